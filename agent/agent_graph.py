@@ -1,12 +1,10 @@
 import os, sys
 from typing import TypedDict, Annotated, Sequence, Dict
 from langgraph.graph import StateGraph, END
-from langgraph.graph.message import add_messages
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from langchain_google_genai import ChatGoogleGenerativeAI # Importar Gemini
 from langchain_core.tools import tool , BaseTool, Tool
 from dotenv import load_dotenv
-import re, ast
+import re
 from inspect import signature
 import json
 import ldap3
@@ -23,7 +21,17 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 't
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import tool generation node
-from generate_tool_node import generate_tool_node 
+from generate_tool_node import generate_tool_node, recent_generation_failure, record_generation_failure, forget_generation_failures
+from single_flight import SingleFlight, normalize_call_key, is_reusable_result
+from prefetch import Prefetcher, PREFETCH_ENABLED
+from query_planner import MULTI_STEP_TOOL, PlanError, build_planner_prompt, parse_plan, execute_plan
+from tool_validation import profile_store
+from profiling import ProfiledApp, profile_span, profiled_node, enable_session_profiling, session_profiling_enabled
+from tool_index import ToolIndex, fast_path_attribute, make_attribute_tool, signature_for_tool, signature_from_name
+from conversation_memory import SessionStore, bounded_add_messages, DEFAULT_SESSION
+from llm_client import get_llm_client
+from routing_output import RoutingParseError, routing_schema, validate_decision, parse_routing_output, routing_stats
+from prompt_budget import RoutingPrompt, ProviderContextCache, invoke_routing, invoke_with_usage, shorten_description, usage_log
 
 # Import herramientas disponibles (estáticas)
 from user_tools import (
@@ -33,19 +41,18 @@ from user_tools import (
     get_current_user_info_tool,
     get_user_groups_tool,
     enumerate_group_members_tool,
-    get_user_email_tool
+    get_user_email_tool,
+    get_user_attribute_value
 )
+from export_tools import export_directory_tool
+from audit_tools import audit_directory_tool
 
 # Configuración API + Entorno
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
-# Configuración para Gemini
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    logger.critical("GOOGLE_API_KEY no está configurada en el archivo .env.")
-    sys.exit(1)
-
-model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite", google_api_key=GOOGLE_API_KEY, temperature=0) # Usar gemini-2.0-flash-lite
+# Cliente LLM compartido (Gemini por defecto; ver LLM_PROVIDER): límites de tasa, reintentos,
+# cobertura, deadline y fallback determinista para el router y el formateo.
+model = get_llm_client()
 
 # --- FUNCIÓN PARA INICIALIZAR HERRAMIENTAS ESTÁTICAS --- 
 def initialize_static_tools() -> Dict[str, BaseTool]: 
@@ -57,9 +64,21 @@ def initialize_static_tools() -> Dict[str, BaseTool]:
         "get_current_user_info_tool": get_current_user_info_tool, 
         "get_user_groups_tool": get_user_groups_tool, 
         "enumerate_group_members_tool": enumerate_group_members_tool, 
-        "get_user_email_tool": get_user_email_tool 
+        "get_user_email_tool": get_user_email_tool, 
+        "export_directory_tool": export_directory_tool, 
+        "audit_directory_tool": audit_directory_tool 
     } 
 
+# Coalescencia de invocaciones de herramientas. TOOL_RESULT_TTL (segundos, 0 = desactivado)
+# permite reutilizar brevemente un resultado exitoso para la misma herramienta y argumento.
+# No se aplica a UNCOALESCED_TOOLS: cada invocación debe exportar o auditar de nuevo.
+TOOL_RESULT_TTL = float(os.getenv("TOOL_RESULT_TTL", "0"))
+tool_flight = SingleFlight(result_ttl=TOOL_RESULT_TTL)
+
+# Herramientas que escriben archivos o recorren todo el directorio: se ejecutan siempre, sin
+# compartir ni reutilizar resultados (un resultado anterior sería un archivo o un informe obsoleto).
+UNCOALESCED_TOOLS = {"export_directory_tool", "audit_directory_tool"}
+
 # Diccionario de herramientas (inicialmente solo estáticas)
 tools_dict: Dict[str, BaseTool] = initialize_static_tools()
 
@@ -83,6 +102,8 @@ from ldap3 import Server, Connection, ALL_ATTRIBUTES, SUBTREE
 from langchain_core.tools import tool # Importante para que el @tool funcione
 import ldap3.core.exceptions
 import re # Necesario para parsing en herramientas generadas
+from ldap_backend import open_connection # Conexión contra el backend configurado (LDAP o LDIF)
+from filter_builder import eq, presence, prefix, and_, or_, not_, escape_filter_value # Filtros LDAP escapados
 
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '.env')))
 
@@ -111,8 +132,8 @@ LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
         for name in dir(dynamic_module):
             obj = getattr(dynamic_module, name)
             
-            if callable(obj) and hasattr(obj, 'name') and hasattr(obj, 'description'):
-                actual_tool_instance = obj if isinstance(obj, Tool) else Tool(name=obj.name, description=obj.description, func=obj)
+            if isinstance(obj, BaseTool) or (callable(obj) and hasattr(obj, 'name') and hasattr(obj, 'description')):
+                actual_tool_instance = obj if isinstance(obj, BaseTool) else Tool(name=obj.name, description=obj.description, func=obj)
                 
                 if actual_tool_instance.name not in tools_dict:
                     tools_dict[actual_tool_instance.name] = actual_tool_instance
@@ -128,22 +149,31 @@ load_dynamic_tools()
 
 # Estado del agente
 class AgentState(TypedDict, total=False):
-    messages: Annotated[Sequence[BaseMessage], add_messages]
+    messages: Annotated[Sequence[BaseMessage], bounded_add_messages]
+    session_id: str
     user_input: str
     tool_name: str
     tool_arg: str
     tool_generated: bool
+    tool_result_ready: bool
     result: str 
     new_generated_tool: BaseTool
     generated_tool_code: str
+    generated_tool_profile: dict
+    plan: list
+    plan_results: dict
+    profile: bool
 
 # --- NUEVA FUNCIÓN PARA GENERAR DESCRIPCIÓN DE TOOLS DINÁMICAMENTE ---
-def get_available_tools_description() -> str:
-    """Genera una descripción formateada de las herramientas disponibles en tools_dict."""
+def get_available_tools_description(max_description_chars: int | None = None) -> str:
+    """
+    Genera una descripción formateada de las herramientas disponibles en tools_dict.
+    Con 'max_description_chars' se acortan las descripciones para respetar el presupuesto del prompt.
+    """
     description = ""
     tool_number = 1
     for tool_name, tool_obj in tools_dict.items():
-        tool_desc = getattr(tool_obj, 'description', 'No hay descripción disponible.')
+        tool_desc = shorten_description(getattr(tool_obj, 'description', 'No hay descripción disponible.'), max_description_chars)
         
         params = []
         func_to_inspect = getattr(tool_obj, 'func', tool_obj) 
@@ -159,26 +189,45 @@ def get_available_tools_description() -> str:
 
         description += f"{tool_number}. {tool_name}:\n"
         description += f"- Uso: {tool_desc}\n"
-        description += f"{arg_req}\n\n"
+        description += f"{arg_req}\n"
+        cost = profile_store.summary(tool_name)
+        if cost:
+            description += f"- Costo medido: {cost}\n"
+        description += "\n"
         tool_number += 1
     return description
 # --- FIN NUEVA FUNCIÓN ---
 
 
-# Nodo de selección
-def select_tool_node(state: AgentState) -> AgentState:
-    user_input = state["user_input"]
-    
-    current_messages = state.get("messages", [])
-    current_messages.append(HumanMessage(content=user_input)) 
-    
-    prompt = f"""
-    Eres un agente especializado en seguridad ofensiva LDAP. Tu objetivo principal es ayudarte a recopilar información y realizar tareas de reconocimiento en un servidor LDAP. 
+# Índice de firmas de intención: evita generar herramientas casi duplicadas
+tool_index = ToolIndex(cost_of=profile_store.cost)
 
-    Las herramientas disponibles son: 
-    
-    {get_available_tools_description()} 
+def resolve_tool_intent(state: AgentState) -> None:
+    """
+    Mapea el nombre de herramienta elegido por el LLM a una herramienta existente equivalente
+    o, si pide un único atributo de usuario, registra una herramienta genérica sin generar código.
+    """
+    tool_name = state.get("tool_name", "")
+    if not tool_name or tool_name in tools_dict or tool_name in ("ninguno", MULTI_STEP_TOOL):
+        return
+
+    existing_tool = tool_index.resolve(tool_name, tools_dict)
+    if existing_tool:
+        logger.info(f"La herramienta '{tool_name}' equivale a '{existing_tool}'. Se reutiliza sin generar código.")
+        state["tool_name"] = existing_tool
+        return
 
+    attribute = fast_path_attribute(tool_name)
+    if attribute:
+        tools_dict[tool_name] = make_attribute_tool(tool_name, attribute, get_user_attribute_value)
+        logger.info(f"Herramienta genérica '{tool_name}' registrada para el atributo '{attribute}'.")
+
+# Prompt de enrutamiento: prefijo estable (rol, catálogo, instrucciones, ejemplos y formato) + consulta.
+ROUTING_ROLE = """
+    Eres un agente especializado en seguridad ofensiva LDAP. Tu objetivo principal es ayudarte a recopilar información y realizar tareas de reconocimiento en un servidor LDAP. 
+"""
+
+ROUTING_INSTRUCTIONS = """
     Instrucciones clave para la selección de herramientas: 
     1.  **Si la consulta es sobre un atributo ESPECÍFICO de un usuario** (ej. 'dame el teléfono de Alice', 'cuál es el título de Bob', 'dime el departamento de un usuario'): 
         * **Prioridad 1: Busca una herramienta DEDICADA existente** para ese atributo (ej. `get_user_email_tool`). Si la encuentras, úsala. 
@@ -193,7 +242,9 @@ def select_tool_node(state: AgentState) -> AgentState:
         * Ejemplos: `get_password_policy_tool`, `find_weak_password_users_tool`, `list_computers_tool`. 
         * La herramienta generada debe tener un único parámetro `query: str` si necesita una entrada, o ningún parámetro si es una consulta general del dominio. Debe devolver **SOLO el valor del atributo solicitado o la lista de resultados directamente**. 
     4.  **Si la consulta NO está relacionada con LDAP** (ej. un saludo, una pregunta general, etc.): 
-        * Tu respuesta JSON debe ser: ` {{"tool": "ninguno", "arg": "ninguno"}} ` 
+        * Tu respuesta JSON debe ser: ` {"tool": "ninguno", "arg": "ninguno"} ` 
+    5.  **Si la consulta necesita ENCADENAR varias herramientas** (ej. 'dame los emails de todos los miembros de developers', 'qué títulos tienen los usuarios del grupo it'): 
+        * Tu respuesta JSON debe ser: ` {"tool": "multi_step", "arg": "ninguno"} `. Un planificador armará los pasos. 
 
     **IMPORTANTE: Cuando selecciones una herramienta, DEBES usar su `nombre_de_tool` EXACTO, no su número de la lista.**
     **CRÍTICO: Si la herramienta requiere un argumento, el valor de 'arg' DEBE ser el valor exacto que la herramienta necesita.**
@@ -203,63 +254,176 @@ def select_tool_node(state: AgentState) -> AgentState:
     * Para herramientas que requieren un `group_name` (como `enumerate_group_members_tool`), el `arg` SIEMPRE será el nombre del grupo (ej. "it", "managers", "admins") que se encuentra en la consulta del usuario.
     * Para herramientas que requieren un `field` (como `get_current_user_info_tool`), el `arg` SIEMPRE será el nombre del atributo solicitado (ej. "title", "mail", "phone") que se encuentra en la consulta del usuario.
     * **El valor de 'arg' DEBE ser solo el dato puro, sin comillas adicionales, texto explicativo, o prefijos como 'de' o 'del equipo'.**
-
-    **EJEMPLOS DE EXTRACCIÓN DE ARGUMENTOS (¡PRECISOS Y CRÍTICOS PARA EL ÉXITO!):**
-    * **Consulta:** "dame el email de test.user"
-        **JSON:** ` {{"tool": "get_user_email_tool", "arg": "test.user"}} `
-        *(Aquí, "test.user" es el UID exacto)*
-    * **Consulta:** "cuáles son los grupos de alice.brown"
-        **JSON:** ` {{"tool": "get_user_groups_tool", "arg": "alice.brown"}} `
-        *(Aquí, "alice.brown" es el UID exacto)*
-    * **Consulta:** "dame todos los atributos de john.doe"
-        **JSON:** ` {{"tool": "get_user_attributes_tool", "arg": "john.doe"}} `
-        *(Aquí, "john.doe" es el UID exacto)*
-    * **Consulta:** "enumera los miembros del grupo admins"
-        **JSON:** ` {{"tool": "enumerate_group_members_tool", "arg": "admins"}} `
-        *(Aquí, "admins" es el nombre del grupo exacto)*
-    * **Consulta:** "dame todos los usuarios del equipo it"
-        **JSON:** ` {{"tool": "enumerate_group_members_tool", "arg": "it"}} `
-        *(Aquí, "it" es el nombre del grupo exacto)*
-    * **Consulta:** "dame el título del usuario actual"
-        **JSON:** ` {{"tool": "get_current_user_info_tool", "arg": "title"}} `
-        *(Aquí, "title" es el nombre del campo exacto)*
-    * **Consulta:** "dame todos los usuarios"
-        **JSON:** ` {{"tool": "get_all_usernames_tool", "arg": "ninguno"}} `
-        *(No requiere argumento)*
-
-    Consulta del usuario: "{user_input}" 
-
+"""
+
+# Ordenados por prioridad: si el prompt excede el presupuesto se descartan desde el final.
+ROUTING_EXAMPLES = [
+    """    * **Consulta:** "dame el email de test.user"
+        **JSON:** ` {"tool": "get_user_email_tool", "arg": "test.user"} `
+        *(Aquí, "test.user" es el UID exacto)*""",
+    """    * **Consulta:** "cuáles son los grupos de alice.brown"
+        **JSON:** ` {"tool": "get_user_groups_tool", "arg": "alice.brown"} `
+        *(Aquí, "alice.brown" es el UID exacto)*""",
+    """    * **Consulta:** "dame todos los atributos de john.doe"
+        **JSON:** ` {"tool": "get_user_attributes_tool", "arg": "john.doe"} `
+        *(Aquí, "john.doe" es el UID exacto)*""",
+    """    * **Consulta:** "enumera los miembros del grupo admins"
+        **JSON:** ` {"tool": "enumerate_group_members_tool", "arg": "admins"} `
+        *(Aquí, "admins" es el nombre del grupo exacto)*""",
+    """    * **Consulta:** "dame el título del usuario actual"
+        **JSON:** ` {"tool": "get_current_user_info_tool", "arg": "title"} `
+        *(Aquí, "title" es el nombre del campo exacto)*""",
+    """    * **Consulta:** "dame todos los usuarios"
+        **JSON:** ` {"tool": "get_all_usernames_tool", "arg": "ninguno"} `
+        *(No requiere argumento)*""",
+    """    * **Consulta:** "exporta todos los usuarios con mail, title y sus grupos en csv"
+        **JSON:** ` {"tool": "export_directory_tool", "arg": "mail,title,groups,csv"} `
+        *(Atributos separados por comas más las opciones 'groups', 'csv'/'jsonl' y 'gzip')*""",
+    """    * **Consulta:** "dame todos los usuarios del equipo it"
+        **JSON:** ` {"tool": "enumerate_group_members_tool", "arg": "it"} `
+        *(Aquí, "it" es el nombre del grupo exacto)*""",
+    """    * **Consulta:** "haz una auditoría de seguridad del directorio"
+        **JSON:** ` {"tool": "audit_directory_tool", "arg": "ninguno"} `
+        *(Una sola pasada por todo el directorio; 'arg' puede limitar los analizadores, ej. "plaintext_passwords")*""",
+]
+
+ROUTING_RESPONSE_FORMAT = """
     Responde estrictamente en JSON: 
-    {{ 
+    { 
     "tool": "<nombre_de_tool>", 
     "arg": "<argumento_o_ninguno>" 
-    }} 
-    """ 
-    response = model.invoke(prompt) 
-    response_text = response.content 
+    }
+"""
+
+def build_routing_prefix(examples: int, description_chars: int | None) -> str:
+    prefix = ROUTING_ROLE
+    prefix += "\n    Las herramientas disponibles son: \n\n"
+    prefix += get_available_tools_description(description_chars)
+    prefix += ROUTING_INSTRUCTIONS
+    if examples:
+        prefix += "\n    **EJEMPLOS DE EXTRACCIÓN DE ARGUMENTOS (¡PRECISOS Y CRÍTICOS PARA EL ÉXITO!):**\n"
+        prefix += "\n".join(ROUTING_EXAMPLES[:examples]) + "\n"
+    return prefix + ROUTING_RESPONSE_FORMAT
+
+def build_routing_suffix(user_input: str, context: str = "") -> str:
+    context_block = ""
+    if context:
+        context_block = f"""
+    Contexto de la conversación (úsalo para completar el 'arg' de seguimientos como "y sus grupos?" o "y los de ese grupo?"):
+    {context}
+"""
+    return f"""{context_block}
+    Consulta del usuario: "{user_input}" 
 
-    try: 
-        match = re.search(r"\{(.+?)\}", response_text, re.DOTALL) 
-        if match: 
-            tool_info = ast.literal_eval("{" + match.group(1) + "}") 
-            tool_name = tool_info.get("tool", "").strip() 
-            tool_arg = tool_info.get("arg", "").strip() 
-
-            state["tool_name"] = tool_name 
-            state["tool_arg"] = tool_arg 
-        else: 
-            state["tool_name"] = "" 
-            state["tool_arg"] = "" 
-            logger.warning(f"No se pudo parsear la respuesta del LLM a JSON: {response_text}") 
+    Responde únicamente con el JSON indicado.
+    """
 
-        state["messages"] = current_messages 
-        
-    except Exception as e: 
-        state["tool_name"] = "" 
-        state["tool_arg"] = "" 
-        logger.error(f"Error parseando la respuesta del LLM en select_tool_node: {e}", exc_info=True) 
-        state["messages"] = current_messages 
-        
+def tools_catalog_fingerprint() -> tuple:
+    return tuple((tool_name, getattr(tool_obj, 'description', ''), profile_store.summary(tool_name))
+                 for tool_name, tool_obj in tools_dict.items())
+
+routing_prompt = RoutingPrompt(build_routing_prefix, build_routing_suffix, len(ROUTING_EXAMPLES))
+routing_context_cache = ProviderContextCache()
+
+
+# Memoria de conversación por sesión (historial acotado, resumen y últimas entidades)
+MEMORY_LLM_SUMMARY = os.getenv("MEMORY_LLM_SUMMARY", "0") == "1"
+
+def summarize_with_llm(previous_summary: str, turns: list) -> str:
+    turns_text = "\n".join(f"{role}: {text}" for role, text in turns)
+    prompt = f"""
+    Resume en pocas líneas esta conversación con un agente LDAP, conservando los usuarios, grupos y atributos mencionados.
+
+    Resumen previo:
+    {previous_summary or "(vacío)"}
+
+    Turnos nuevos:
+    {turns_text}
+
+    Devuelve solo el resumen actualizado.
+    """
+    return invoke_with_usage(model, "summary", prompt).content
+
+sessions = SessionStore(summarizer=summarize_with_llm if MEMORY_LLM_SUMMARY else None)
+
+def tool_arg_kind(tool_name: str) -> str:
+    tool_obj = tools_dict.get(tool_name)
+    if tool_obj is None:
+        return signature_from_name(tool_name).arg_kind
+    return signature_for_tool(tool_name, tool_obj).arg_kind
+
+def fill_follow_up_arg(state: AgentState, memory) -> None:
+    """Completa el argumento de un seguimiento ("y sus grupos?") con la última entidad de la sesión."""
+    tool_name = state.get("tool_name", "")
+    tool_arg = state.get("tool_arg", "")
+    if tool_name in ("", "ninguno", MULTI_STEP_TOOL) or (tool_arg and tool_arg.lower() != "ninguno"):
+        return
+    value = memory.entity(tool_arg_kind(tool_name))
+    if value:
+        logger.info(f"Argumento de '{tool_name}' tomado del contexto de la conversación: '{value}'.")
+        state["tool_arg"] = value
+
+# Salida estructurada del router: se desactiva sola si el modelo no la soporta.
+ROUTING_STRUCTURED_OUTPUT = os.getenv("ROUTING_STRUCTURED_OUTPUT", "1") == "1"
+routing_schema_cache = {}
+
+def route_query(user_input: str, context: str = ""):
+    """
+    Pide al LLM la herramienta y el argumento para la consulta. Usa salida estructurada validada
+    contra un esquema de las herramientas registradas y, si no está disponible o falla, el texto
+    del modelo con reparación local del JSON. Devuelve None si no se obtuvo una decisión válida.
+    """
+    global ROUTING_STRUCTURED_OUTPUT
+    fingerprint = tools_catalog_fingerprint()
+    special_tools = ("ninguno", MULTI_STEP_TOOL)
+    schema = None
+    if ROUTING_STRUCTURED_OUTPUT and hasattr(model, "with_structured_output"):
+        if fingerprint not in routing_schema_cache:
+            routing_schema_cache.clear()
+            routing_schema_cache[fingerprint] = routing_schema(tools_dict, special_tools)
+        schema = routing_schema_cache[fingerprint]
+
+    parsed = None
+    try:
+        response, parsed = invoke_routing(model, routing_prompt, fingerprint, user_input, routing_context_cache, context, schema)
+    except Exception as e:
+        if schema is None:
+            raise
+        logger.warning(f"La salida estructurada del router falló ({e}). Se desactiva y se usa texto.")
+        ROUTING_STRUCTURED_OUTPUT = False
+        response, parsed = invoke_routing(model, routing_prompt, fingerprint, user_input, routing_context_cache, context)
+
+    try:
+        if parsed is not None:
+            decision = validate_decision(parsed, tools_dict, special_tools)
+            routing_stats["structured"] += 1
+            return decision
+        return parse_routing_output(str(response.content), tools_dict, special_tools)
+    except RoutingParseError as e:
+        if parsed is not None:
+            # La decisión estructurada no validó: se intenta con el texto crudo antes de desistir.
+            try:
+                return parse_routing_output(str(response.content), tools_dict, special_tools)
+            except RoutingParseError:
+                pass
+        logger.warning(f"No se pudo interpretar la respuesta del router: {e}")
+        return None
+
+# Nodo de selección
+def select_tool_node(state: AgentState) -> AgentState:
+    user_input = state["user_input"]
+    
+    current_messages = state.get("messages", [])
+    current_messages.append(HumanMessage(content=user_input)) 
+    
+    memory = sessions.get(state.get("session_id")) 
+    decision = route_query(user_input, memory.context_for_prompt()) 
+    state["tool_name"] = decision.tool if decision else "" 
+    state["tool_arg"] = decision.arg if decision else "" 
+    state["messages"] = current_messages 
+
+    resolve_tool_intent(state) 
+    fill_follow_up_arg(state, memory) 
     return state 
 
 # Decisión condicional:
@@ -268,12 +432,64 @@ def decide_if_tool_exists(state: AgentState) -> str:
     
     if tool_name == "ninguno": 
         return "respond_to_user" 
+    elif not tool_name: 
+        # Salida del router ilegible: se pide reformular en lugar de generar una herramienta.
+        return "respond_to_user" 
+    elif tool_name == MULTI_STEP_TOOL: 
+        return "plan_query" 
     elif tool_name in tools_dict: 
         return "execute_tool" 
+    elif recent_generation_failure(tool_name): 
+        logger.warning(f"⚠️ La generación de '{tool_name}' falló recientemente. No se reintenta.") 
+        return "generation_failed" 
     else: 
         logger.warning(f"⚠️ La herramienta '{tool_name}' NO existe en tools_dict. Se procederá a generación.") 
         return "generate_tool" 
 
+def build_tool_call(tool_name: str, tool_arg=None):
+    """
+    Prepara la invocación de una herramienta registrada pasando 'tool_arg' como su primer parámetro
+    (si lo tiene). Devuelve (clave de coalescencia, función sin argumentos que la ejecuta).
+    """
+    tool_fn = tools_dict[tool_name]
+    sig = signature(tool_fn.func)
+    params = list(sig.parameters.keys()) 
+
+    invoke_args = {}
+    if tool_arg and str(tool_arg).lower() != "ninguno" and tool_arg != "":
+        if params: 
+            
+            param_name = params[0] 
+            invoke_args = {param_name: tool_arg}
+        else: 
+            logger.warning(f"La herramienta '{tool_name}' recibió el argumento '{tool_arg}' pero no espera parámetros. Invocando sin argumentos.")
+
+    call_key = normalize_call_key(tool_name, invoke_args.get(params[0]) if invoke_args else None)
+
+    def run():
+        with profile_span(f"tool:{tool_name}"):
+            return tool_fn.invoke(invoke_args)
+
+    return call_key, run
+
+def invoke_tool(tool_name: str, tool_arg=None):
+    """
+    Invoca una herramienta registrada. Las invocaciones idénticas concurrentes comparten una sola
+    operación LDAP, y las precalentadas por el prefetcher se sirven sin ir al directorio (salvo
+    UNCOALESCED_TOOLS, que se ejecutan siempre).
+    """
+    call_key, run = build_tool_call(tool_name, tool_arg)
+    if tool_name in UNCOALESCED_TOOLS:
+        return run()
+    prefetcher.record(call_key, tool_arg)
+    return tool_flight.do(call_key, run, cacheable=is_reusable_result)
+
+# Precalentamiento: registra los pares (herramienta, argumento) más pedidos y los precarga en
+# tool_flight al arrancar y cada PREFETCH_INTERVAL segundos (ver agent/prefetch.py).
+prefetcher = Prefetcher(tool_flight, build_tool_call)
+if PREFETCH_ENABLED:
+    prefetcher.start()
+
 # Ejecución de herramienta 
 def execute_tool_node(state: AgentState) -> AgentState: 
     tool_name = state.get("tool_name", "") 
@@ -292,22 +508,12 @@ def execute_tool_node(state: AgentState) -> AgentState:
         return state
 
     try:
-        execution_result = None
-        
-        sig = signature(tool_fn.func)
-        params = list(sig.parameters.keys()) 
-
-        if tool_arg and str(tool_arg).lower() != "ninguno" and tool_arg != "":
-            if params: 
-                
-                param_name = params[0] 
-                invoke_args = {param_name: tool_arg}
-                execution_result = tool_fn.invoke(invoke_args)
-            else: 
-                logger.warning(f"La herramienta '{tool_name}' recibió el argumento '{tool_arg}' pero no espera parámetros. Invocando sin argumentos.")
-                execution_result = tool_fn.invoke({}) 
-        else: 
-            execution_result = tool_fn.invoke({})
+        if state.get("tool_result_ready"):
+            # La herramienta recién generada ya se ejecutó con este mismo argumento en generate_tool.
+            execution_result = state.get("result")
+            state["tool_result_ready"] = False
+        else:
+            execution_result = invoke_tool(tool_name, tool_arg)
 
         state["result"] = execution_result
         
@@ -323,7 +529,7 @@ def execute_tool_node(state: AgentState) -> AgentState:
         Si el resultado indica que no se encontró información, informa al usuario de manera cortés.
         Sé conciso, pero informativo.
         """
-        formatted_response_from_llm = model.invoke(format_prompt)
+        formatted_response_from_llm = invoke_with_usage(model, "format", format_prompt)
         formatted_result = formatted_response_from_llm.content
 
         state["messages"].append(AIMessage(content=formatted_result))
@@ -348,7 +554,7 @@ def respond_to_user_node(state: AgentState) -> AgentState:
     Por favor, responde amablemente al usuario indicando que tu propósito es ayudar con consultas LDAP y si puede reformular su pregunta. 
     Sé conciso y directo. 
     """ 
-    response_from_llm = model.invoke(prompt_for_response) 
+    response_from_llm = invoke_with_usage(model, "respond", prompt_for_response) 
     
     final_response = response_from_llm.content 
     state["result"] = final_response 
@@ -356,6 +562,65 @@ def respond_to_user_node(state: AgentState) -> AgentState:
     state["messages"] = current_messages 
     return state 
 
+# Nodo planificador: un único llamado al LLM produce el DAG de herramientas para consultas compuestas 
+def plan_query_node(state: AgentState) -> AgentState: 
+    user_input = state.get("user_input", "") 
+    current_messages = state.get("messages", []) 
+
+    context = sessions.get(state.get("session_id")).context_for_prompt() 
+    prompt = build_planner_prompt(user_input, get_available_tools_description(), context) 
+    response = invoke_with_usage(model, "plan", prompt) 
+
+    try: 
+        state["plan"] = parse_plan(response.content, tools_dict) 
+    except PlanError as e: 
+        error_msg = f"❌ No se pudo planificar la consulta: {e}" 
+        logger.warning(f"{error_msg} Respuesta del LLM: {response.content}") 
+        state["plan"] = [] 
+        state["result"] = error_msg 
+        current_messages.append(AIMessage(content=error_msg)) 
+        state["messages"] = current_messages 
+    return state 
+
+def decide_if_plan_is_valid(state: AgentState) -> str: 
+    return "execute_plan" if state.get("plan") else "end" 
+
+# Ejecución del plan: pasos independientes en paralelo y una sola pasada de formateo al final 
+def execute_plan_node(state: AgentState) -> AgentState: 
+    user_input = state.get("user_input", "") 
+    current_messages = state.get("messages", []) 
+    plan = state.get("plan", []) 
+
+    try: 
+        plan_results = execute_plan(plan, invoke_tool) 
+        state["plan_results"] = plan_results 
+        state["result"] = plan_results 
+
+        steps_summary = "\n".join(
+            f"- Paso {step.id} ({step.tool}): {json.dumps(plan_results.get(step.id), ensure_ascii=False, default=str)}" 
+            for step in plan 
+        ) 
+        format_prompt = f"""
+        El usuario preguntó: "{user_input}"
+        Para responder se ejecutaron varias herramientas encadenadas, con estos resultados:
+        {steps_summary}
+
+        Por favor, combina estos resultados en una única respuesta amigable y conversacional para el usuario.
+        Si el resultado es una lista de elementos, preséntalos de forma clara y legible.
+        Si algún paso indica que no se encontró información, informa al usuario de manera cortés.
+        Sé conciso, pero informativo.
+        """
+        formatted_response_from_llm = invoke_with_usage(model, "format_plan", format_prompt) 
+        current_messages.append(AIMessage(content=formatted_response_from_llm.content)) 
+    except Exception as e: 
+        error_msg = f"❌ Error ejecutando el plan de varios pasos: {str(e)}" 
+        state["result"] = error_msg 
+        logger.error(error_msg, exc_info=True) 
+        current_messages.append(AIMessage(content=error_msg)) 
+
+    state["messages"] = current_messages 
+    return state 
+
 # Nuevo nodo para manejar la herramienta generada y añadirla al tools_dict global 
 def handle_generated_tool(state: AgentState) -> AgentState: 
     global tools_dict 
@@ -373,7 +638,7 @@ def handle_generated_tool(state: AgentState) -> AgentState:
                     current_file_content = f_read.read()
 
             
-            with open(DYNAMIC_TOOLS_FILE, 'w', encoding='utf-8') as f_write:
+            with profile_span("write:dynamic_tools"), open(DYNAMIC_TOOLS_FILE, 'w', encoding='utf-8') as f_write:
                 if not re.search(rf"(?:^|\n)\s*@tool(?:\s*\(.*?\))?\s*\ndef\s+{re.escape(new_tool_name)}\(", current_file_content, re.MULTILINE): 
                     f_write.write(current_file_content)
                     f_write.write("\n\n") 
@@ -385,7 +650,8 @@ def handle_generated_tool(state: AgentState) -> AgentState:
             
             if "dynamic_tools" in sys.modules: 
                 dynamic_module = sys.modules["dynamic_tools"] 
-                importlib.reload(dynamic_module) 
+                with profile_span("reload:dynamic_tools"): 
+                    importlib.reload(dynamic_module) 
                 logger.info(f"✅ Módulo 'dynamic_tools.py' recargado.") 
             else: 
                 
@@ -403,51 +669,116 @@ def handle_generated_tool(state: AgentState) -> AgentState:
             found_reloaded_tool = False 
             for name in dir(dynamic_module): 
                 obj = getattr(dynamic_module, name) 
-                if callable(obj) and hasattr(obj, 'name') and hasattr(obj, 'description'): 
-                    actual_tool_instance = obj if isinstance(obj, Tool) else Tool(name=obj.name, description=obj.description, func=obj) 
+                if isinstance(obj, BaseTool) or (callable(obj) and hasattr(obj, 'name') and hasattr(obj, 'description')): 
+                    actual_tool_instance = obj if isinstance(obj, BaseTool) else Tool(name=obj.name, description=obj.description, func=obj) 
                     if actual_tool_instance.name == new_tool_name: 
                         tools_dict[actual_tool_instance.name] = actual_tool_instance 
                         logger.info(f"✅ Herramienta dinámica '{actual_tool_instance.name}' añadida al diccionario global después de recarga.") 
+                        if state.get("generated_tool_profile"): 
+                            profile_store.save(new_tool_name, state["generated_tool_profile"]) 
                         found_reloaded_tool = True 
                         break 
 
             if not found_reloaded_tool: 
                 logger.error(f"❌ La herramienta '{new_tool_name}' no se encontró en el módulo recargado.") 
+                record_generation_failure(new_tool_name, "la herramienta no se encontró en dynamic_tools.py tras recargarlo.")
 
         except Exception as e: 
             logger.error(f"❌ Error al persistir o recargar el código de la herramienta en {DYNAMIC_TOOLS_FILE}: {e}", exc_info=True) 
+            record_generation_failure(new_tool_name, str(e))
     
     return state 
 
+# Tras generar: la herramienta registrada se ejecuta directamente con el tool_arg original,
+# sin volver a pasar por select_tool (una llamada menos al LLM y sin riesgo de bucle).
+def decide_after_generation(state: AgentState) -> str: 
+    if state.get("tool_generated") and state.get("tool_name") in tools_dict: 
+        return "execute_tool" 
+    return "generation_failed" 
+
+def generation_failed_node(state: AgentState) -> AgentState: 
+    tool_name = state.get("tool_name", "") 
+    error = recent_generation_failure(tool_name) or state.get("result") or "error desconocido" 
+    message = f"❌ No se pudo generar la herramienta '{tool_name}' para esta consulta: {error}" 
+    state["result"] = message 
+    state["tool_result_ready"] = False 
+    current_messages = state.get("messages", []) 
+    current_messages.append(AIMessage(content=message)) 
+    state["messages"] = current_messages 
+    return state 
+
+# Registra el turno en la memoria de la sesión: consulta, entidades usadas y respuesta final.
+def remember_turn_node(state: AgentState) -> AgentState: 
+    memory = sessions.get(state.get("session_id")) 
+    memory.add_turn("usuario", state.get("user_input", "")) 
+
+    if state.get("plan") and state.get("tool_name") == MULTI_STEP_TOOL: 
+        for step in state["plan"]: 
+            memory.remember_entity(tool_arg_kind(step.tool), step.arg) 
+    elif state.get("tool_name") in tools_dict: 
+        memory.remember_entity(tool_arg_kind(state["tool_name"]), state.get("tool_arg")) 
+
+    for message in reversed(state.get("messages", [])): 
+        if isinstance(message, AIMessage): 
+            memory.add_turn("agente", message.content) 
+            break 
+    return {} 
+
 # Grafo 
 graph = StateGraph(AgentState) 
 
-graph.add_node("select_tool", select_tool_node) 
+graph.add_node("select_tool", profiled_node("select_tool", select_tool_node)) 
 graph.add_conditional_edges( 
     "select_tool", 
     decide_if_tool_exists, 
     { 
         "execute_tool": "execute_tool", 
         "generate_tool": "generate_tool", 
-        "respond_to_user": "respond_to_user_node" 
+        "respond_to_user": "respond_to_user_node", 
+        "plan_query": "plan_query", 
+        "generation_failed": "generation_failed" 
     } 
 ) 
 
-graph.add_node("execute_tool", execute_tool_node) 
-graph.add_node("generate_tool", generate_tool_node) 
-graph.add_node("handle_generated_tool", handle_generated_tool) 
-graph.add_node("respond_to_user_node", respond_to_user_node) 
-
-graph.add_edge("execute_tool", END) 
-graph.add_edge("respond_to_user_node", END) 
+graph.add_node("execute_tool", profiled_node("execute_tool", execute_tool_node)) 
+graph.add_node("generate_tool", profiled_node("generate_tool", generate_tool_node)) 
+graph.add_node("handle_generated_tool", profiled_node("handle_generated_tool", handle_generated_tool)) 
+graph.add_node("respond_to_user_node", profiled_node("respond_to_user_node", respond_to_user_node)) 
+graph.add_node("plan_query", profiled_node("plan_query", plan_query_node)) 
+graph.add_node("execute_plan", profiled_node("execute_plan", execute_plan_node)) 
+graph.add_node("generation_failed", profiled_node("generation_failed", generation_failed_node)) 
+graph.add_node("remember_turn", profiled_node("remember_turn", remember_turn_node)) 
+
+graph.add_edge("execute_tool", "remember_turn") 
+graph.add_edge("respond_to_user_node", "remember_turn") 
+graph.add_edge("execute_plan", "remember_turn") 
+graph.add_edge("generation_failed", "remember_turn") 
+graph.add_edge("remember_turn", END) 
+graph.add_conditional_edges( 
+    "plan_query", 
+    decide_if_plan_is_valid, 
+    { 
+        "execute_plan": "execute_plan", 
+        "end": "remember_turn" 
+    } 
+) 
 
 graph.add_edge("generate_tool", "handle_generated_tool") 
-graph.add_edge("handle_generated_tool", "select_tool") 
+graph.add_conditional_edges( 
+    "handle_generated_tool", 
+    decide_after_generation, 
+    { 
+        "execute_tool": "execute_tool", 
+        "generation_failed": "generation_failed" 
+    } 
+) 
 
 graph.set_entry_point("select_tool") 
 
 
-app = graph.compile() 
+# Envoltorio de perfilado: solo actúa en las consultas marcadas con "profile", en sesiones con
+# perfilado activo o según PROFILE_SAMPLE_RATE.
+app = ProfiledApp(graph.compile()) 
 
 if __name__ == "__main__": 
     logging.getLogger().setLevel(logging.CRITICAL) 
@@ -459,7 +790,9 @@ if __name__ == "__main__":
         print("1. Realizar consulta LDAP") 
         print("2. Ver herramientas disponibles") 
         print("3. Resetear herramientas dinámicas")
-        print("4. Salir") 
+        print("4. Ver uso de tokens del LLM")
+        print("5. Activar/desactivar el perfilado de las consultas")
+        print("6. Salir") 
         
         choice = input("Elige una opción: ") 
         
@@ -472,6 +805,7 @@ if __name__ == "__main__":
             initial_messages = [HumanMessage(content=user_input)] 
             
             inputs = { 
+                "session_id": DEFAULT_SESSION, 
                 "user_input": user_input, 
                 "tool_generated": False, 
                 "result": "", 
@@ -518,16 +852,9 @@ if __name__ == "__main__":
                 
             reset_dynamic_tools_file() 
 
-            tools_dict = {
-                "get_all_usernames_tool": get_all_usernames_tool,
-                "get_user_attributes_tool": get_user_attributes_tool,
-                "get_group_names_tool": get_group_names_tool,
-                "get_current_user_info_tool": get_current_user_info_tool,
-                "get_user_groups_tool": get_user_groups_tool,
-                "enumerate_group_members_tool": enumerate_group_members_tool,
-                "get_user_email_tool": get_user_email_tool
-            }
+            tools_dict = initialize_static_tools()
             load_dynamic_tools()
+            forget_generation_failures()
             print("✅ Reseteo completado. Las herramientas dinámicas han sido reiniciadas.") 
             print("\n--- ¡Importante: Reinicia tu agente para un reseteo completo! ---") 
             print("Para que los cambios surtan efecto y tu agente cargue solo las herramientas iniciales:") 
@@ -535,8 +862,38 @@ if __name__ == "__main__":
             print("------------------------------------------------------------------") 
 
         elif choice == '4': 
+            print("\n--- Uso de tokens por tipo de llamada ---") 
+            if not usage_log.totals: 
+                print("Todavía no se realizaron llamadas al LLM.") 
+            for label, totals in usage_log.totals.items(): 
+                calls = totals["calls"] 
+                print(f"{label}: {calls} llamadas, {totals['latency_ms'] / calls:.0f} ms promedio, "
+                      f"prompt≈{totals['estimated_prompt_tokens']:.0f} tokens estimados, entrada={totals['input_tokens']:.0f}, "
+                      f"salida={totals['output_tokens']:.0f}, cacheados={totals['cached_tokens']:.0f}") 
+            prefix = routing_prompt.prefix(tools_catalog_fingerprint()) 
+            print(f"Prefijo de enrutamiento: {prefix.tokens} tokens (presupuesto {routing_prompt.budget}), "
+                  f"{prefix.examples}/{len(ROUTING_EXAMPLES)} ejemplos.") 
+            print("Decisiones del router: " + ", ".join(f"{key}={value}" for key, value in routing_stats.items())) 
+            prefetch_report = prefetcher.report() 
+            print(f"Precalentamiento: {prefetch_report['warmed']} entradas cargadas en {prefetch_report['cycles']} ciclos, "
+                  f"{prefetch_report['warm_hits']}/{prefetch_report['tool_calls']} llamadas servidas con datos precalentados "
+                  f"(tasa de acierto {prefetch_report['hit_rate']:.0%}).") 
+            if model.cache is not None: 
+                print(f"Caché LLM ({model.cache.mode}): " + ", ".join(f"{key}={value}" for key, value in model.cache.stats.items())) 
+            print("---------------------------------") 
+
+        elif choice == '5': 
+            enabled = not session_profiling_enabled(DEFAULT_SESSION) 
+            enable_session_profiling(DEFAULT_SESSION, enabled) 
+            if enabled: 
+                print("🔬 Perfilado activado: cada consulta escribe su perfil en PROFILE_DIR.") 
+                print("Para ver los puntos calientes: python directory_cli.py profiles") 
+            else: 
+                print("Perfilado desactivado.") 
+
+        elif choice == '6': 
             print("👋 ¡Hasta luego!") 
             break 
         
         else: 
-            print("Opción no válida. Por favor, elige un número del 1 al 4.")
+            print("Opción no válida. Por favor, elige un número del 1 al 6.")
@@ -0,0 +1,139 @@
+import os
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Sequence
+
+from langgraph.graph.message import add_messages
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Mensajes que conserva el canal 'messages' del estado del grafo.
+MEMORY_MAX_MESSAGES = int(os.getenv("MEMORY_MAX_MESSAGES", "20"))
+# Turnos (usuario o agente) que guarda cada sesión antes de resumir los más viejos.
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "12"))
+MEMORY_MAX_TURN_CHARS = int(os.getenv("MEMORY_MAX_TURN_CHARS", "400"))
+MEMORY_SUMMARY_CHARS = int(os.getenv("MEMORY_SUMMARY_CHARS", "800"))
+# Turnos desalojados que se acumulan antes de actualizar el resumen (una llamada por lote).
+MEMORY_SUMMARY_BATCH = int(os.getenv("MEMORY_SUMMARY_BATCH", "4"))
+# Turnos recientes que se incluyen como contexto en los prompts.
+MEMORY_PROMPT_TURNS = int(os.getenv("MEMORY_PROMPT_TURNS", "4"))
+MEMORY_MAX_SESSIONS = int(os.getenv("MEMORY_MAX_SESSIONS", "256"))
+
+DEFAULT_SESSION = "default"
+
+# Tipo de argumento de una herramienta -> entidad que recuerda la sesión.
+ENTITY_KINDS = {"uid": "uid", "group": "group"}
+
+
+def bounded_add_messages(left: Sequence, right: Sequence) -> list:
+    """Reducer del canal 'messages': igual que add_messages pero conserva solo los últimos MEMORY_MAX_MESSAGES."""
+    return add_messages(left, right)[-MEMORY_MAX_MESSAGES:]
+
+
+def _compact(text) -> str:
+    text = " ".join(str(text).split())
+    if len(text) > MEMORY_MAX_TURN_CHARS:
+        return text[:MEMORY_MAX_TURN_CHARS - 1] + "…"
+    return text
+
+
+def extractive_summary(previous_summary: str, turns: list[tuple[str, str]]) -> str:
+    """Resumen local sin LLM: agrega una línea corta por turno y conserva el final más reciente."""
+    lines = [previous_summary] if previous_summary else []
+    lines.extend(f"{role}: {text[:120]}" for role, text in turns)
+    summary = "\n".join(lines)
+    if len(summary) > MEMORY_SUMMARY_CHARS:
+        summary = summary[-MEMORY_SUMMARY_CHARS:].split("\n", 1)[-1]
+    return summary
+
+
+class ConversationMemory:
+    """
+    Historial acotado de una sesión: un buffer circular de turnos compactos (rol, texto recortado),
+    un resumen acumulado de los turnos desalojados y las últimas entidades resueltas (uid, grupo).
+    El tamaño por sesión es constante sin importar la duración de la conversación.
+    """
+
+    def __init__(self, summarizer: Callable[[str, list[tuple[str, str]]], str] | None = None):
+        self.turns: deque = deque(maxlen=MEMORY_MAX_TURNS)
+        self.summary = ""
+        self.entities: dict[str, str] = {}
+        self.summarizer = summarizer or extractive_summary
+        self._evicted: list[tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def add_turn(self, role: str, text) -> None:
+        if not text:
+            return
+        with self._lock:
+            if len(self.turns) == self.turns.maxlen:
+                self._evicted.append(self.turns[0])
+            self.turns.append((role, _compact(text)))
+            if len(self._evicted) >= MEMORY_SUMMARY_BATCH:
+                evicted, self._evicted = self._evicted, []
+            else:
+                evicted = None
+        if evicted:
+            self._summarize(evicted)
+
+    def _summarize(self, evicted: list[tuple[str, str]]) -> None:
+        try:
+            summary = self.summarizer(self.summary, evicted)
+        except Exception as e:
+            logger.warning(f"No se pudo resumir el historial: {e}. Se usa el resumen local.")
+            summary = extractive_summary(self.summary, evicted)
+        self.summary = str(summary)[-MEMORY_SUMMARY_CHARS:]
+
+    def remember_entity(self, kind: str, value) -> None:
+        if kind in ENTITY_KINDS and value and str(value).strip().lower() != "ninguno":
+            self.entities[ENTITY_KINDS[kind]] = str(value).strip()
+
+    def entity(self, kind: str) -> str | None:
+        return self.entities.get(ENTITY_KINDS.get(kind, kind))
+
+    def context_for_prompt(self) -> str:
+        """Texto de contexto para los prompts: resumen, entidades y últimos turnos. Vacío si no hay historial."""
+        parts = []
+        if self.summary:
+            parts.append(f"Resumen de la conversación anterior:\n{self.summary}")
+        if self.entities:
+            parts.append("Últimas entidades mencionadas: " + ", ".join(f"{kind}={value}" for kind, value in self.entities.items()))
+        recent = list(self.turns)[-MEMORY_PROMPT_TURNS:]
+        if recent:
+            parts.append("Últimos turnos:\n" + "\n".join(f"{role}: {text}" for role, text in recent))
+        return "\n".join(parts)
+
+
+class SessionStore:
+    """Memorias por sesión con desalojo LRU: como máximo MEMORY_MAX_SESSIONS sesiones en memoria."""
+
+    def __init__(self, max_sessions: int = MEMORY_MAX_SESSIONS,
+                 summarizer: Callable[[str, list[tuple[str, str]]], str] | None = None):
+        self.max_sessions = max_sessions
+        self.summarizer = summarizer
+        self._sessions: OrderedDict[str, ConversationMemory] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str | None) -> ConversationMemory:
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None:
+                memory = ConversationMemory(self.summarizer)
+                self._sessions[session_id] = memory
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return memory
+
+    def reset(self, session_id: str | None = None) -> None:
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
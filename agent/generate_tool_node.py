@@ -1,11 +1,17 @@
-import os,sys
+import os
 import re
-from langchain_core.tools import tool 
+import time
+from langchain_core.tools import tool, BaseTool 
 from dotenv import load_dotenv
 from typing import TypedDict
 from inspect import signature
 import ldap3
-from langchain_google_genai import ChatGoogleGenerativeAI 
+from ldap_backend import open_connection
+from llm_client import get_llm_client
+from tool_validation import validate_tool
+from profiling import profile_span
+import filter_builder
+from filter_builder import eq, presence, prefix, and_, or_, not_, escape_filter_value
 
 import logging
 
@@ -15,13 +21,55 @@ logger = logging.getLogger(__name__)
 
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    logger.critical("GOOGLE_API_KEY no está configurada en el archivo .env en generate_tool_node.py")
-    sys.exit(1)
+model = get_llm_client()
 
 
-model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite", google_api_key=GOOGLE_API_KEY, temperature=0)
+# Filtros armados a mano en el código generado: f-strings, '%', .format() o concatenación
+# de un texto que empieza con '(' y contiene '='. Deben construirse con filter_builder.
+UNSAFE_FILTER_PATTERNS = [
+    re.compile(r"""\bf(['"]{1,3})\([^'"\n]*(=[^'"\n]*\{|\{[^'"\n]*=)"""),
+    re.compile(r"""(['"])\([^'"\n]*=[^'"\n]*\1\s*(%|\+|\.format\()"""),
+]
+
+
+def find_unsafe_filter(code: str) -> str | None:
+    """Devuelve la primera construcción de filtro insegura encontrada en el código, o None."""
+    for pattern in UNSAFE_FILTER_PATTERNS:
+        match = pattern.search(code)
+        if match:
+            return match.group(0)
+    return None
+
+
+# Reintentos de generación por consulta y memoria de fallos: un nombre de herramienta que no
+# se pudo generar no se vuelve a intentar durante GENERATION_FAILURE_TTL segundos.
+GENERATION_MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", "2"))
+GENERATION_FAILURE_TTL = float(os.getenv("GENERATION_FAILURE_TTL", "3600"))
+_failed_generations: dict[str, tuple[float, str]] = {}
+
+
+class GeneratedToolError(Exception):
+    """El código generado no define una herramienta válida o no cumple las reglas."""
+
+
+def record_generation_failure(tool_name: str, error: str | None) -> None:
+    _failed_generations[tool_name] = (time.monotonic() + GENERATION_FAILURE_TTL, error or "error desconocido")
+
+
+def recent_generation_failure(tool_name: str) -> str | None:
+    """Devuelve el error del último intento fallido de generar 'tool_name', si todavía está vigente."""
+    entry = _failed_generations.get(tool_name)
+    if entry is None:
+        return None
+    expires_at, error = entry
+    if expires_at < time.monotonic():
+        del _failed_generations[tool_name]
+        return None
+    return error
+
+
+def forget_generation_failures() -> None:
+    _failed_generations.clear()
 
 
 class AgentState(TypedDict, total=False):
@@ -29,15 +77,14 @@ class AgentState(TypedDict, total=False):
     tool_name: str
     tool_arg: str
     tool_generated: bool
+    tool_result_ready: bool
     result: str
     new_generated_tool: tool
     generated_tool_code: str
+    generated_tool_profile: dict
 
-def generate_tool_node(state: AgentState) -> AgentState:
-    user_input = state.get("user_input", "")
-    tool_name = state.get("tool_name", "")
-    tool_arg = state.get("tool_arg", "")
 
+def build_generation_prompt(user_input: str, tool_name: str, previous_error: str | None = None) -> str:
     prompt = f"""
     Generá una función en Python decorada con @tool de langchain_core.tools
     para consultar un servidor LDAP y responder la siguiente necesidad del usuario:
@@ -46,14 +93,12 @@ def generate_tool_node(state: AgentState) -> AgentState:
 
     Condiciones:
     - La función debe incluir `import os`, `from dotenv import load_dotenv`, y `load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '.env')))` al principio para cargar las variables de entorno correctamente desde la raíz del proyecto.
-    - Debe usar ldap3 (ej: ldap3.Server, ldap3.Connection) para conectarse a un servidor LDAP.
-    - Debe obtener credenciales y bases DN desde variables de entorno específicas:
-        - `LDAP_HOST` para el host del servidor.
-        - `LDAP_BIND_DN` para el usuario de enlace (bind user).
-        - `LDAP_BIND_PASSWORD` para la contraseña del usuario de enlace.
+    - Para conectarse debe usar `conn = open_connection()` (ya disponible, no la importes ni la definas): devuelve una conexión ya vinculada contra el backend configurado (servidor LDAP o LDIF local) con la misma interfaz que ldap3.Connection (`conn.search`, `conn.entries`, `conn.bound`, `conn.unbind()`). No construyas `ldap3.Server` ni `ldap3.Connection` directamente.
+    - Debe obtener las bases DN desde variables de entorno específicas:
         - `LDAP_USERS_BASE_DN` para la base DN de usuarios (si busca usuarios).
         - `LDAP_GROUPS_BASE_DN` para la base DN de grupos (si busca grupos).
     - No uses `LDAP_SERVER`, `LDAP_USER`, `LDAP_PASSWORD`, `LDAP_BASE_DN`. Usa los nombres que te he especificado.
+    - Los filtros LDAP deben construirse EXCLUSIVAMENTE con las funciones ya disponibles `eq(attr, valor)`, `presence(attr)`, `prefix(attr, valor)`, `and_(...)`, `or_(...)` y `not_(...)` (ej. `search_filter=and_(eq('objectClass', 'inetOrgPerson'), eq('uid', uid))`). Nunca armes filtros con f-strings, `%`, `.format()` ni concatenación: el código que lo haga será rechazado.
     - La función debe llamarse: {tool_name}
     - Si la herramienta necesita un argumento (por ejemplo, un uid para buscar), la función debe aceptarlo como su **único parámetro** con un nombre apropiado (ej: `uid: str`). Si no necesita argumentos, la función no debe tener parámetros.
     - No incluir explicaciones, texto adicional, o comentarios externos al código de la función.
@@ -64,76 +109,103 @@ def generate_tool_node(state: AgentState) -> AgentState:
 
     Solo devolvé el código de la función, incluyendo cualquier importación necesaria **dentro de la función** si aplica (ej. `from dotenv import load_dotenv`).
     """
-
-    code = "" 
-    try:
-        response = model.invoke(prompt)
-        code_with_markdown = response.content.strip()
-
-        code_match = re.search(r"```python\s*\n(.*?)```", code_with_markdown, re.DOTALL)
-
-        if code_match:
-            code = code_match.group(1).strip()
-        else:
-            code = code_with_markdown 
-        
-
-
-        exec_globals = {
-            "os": os,
-            "tool": tool, 
-            "ldap3": ldap3,
-            "Server": ldap3.Server,
-            "Connection": ldap3.Connection,
-            "ALL_ATTRIBUTES": ldap3.ALL_ATTRIBUTES, 
-            "SUBTREE": ldap3.SUBTREE,
-            "load_dotenv": load_dotenv,
-            "ldap3_exceptions": ldap3.core.exceptions, 
-            "__file__": os.path.join(os.path.dirname(__file__), 'temp_tool.py') 
-        }
-        local_vars = {}
+    if previous_error:
+        prompt += f"""
+    El intento anterior de generar esta herramienta falló con el siguiente error. Corrige el código:
+    {previous_error}
+    """
+    return prompt
+
+
+def _extract_code(response_text: str) -> str:
+    code_with_markdown = response_text.strip()
+    code_match = re.search(r"```python\s*\n(.*?)```", code_with_markdown, re.DOTALL)
+    if code_match:
+        return code_match.group(1).strip()
+    return code_with_markdown
+
+
+def compile_generated_tool(code: str):
+    """Valida y ejecuta el código generado. Devuelve la herramienta definida o lanza GeneratedToolError."""
+    unsafe_filter = find_unsafe_filter(code)
+    if unsafe_filter:
+        raise GeneratedToolError(f"la herramienta generada arma filtros LDAP sin escapar ({unsafe_filter}...). Debe usar filter_builder.")
+
+    exec_globals = {
+        "os": os,
+        "tool": tool, 
+        "ldap3": ldap3,
+        "Server": ldap3.Server,
+        "Connection": ldap3.Connection,
+        "ALL_ATTRIBUTES": ldap3.ALL_ATTRIBUTES, 
+        "SUBTREE": ldap3.SUBTREE,
+        "load_dotenv": load_dotenv,
+        "open_connection": open_connection,
+        "filter_builder": filter_builder,
+        "eq": eq,
+        "presence": presence,
+        "prefix": prefix,
+        "and_": and_,
+        "or_": or_,
+        "not_": not_,
+        "escape_filter_value": escape_filter_value,
+        "ldap3_exceptions": ldap3.core.exceptions, 
+        "__file__": os.path.join(os.path.dirname(__file__), 'temp_tool.py') 
+    }
+    local_vars = {}
+    with profile_span("exec:generated_tool"):
         exec(code, exec_globals, local_vars)
 
-        tool_fn = None
-        for val in local_vars.values():
-            if callable(val) and hasattr(val, 'name') and hasattr(val, 'description'):
-                tool_fn = val
-                break
-        
-        if tool_fn is None:
-            state["result"] = "❌ Error: no se pudo detectar una función válida en el código generado."
-            logger.error(f"Código generado que no produjo una herramienta válida:\n{code}")
-            state["tool_generated"] = False 
-            state["new_generated_tool"] = None
-            state["generated_tool_code"] = code 
-            return state
+    for val in local_vars.values():
+        # BaseTool dejó de ser callable en langchain-core 1.x: se detecta por tipo.
+        if isinstance(val, BaseTool) or (callable(val) and hasattr(val, 'name') and hasattr(val, 'description')):
+            return val
+    raise GeneratedToolError("no se pudo detectar una función válida en el código generado.")
 
-        sig = signature(tool_fn.func) 
-        params = list(sig.parameters.keys())
-
-        execution_result = None
-        test_input_args = {}
-
-        if params: 
-            for param_name in params:
-                test_input_args[param_name] = "testuser" 
-            
-            
-            execution_result = tool_fn.invoke(test_input_args)
-        else: 
-            
-            execution_result = tool_fn.invoke({})
-
-        state["result"] = execution_result
-        state["tool_generated"] = True
-        state["new_generated_tool"] = tool_fn 
-        state["generated_tool_code"] = code 
-        
-
-    except Exception as e:
-        state["result"] = f"❌ Error generando o ejecutando herramienta: {str(e)}"
-        logger.error(f"Error completo en generate_tool_node para '{tool_name}': {e}", exc_info=True)
-        state["tool_generated"] = False 
-        state["new_generated_tool"] = None
-        state["generated_tool_code"] = code 
+
+def generate_tool_node(state: AgentState) -> AgentState:
+    user_input = state.get("user_input", "")
+    tool_name = state.get("tool_name", "")
+    tool_arg = state.get("tool_arg", "")
+    has_real_arg = bool(tool_arg) and str(tool_arg).strip().lower() != "ninguno"
+
+    code = ""
+    last_error = None
+    for attempt in range(1, GENERATION_MAX_ATTEMPTS + 1):
+        try:
+            response = model.invoke(build_generation_prompt(user_input, tool_name, last_error), purpose="generation")
+            code = _extract_code(response.content)
+            tool_fn = compile_generated_tool(code)
+
+            # Se valida en paralelo con uids/grupos reales del directorio y con el argumento que
+            # extrajo el router: ese resultado es la respuesta a la consulta y se reutiliza en
+            # execute_tool sin volver a invocar ni a enrutar.
+            params = list(signature(tool_fn.func).parameters.keys())
+            report = validate_tool(tool_fn, tool_arg if has_real_arg else None)
+            if report.requested is not None:
+                execution_result = report.requested.result
+            else:
+                execution_result = report.runs[0].result if report.runs else None
+            logger.info(f"Herramienta '{tool_name}' validada: {report.profile}")
+
+            state["result"] = execution_result
+            state["tool_result_ready"] = not params or has_real_arg
+            state["tool_generated"] = True
+            state["new_generated_tool"] = tool_fn
+            state["generated_tool_code"] = code
+            state["generated_tool_profile"] = report.profile
+            return state
+        except Exception as e:
+            last_error = str(e)
+            logger.warning(f"Intento {attempt}/{GENERATION_MAX_ATTEMPTS} de generar '{tool_name}' falló: {e}")
+            logger.debug(f"Código generado descartado:\n{code}")
+
+    record_generation_failure(tool_name, last_error)
+    state["result"] = f"❌ Error generando o ejecutando herramienta: {last_error}"
+    logger.error(f"No se pudo generar '{tool_name}' tras {GENERATION_MAX_ATTEMPTS} intentos: {last_error}")
+    state["tool_generated"] = False
+    state["tool_result_ready"] = False
+    state["new_generated_tool"] = None
+    state["generated_tool_code"] = code
+    state["generated_tool_profile"] = None
     return state
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# "off": sin caché; "record": llama al modelo y guarda; "replay": solo respuestas guardadas (sin red);
+# "readwrite": sirve lo guardado y graba lo que falte (ahorro en consultas repetidas en producción).
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off").lower()
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.llm_cache')))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+CACHE_MODES = ("off", "record", "replay", "readwrite")
+
+
+class LLMCacheMiss(LookupError):
+    """En modo replay, el prompt no tiene respuesta grabada."""
+
+
+class LlmCallCache:
+    """
+    Almacén en disco de respuestas del LLM direccionado por contenido: la clave es el hash de
+    modelo + temperatura + prompt (+ esquema y parámetros de la llamada). Cada respuesta se guarda
+    comprimida con zlib en <dir>/<2 primeros hex>/<resto>.z; al superar 'max_bytes' se borran las
+    menos usadas (la lectura actualiza el mtime) hasta quedar en el 90 %.
+    """
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, mode: str = LLM_CACHE_MODE, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"LLM_CACHE_MODE inválido: '{mode}'. Opciones: {', '.join(CACHE_MODES)}.")
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self._size: int | None = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    @property
+    def reads(self) -> bool:
+        return self.mode in ("replay", "readwrite")
+
+    @property
+    def writes(self) -> bool:
+        return self.mode in ("record", "readwrite")
+
+    @staticmethod
+    def key(model_id: str, temperature, prompt, extra: dict | None = None) -> str:
+        material = json.dumps(
+            {"model": model_id, "temperature": temperature, "prompt": str(prompt), "extra": extra or {}},
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key[2:] + ".z")
+
+    def get(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        except (OSError, zlib.error, ValueError) as e:
+            logger.warning(f"Entrada de caché LLM ilegible ({path}): {e}. Se descarta.")
+            self.stats["misses"] += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        path = self._path(key)
+        data = zlib.compress(json.dumps(entry, ensure_ascii=False, default=str).encode("utf-8"), 9)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{threading.get_ident()}.partial"
+        with open(partial_path, "wb") as f:
+            f.write(data)
+        os.replace(partial_path, path)
+        self.stats["writes"] += 1
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".z"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self) -> None:
+        target = int(self.max_bytes * 0.9)
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.stats["evictions"] += 1
+        self._size = size
+        logger.info(f"Caché LLM recortada a {size} bytes.")
+
+
+def entry_from_response(content, parsed=None) -> dict:
+    return {"content": content, "parsed": parsed, "created": time.time()}
@@ -0,0 +1,392 @@
+import os
+import sys
+import copy
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable
+
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage
+
+from local_fallback import local_response
+from llm_cache import LlmCallCache, LLMCacheMiss, entry_from_response
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+# "gemini" (por defecto), "fake" (modelo local con latencia y errores inyectados) o "local" (sin red).
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.0-flash-lite")
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0"))
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "5"))          # solicitudes por segundo
+LLM_BURST = int(os.getenv("LLM_BURST", "10"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "30"))             # segundos por llamada, reintentos incluidos
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "5"))        # 0 desactiva las solicitudes de cobertura
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))
+LLM_COOLDOWN = float(os.getenv("LLM_COOLDOWN", "30"))
+LLM_FAKE_LATENCY = float(os.getenv("LLM_FAKE_LATENCY", "0.05"))
+LLM_FAKE_ERROR_RATE = float(os.getenv("LLM_FAKE_ERROR_RATE", "0"))
+
+# Propósitos de llamada que pueden resolverse sin el modelo remoto.
+LOCAL_FALLBACK_PURPOSES = ("routing", "format", "format_plan", "respond")
+
+_RETRYABLE_MARKERS = ("429", "rate limit", "ratelimit", "quota", "resource_exhausted", "resourceexhausted",
+                      "unavailable", "500", "502", "503", "504", "deadline", "timeout", "timed out",
+                      "temporarily", "connection")
+
+
+class LLMUnavailableError(RuntimeError):
+    """El modelo remoto no respondió a tiempo y no hay alternativa local para este tipo de llamada."""
+
+
+class InjectedLLMError(RuntimeError):
+    """Error simulado por FakeChatModel (se presenta como un 503 reintentable)."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    description = f"{type(error).__name__} {error}".lower()
+    return any(marker in description for marker in _RETRYABLE_MARKERS)
+
+
+class TokenBucket:
+    """Limitador de tasa: 'rate' fichas por segundo con ráfagas de hasta 'capacity'."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Toma una ficha si hay; si no, devuelve los segundos a esperar hasta la próxima."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        return self.rate <= 0 or self._take() == 0.0
+
+    def acquire(self, timeout: float) -> bool:
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            wait_for = self._take()
+            if wait_for == 0.0:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait_for, remaining))
+
+
+class FakeChatModel:
+    """
+    Modelo de pruebas: responde con 'responder(prompt)' tras una latencia configurable y falla
+    con la probabilidad 'error_rate'. Permite ejercitar reintentos, cobertura y fallback sin red.
+    """
+
+    def __init__(self, responder: Callable[[str], str] = local_response, latency: float = LLM_FAKE_LATENCY,
+                 latency_jitter: float = 0.0, error_rate: float = LLM_FAKE_ERROR_RATE,
+                 error_factory: Callable[[], BaseException] | None = None, seed: int | None = None):
+        self.responder = responder
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_factory = error_factory or (lambda: InjectedLLMError("503 servicio no disponible (simulado)"))
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, prompt, **kwargs):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            fail = self.random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise self.error_factory()
+        text = prompt if isinstance(prompt, str) else str(prompt)
+        return AIMessage(content=self.responder(text))
+
+
+class LLMClient:
+    """
+    Capa común de acceso al LLM: limita la tasa (token bucket) y la concurrencia, reintenta errores
+    transitorios con backoff exponencial con jitter, lanza una solicitud de cobertura si la primera
+    tarda más de 'hedge_after' y corta cada llamada al llegar a 'deadline'. Si el modelo remoto
+    falla o está en enfriamiento tras fallos consecutivos, responde con el fallback registrado
+    para el propósito de la llamada ('routing', 'format', ...).
+
+    Con una 'cache' (LlmCallCache) activa, las respuestas grabadas se sirven sin pasar por los
+    límites ni por el modelo, y las respuestas remotas exitosas se graban (nunca las del fallback).
+
+    Las llamadas abandonadas por deadline o cobertura terminan en segundo plano: no se pueden
+    interrumpir, pero su resultado se descarta.
+    """
+
+    def __init__(self, primary, fallbacks: dict[str, Callable[[str], str]] | None = None,
+                 rate: float = LLM_RATE_LIMIT, burst: int = LLM_BURST, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_retries: int = LLM_MAX_RETRIES, deadline: float = LLM_DEADLINE, hedge_after: float = LLM_HEDGE_AFTER,
+                 failure_threshold: int = LLM_FAILURE_THRESHOLD, cooldown: float = LLM_COOLDOWN,
+                 cache: LlmCallCache | None = None, model_id: str = LLM_MODEL, temperature: float = LLM_TEMPERATURE):
+        self.primary = primary
+        self.cache = cache if cache is not None and cache.mode != "off" else None
+        self.model_id = model_id
+        self.temperature = temperature
+        self.fallbacks = dict(fallbacks or {})
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(rate, burst)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency * 2 + 2, thread_name_prefix="llm")
+        self._health = {"consecutive_failures": 0, "open_until": 0.0}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                      "deadline_exceeded": 0, "failures": 0, "fallbacks": 0}
+
+    def __getattr__(self, name):
+        # Atributos del modelo subyacente (p. ej. 'client' y 'model' para la caché de contexto).
+        primary = self.__dict__.get("primary")
+        if primary is None:
+            raise AttributeError(name)
+        return getattr(primary, name)
+
+    def register_fallback(self, purpose: str, handler: Callable[[str], str]) -> None:
+        self.fallbacks[purpose] = handler
+
+    def model_copy(self, update: dict | None = None) -> "LLMClient":
+        """Copia que comparte límites, estadísticas y estado de salud pero usa una copia del modelo."""
+        clone = copy.copy(self)
+        if self.primary is None:
+            return clone
+        clone.primary = self.primary.model_copy(update=update or {})
+        return clone
+
+    def with_structured_output(self, schema, include_raw: bool = False) -> "_StructuredClient":
+        replaying = self.cache is not None and self.cache.mode == "replay"
+        if not replaying and (self.primary is None or not hasattr(self.primary, "with_structured_output")):
+            raise NotImplementedError("El modelo configurado no soporta salida estructurada.")
+        return _StructuredClient(self, schema, include_raw)
+
+    def invoke(self, prompt, purpose: str | None = None, **kwargs):
+        return self._call(lambda target: target.invoke(prompt, **kwargs), prompt, purpose, structured=False,
+                          cache_extra=kwargs)
+
+    # --- Caché de respuestas ---
+
+    def _cache_key(self, prompt, structured: bool, cache_extra: dict | None) -> str:
+        extra = dict(cache_extra or {})
+        extra["structured"] = structured
+        cached_content = getattr(self.primary, "cached_content", None) if self.primary is not None else None
+        if cached_content:
+            extra["cached_content"] = cached_content
+        return self.cache.key(self.model_id, self.temperature, prompt, extra)
+
+    @staticmethod
+    def _from_cache(entry: dict, structured: bool):
+        message = AIMessage(content=entry.get("content", ""))
+        if structured:
+            return {"raw": message, "parsed": entry.get("parsed"), "parsing_error": None}
+        return message
+
+    def _store(self, key: str, result, structured: bool) -> None:
+        try:
+            if structured:
+                if not isinstance(result, dict) or result.get("parsing_error") is not None:
+                    return
+                parsed = result.get("parsed")
+                if hasattr(parsed, "model_dump"):
+                    parsed = parsed.model_dump()
+                self.cache.put(key, entry_from_response(result["raw"].content, parsed))
+            else:
+                self.cache.put(key, entry_from_response(result.content))
+        except (OSError, AttributeError, KeyError, TypeError) as e:
+            logger.warning(f"No se pudo grabar la respuesta en la caché LLM: {e}")
+
+    # --- Núcleo ---
+
+    def _circuit_open(self) -> bool:
+        return self._health["open_until"] > time.monotonic()
+
+    def _record_outcome(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._health["consecutive_failures"] = 0
+                return
+            self.stats["failures"] += 1
+            self._health["consecutive_failures"] += 1
+            if self._health["consecutive_failures"] >= self.failure_threshold:
+                self._health["open_until"] = time.monotonic() + self.cooldown
+                logger.warning(f"LLM remoto con {self._health['consecutive_failures']} fallos seguidos. "
+                               f"Se usa el fallback local durante {self.cooldown:.0f} s.")
+
+    def _call(self, fn: Callable[[Any], Any], prompt, purpose: str | None, structured: bool,
+              cache_extra: dict | None = None):
+        self.stats["calls"] += 1
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt, structured, cache_extra)
+            if self.cache.reads:
+                entry = self.cache.get(cache_key)
+                if entry is not None:
+                    return self._from_cache(entry, structured)
+                if self.cache.mode == "replay":
+                    return self._fallback(prompt, purpose, structured,
+                                          LLMCacheMiss(f"sin respuesta grabada para este prompt ({cache_key[:12]})"))
+
+        if self.primary is None or (self._circuit_open() and purpose in self.fallbacks):
+            return self._fallback(prompt, purpose, structured, None)
+
+        deadline = time.monotonic() + self.deadline
+        last_error: BaseException | None = None
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.bucket.acquire(remaining):
+                last_error = TimeoutError("no hubo capacidad en el limitador de tasa antes del deadline")
+                break
+            try:
+                result = self._attempt(fn, deadline)
+                self._record_outcome(True)
+                if cache_key is not None and self.cache.writes:
+                    self._store(cache_key, result, structured)
+                return result
+            except Exception as e:
+                last_error = e
+                if isinstance(e, TimeoutError) and time.monotonic() >= deadline:
+                    self.stats["deadline_exceeded"] += 1
+                    break
+                if not is_retryable(e) or attempt == self.max_retries:
+                    break
+                self.stats["retries"] += 1
+                backoff = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                logger.warning(f"LLM[{purpose}] intento {attempt + 1} falló ({e}). Reintento en {backoff:.2f} s.")
+                time.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+
+        self._record_outcome(False)
+        return self._fallback(prompt, purpose, structured, last_error)
+
+    def _guarded(self, fn: Callable[[Any], Any], deadline: float):
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError("no hubo un lugar libre de concurrencia antes del deadline")
+        try:
+            self.stats["attempts"] += 1
+            return fn(self.primary)
+        finally:
+            self._slots.release()
+
+    def _attempt(self, fn: Callable[[Any], Any], deadline: float):
+        """Una solicitud, más una de cobertura si la primera tarda; devuelve la primera respuesta exitosa."""
+        pending = {self._executor.submit(self._guarded, fn, deadline)}
+        hedge = None
+        first_error: BaseException | None = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"el LLM no respondió dentro del deadline de {self.deadline:.1f} s")
+            can_hedge = hedge is None and self.hedge_after > 0
+            done, pending = wait(pending, timeout=min(remaining, self.hedge_after) if can_hedge else remaining,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is hedge:
+                        self.stats["hedge_wins"] += 1
+                    return future.result()
+                first_error = first_error or error
+            if not done and can_hedge and self.bucket.try_acquire():
+                self.stats["hedges"] += 1
+                hedge = self._executor.submit(self._guarded, fn, deadline)
+                pending.add(hedge)
+            elif not done and can_hedge:
+                hedge = False  # sin capacidad para cubrir: se espera a la solicitud original
+        raise first_error
+
+    def _fallback(self, prompt, purpose: str | None, structured: bool, error: BaseException | None):
+        handler = self.fallbacks.get(purpose)
+        if handler is None:
+            if error is None:
+                raise LLMUnavailableError(f"No hay modelo disponible para llamadas '{purpose}'.")
+            raise LLMUnavailableError(f"El LLM falló para '{purpose}': {error}") from error
+        self.stats["fallbacks"] += 1
+        if error is not None:
+            logger.warning(f"LLM[{purpose}] sin respuesta remota ({error}). Se usa el fallback local.")
+        message = AIMessage(content=handler(prompt if isinstance(prompt, str) else str(prompt)))
+        if structured:
+            return {"raw": message, "parsed": None, "parsing_error": None}
+        return message
+
+
+class _StructuredClient:
+    """Vista de salida estructurada que pasa por los mismos límites, reintentos y fallback del cliente."""
+
+    def __init__(self, client: LLMClient, schema, include_raw: bool):
+        self.client = client
+        self.schema = schema
+        self.include_raw = include_raw
+
+    def invoke(self, prompt, purpose: str | None = None, **kwargs):
+        return self.client._call(
+            lambda target: target.with_structured_output(self.schema, include_raw=self.include_raw).invoke(prompt, **kwargs),
+            prompt, purpose, structured=self.include_raw,
+            cache_extra={"schema": self.schema, **kwargs},
+        )
+
+
+def create_primary_model(provider: str = LLM_PROVIDER):
+    """Modelo remoto según LLM_PROVIDER. 'local' no usa modelo remoto: todo pasa por el fallback."""
+    if provider == "local":
+        return None
+    if provider == "fake":
+        return FakeChatModel()
+    google_api_key = os.getenv("GOOGLE_API_KEY")
+    if not google_api_key:
+        logger.critical("GOOGLE_API_KEY no está configurada en el archivo .env.")
+        sys.exit(1)
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=LLM_MODEL, google_api_key=google_api_key, temperature=LLM_TEMPERATURE)
+
+
+_shared_client: LLMClient | None = None
+_shared_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """Cliente compartido por todos los módulos del agente (mismos límites de tasa y concurrencia)."""
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            cache = LlmCallCache()
+            # En replay no se contacta al modelo remoto: no hace falta red ni GOOGLE_API_KEY.
+            primary = None if cache.mode == "replay" else create_primary_model()
+            _shared_client = LLMClient(
+                primary,
+                fallbacks={purpose: local_response for purpose in LOCAL_FALLBACK_PURPOSES},
+                cache=cache,
+                model_id=LLM_MODEL if LLM_PROVIDER == "gemini" else LLM_PROVIDER,
+            )
+        return _shared_client
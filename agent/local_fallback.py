@@ -0,0 +1,155 @@
+import re
+import ast
+import json
+import unicodedata
+
+from tool_index import ATTRIBUTE_SYNONYMS
+
+
+# Respuestas deterministas sin LLM para el router, el formateo y la respuesta directa. Se usan
+# cuando el modelo remoto está caído o lento (ver llm_client) y como modelo "local" sin red.
+
+_QUERY_PATTERN = re.compile(r'(?:Consulta del usuario|El usuario preguntó):\s*"(.*?)"', re.DOTALL)
+_UID_PATTERN = re.compile(r"\b([a-z][a-z0-9_-]*\.[a-z0-9_-]+)\b")
+_GROUP_PATTERN = re.compile(r"\b(?:grupo|equipo|group|team)\s+([a-z0-9_.-]+)")
+_SUBJECT_PATTERN = re.compile(r"\b(?:de|del|of|for|para)\s+([a-z0-9_.-]+)\s*\??$")
+
+_STOPWORDS = {"todos", "todas", "los", "las", "usuario", "usuarios", "grupo", "grupos", "actual", "mi", "el", "la", "ese", "esa"}
+_CURRENT_USER_WORDS = ("usuario actual", "mi usuario", "mis ", "whoami", "current user")
+_ALL_ATTRIBUTES_WORDS = ("atributos de", "todos los atributos", "toda la info", "todos los detalles", "all attributes", "detalles de")
+_EXPORT_WORDS = ("export", "volcado", "dump")
+_AUDIT_WORDS = ("auditor", "audit", "reconocimiento", "recon ", "en claro", "plaintext", "hallazgos", "vulnerab")
+_MEMBER_WORDS = ("miembros", "members", "usuarios del", "integrantes", "quienes estan", "quiénes están")
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def extract_user_query(prompt: str) -> str:
+    """Extrae la consulta del usuario del prompt (la última aparición, que es la del sufijo)."""
+    matches = _QUERY_PATTERN.findall(prompt)
+    return matches[-1].strip() if matches else ""
+
+
+def _attributes_in(text: str) -> list[str]:
+    words = re.findall(r"[a-z]+", text)
+    found = []
+    for index, word in enumerate(words):
+        pair = f"{word}_{words[index + 1]}" if index + 1 < len(words) else None
+        attribute = ATTRIBUTE_SYNONYMS.get(pair) or ATTRIBUTE_SYNONYMS.get(word)
+        if attribute and attribute not in found:
+            found.append(attribute)
+    return found
+
+
+def _snake(attribute: str) -> str:
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", attribute).lower()
+
+
+def deterministic_route(user_input: str) -> dict:
+    """Elige herramienta y argumento por palabras clave. Devuelve {'tool', 'arg'} como el router LLM."""
+    text = _normalize(user_input).strip()
+    uid_match = _UID_PATTERN.search(text)
+    uid = uid_match.group(1) if uid_match else None
+    if uid is None:
+        subject = _SUBJECT_PATTERN.search(text)
+        if subject and subject.group(1) not in _STOPWORDS:
+            uid = subject.group(1)
+    group_match = _GROUP_PATTERN.search(text)
+    group = group_match.group(1) if group_match and group_match.group(1) not in _STOPWORDS else None
+    attributes = _attributes_in(text)
+
+    if any(word in text for word in _EXPORT_WORDS):
+        options = [attribute for attribute in attributes if attribute not in ("groups", "member")]
+        if "grupo" in text or "group" in text:
+            options.append("groups")
+        options.extend(fmt for fmt in ("csv", "jsonl", "gzip") if fmt in text)
+        return {"tool": "export_directory_tool", "arg": ",".join(options) or "ninguno"}
+    if any(word in text for word in _AUDIT_WORDS):
+        analyzers = []
+        if "en claro" in text or "plaintext" in text:
+            analyzers.append("plaintext_passwords")
+        if "base64" in text or "secreto" in text or "secret" in text:
+            analyzers.append("encoded_secrets")
+        return {"tool": "audit_directory_tool", "arg": ",".join(analyzers) or "ninguno"}
+    if group and any(word in text for word in _MEMBER_WORDS + ("usuarios",)):
+        return {"tool": "enumerate_group_members_tool", "arg": group}
+    if any(word in text for word in _CURRENT_USER_WORDS):
+        field = next((attribute for attribute in attributes if attribute not in ("groups", "member")), "uid")
+        return {"tool": "get_current_user_info_tool", "arg": field}
+    if "grupos" in text or "groups" in text:
+        if uid and uid != group:
+            return {"tool": "get_user_groups_tool", "arg": uid}
+        if re.search(r"\b(sus|su|his|her|their)\b", text):
+            return {"tool": "get_user_groups_tool", "arg": "ninguno"}
+        return {"tool": "get_group_names_tool", "arg": "ninguno"}
+    if any(word in text for word in _ALL_ATTRIBUTES_WORDS):
+        return {"tool": "get_user_attributes_tool", "arg": uid or "ninguno"}
+    if re.search(r"\b(todos los usuarios|all users|lista de usuarios|usernames)\b", text):
+        return {"tool": "get_all_usernames_tool", "arg": "ninguno"}
+
+    user_attributes = [attribute for attribute in attributes if attribute not in ("groups", "member", "userPassword")]
+    if user_attributes:
+        attribute = user_attributes[0]
+        tool_name = "get_user_email_tool" if attribute == "mail" else f"get_user_{_snake(attribute)}_tool"
+        return {"tool": tool_name, "arg": uid or "ninguno"}
+    return {"tool": "ninguno", "arg": "ninguno"}
+
+
+def _result_block(prompt: str) -> str:
+    match = re.search(r"(?:obtuvo el siguiente resultado|con estos resultados):\s*\n(.*?)\n\s*\n\s*Por favor", prompt, re.DOTALL)
+    return match.group(1).strip() if match else ""
+
+
+def _render(value) -> str:
+    if isinstance(value, dict):
+        if "error" in value:
+            return f"No se pudo obtener la información: {value['error']}"
+        return "\n".join(f"- {key}: {_render_inline(item)}" for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return "No se encontraron resultados."
+        return f"Se encontraron {len(value)} resultados:\n" + "\n".join(f"- {_render_inline(item)}" for item in value)
+    if value in (None, ""):
+        return "No se encontró información."
+    return str(value)
+
+
+def _render_inline(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return str(value)
+
+
+def deterministic_format(prompt: str) -> str:
+    """Formatea el resultado incluido en un prompt de formateo sin usar el LLM."""
+    block = _result_block(prompt)
+    if block.startswith("- Paso"):
+        return "Resultados:\n" + block
+    try:
+        value = ast.literal_eval(block)
+    except (ValueError, SyntaxError):
+        value = block
+    return _render(value)
+
+
+def deterministic_reply(prompt: str) -> str:
+    return ("Soy un asistente para consultas LDAP (usuarios, grupos y sus atributos). "
+            "¿Podrías reformular tu pregunta?")
+
+
+def local_response(prompt: str) -> str:
+    """Responde cualquier prompt del agente de forma determinista según su tipo."""
+    if "Responde únicamente con el JSON indicado" in prompt or '"tool": "<nombre_de_tool>"' in prompt:
+        return json.dumps(deterministic_route(extract_user_query(prompt)), ensure_ascii=False)
+    if "obtuvo el siguiente resultado" in prompt or "con estos resultados" in prompt:
+        return deterministic_format(prompt)
+    if "No se identificó ninguna herramienta" in prompt:
+        return deterministic_reply(prompt)
+    if "Eres el planificador" in prompt:
+        return json.dumps({"steps": []})
+    raise NotImplementedError("El modelo local no puede responder este tipo de prompt (p. ej. generación de código).")
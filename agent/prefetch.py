@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, Hashable
+
+from dotenv import load_dotenv
+
+from single_flight import SingleFlight, normalize_call_key, is_reusable_result
+from tool_index import STATIC_TOOL_SIGNATURES, signature_from_name
+from user_tools import bulk_user_emails, bulk_user_groups, bulk_group_members
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+# Precalentamiento guiado por el historial de consultas: se cuentan los pares (herramienta, argumento)
+# ejecutados y, al arrancar y cada PREFETCH_INTERVAL segundos, los más frecuentes se precargan en el
+# caché de resultados de las herramientas durante PREFETCH_TTL segundos.
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_SKETCH_FILE = os.getenv(
+    "PREFETCH_SKETCH_FILE", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.prefetch_sketch.json'))
+)
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "32"))
+PREFETCH_MIN_COUNT = float(os.getenv("PREFETCH_MIN_COUNT", "2"))
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "300"))
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", "240"))
+# Factor de olvido por ciclo: el ranking sigue a la carga actual y no a la de hace semanas.
+PREFETCH_DECAY = float(os.getenv("PREFETCH_DECAY", "0.9"))
+# Herramientas sin consulta en bloque que se precalientan una a una por ciclo.
+PREFETCH_MAX_INDIVIDUAL = int(os.getenv("PREFETCH_MAX_INDIVIDUAL", "8"))
+# Herramientas estáticas de solo lectura y de una sola entrada que se pueden reinvocar en segundo plano.
+# Las de alcance de dominio (exportación, auditoría, listados completos) nunca se precalientan:
+# escriben archivos o recorren todo el directorio.
+PREFETCH_INDIVIDUAL_TOOLS = {
+    name.strip()
+    for name in os.getenv("PREFETCH_INDIVIDUAL_TOOLS", "get_user_attributes_tool,get_current_user_info_tool").split(",")
+    if name.strip()
+}
+PREFETCH_SKETCH_WIDTH = int(os.getenv("PREFETCH_SKETCH_WIDTH", "2048"))
+PREFETCH_SKETCH_DEPTH = int(os.getenv("PREFETCH_SKETCH_DEPTH", "4"))
+
+# Herramientas cuyo resultado se obtiene para muchos argumentos con una sola búsqueda por lote.
+BULK_LOADERS: dict[str, Callable[[list[str]], dict]] = {
+    "get_user_email_tool": bulk_user_emails,
+    "get_user_groups_tool": bulk_user_groups,
+    "enumerate_group_members_tool": bulk_group_members,
+}
+
+_KEY_SEPARATOR = "\t"
+
+
+def _encode(call_key: tuple) -> str:
+    tool_name, arg = call_key
+    return f"{tool_name}{_KEY_SEPARATOR}{arg if arg is not None else ''}"
+
+
+def _decode(key: str) -> tuple:
+    tool_name, _, arg = key.partition(_KEY_SEPARATOR)
+    return tool_name, arg or None
+
+
+def can_warm_individually(tool_name: str, arg) -> bool:
+    """
+    Las estáticas solo si están en PREFETCH_INDIVIDUAL_TOOLS; las generadas solo si son consultas de
+    un usuario o grupo concreto (con argumento), nunca las de alcance de dominio.
+    """
+    if tool_name in STATIC_TOOL_SIGNATURES:
+        return tool_name in PREFETCH_INDIVIDUAL_TOOLS
+    if tool_name in PREFETCH_INDIVIDUAL_TOOLS:
+        return True
+    return arg is not None and signature_from_name(tool_name).subject in ("user", "group")
+
+
+class FrequencySketch:
+    """
+    Count-min sketch (memoria fija, sobreestima pero nunca subestima) más un top-k de las claves
+    con mayor frecuencia estimada. Los hashes son estables entre procesos para poder persistirlo.
+    Para cada clave del top-k se guarda además el argumento tal como se pidió por última vez, porque
+    la clave está normalizada en minúsculas y no todas las herramientas ignoran mayúsculas.
+    """
+
+    def __init__(self, width: int = PREFETCH_SKETCH_WIDTH, depth: int = PREFETCH_SKETCH_DEPTH, top_k: int = PREFETCH_TOP_K):
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.table = [[0.0] * width for _ in range(depth)]
+        self.top: dict[str, float] = {}
+        self.originals: dict[str, str] = {}
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def _cells(self, key: str) -> list[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8 * self.depth).digest()
+        return [int.from_bytes(digest[row * 8:(row + 1) * 8], "little") % self.width for row in range(self.depth)]
+
+    def add(self, key: str, count: float = 1.0, original: str | None = None) -> float:
+        cells = self._cells(key)
+        with self._lock:
+            for row, cell in enumerate(cells):
+                self.table[row][cell] += count
+            estimate = min(self.table[row][cell] for row, cell in enumerate(cells))
+            self.total += count
+            if key in self.top or len(self.top) < self.top_k:
+                self.top[key] = estimate
+            else:
+                coldest = min(self.top, key=self.top.get)
+                if estimate > self.top[coldest]:
+                    del self.top[coldest]
+                    self.originals.pop(coldest, None)
+                    self.top[key] = estimate
+            if original is not None and key in self.top:
+                self.originals[key] = original
+            return estimate
+
+    def original(self, key: str) -> str | None:
+        with self._lock:
+            return self.originals.get(key)
+
+    def estimate(self, key: str) -> float:
+        cells = self._cells(key)
+        with self._lock:
+            return min(self.table[row][cell] for row, cell in enumerate(cells))
+
+    def hottest(self, limit: int | None = None, min_count: float = 0.0) -> list[tuple[str, float]]:
+        with self._lock:
+            ranked = sorted(self.top.items(), key=lambda item: (-item[1], item[0]))
+        return [(key, count) for key, count in ranked if count >= min_count][:limit]
+
+    def decay(self, factor: float = PREFETCH_DECAY) -> None:
+        with self._lock:
+            self.table = [[count * factor for count in row] for row in self.table]
+            self.top = {key: count * factor for key, count in self.top.items() if count * factor >= 0.5}
+            self.originals = {key: arg for key, arg in self.originals.items() if key in self.top}
+            self.total *= factor
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "width": self.width, "depth": self.depth, "top_k": self.top_k, "total": self.total,
+                "table": [[round(count, 3) for count in row] for row in self.table], "top": dict(self.top),
+                "originals": dict(self.originals),
+            }
+
+    def save(self, path: str = PREFETCH_SKETCH_FILE) -> None:
+        partial_path = f"{path}.partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path: str = PREFETCH_SKETCH_FILE, width: int = PREFETCH_SKETCH_WIDTH,
+             depth: int = PREFETCH_SKETCH_DEPTH, top_k: int = PREFETCH_TOP_K) -> "FrequencySketch":
+        sketch = cls(width, depth, top_k)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return sketch
+        except (OSError, ValueError) as e:
+            logger.warning(f"No se pudo leer el historial de consultas de {path}: {e}. Se empieza de cero.")
+            return sketch
+        if data.get("width") != width or data.get("depth") != depth:
+            logger.warning("El historial de consultas guardado tiene otras dimensiones. Se empieza de cero.")
+            return sketch
+        sketch.table = [[float(count) for count in row] for row in data["table"]]
+        sketch.total = float(data.get("total", 0))
+        sketch.top = dict(sorted(data.get("top", {}).items(), key=lambda item: -item[1])[:top_k])
+        sketch.originals = {key: arg for key, arg in data.get("originals", {}).items() if key in sketch.top}
+        return sketch
+
+
+class Prefetcher:
+    """
+    Registra las invocaciones de herramientas en un FrequencySketch persistido y precalienta en
+    segundo plano los resultados más pedidos en el SingleFlight de las herramientas. 'build_call'
+    devuelve (clave, función) para invocar una herramienta sin pasar por la coalescencia.
+    """
+
+    def __init__(self, flight: SingleFlight, build_call: Callable[[str, object], tuple[Hashable, Callable[[], object]]],
+                 sketch_path: str = PREFETCH_SKETCH_FILE, ttl: float = PREFETCH_TTL, interval: float = PREFETCH_INTERVAL):
+        self.flight = flight
+        self.build_call = build_call
+        self.sketch_path = sketch_path
+        self.ttl = ttl
+        self.interval = interval
+        self.sketch = FrequencySketch.load(sketch_path)
+        self.stats = {"recorded": 0, "cycles": 0, "warmed": 0, "bulk_searches": 0, "individual_calls": 0, "failures": 0}
+        self.last_cycle_ms = 0.0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def record(self, call_key: tuple, tool_arg=None) -> None:
+        """Cuenta la invocación; 'tool_arg' es el argumento original, con el que se reinvoca al precalentar."""
+        original = str(tool_arg).strip() if call_key[1] is not None and tool_arg is not None else None
+        self.sketch.add(_encode(call_key), original=original)
+        self.stats["recorded"] += 1
+
+    def hot_calls(self, limit: int = PREFETCH_TOP_K) -> list[tuple[tuple, float]]:
+        """Pares (herramienta, argumento original) más frecuentes con su frecuencia estimada."""
+        hot = []
+        for key, count in self.sketch.hottest(limit, PREFETCH_MIN_COUNT):
+            tool_name, arg = _decode(key)
+            hot.append(((tool_name, self.sketch.original(key) or arg), count))
+        return hot
+
+    def _warm(self, call_key: tuple, value) -> bool:
+        if not is_reusable_result(value):
+            return False
+        self.flight.warm(call_key, value, self.ttl)
+        self.stats["warmed"] += 1
+        return True
+
+    def warm_once(self) -> int:
+        """Precalienta los pares más frecuentes. Devuelve cuántas entradas quedaron cargadas."""
+        start = time.perf_counter()
+        by_tool: dict[str, list[str]] = defaultdict(list)
+        individual = []
+        for (tool_name, arg), _ in self.hot_calls():
+            if tool_name in BULK_LOADERS and arg is not None:
+                by_tool[tool_name].append(arg)
+            elif len(individual) < PREFETCH_MAX_INDIVIDUAL and can_warm_individually(tool_name, arg):
+                individual.append((tool_name, arg))
+
+        warmed = 0
+        for tool_name, args in by_tool.items():
+            try:
+                results = BULK_LOADERS[tool_name](args)
+                self.stats["bulk_searches"] += 1
+            except Exception as e:
+                logger.warning(f"Falló el precalentamiento en bloque de '{tool_name}': {e}")
+                self.stats["failures"] += 1
+                continue
+            for arg in args:
+                call_key = normalize_call_key(tool_name, arg)
+                if call_key[1] in results:
+                    warmed += self._warm(call_key, results[call_key[1]])
+
+        for tool_name, arg in individual:
+            try:
+                call_key, run = self.build_call(tool_name, arg)
+                value = run()
+                self.stats["individual_calls"] += 1
+            except KeyError:
+                continue   # la herramienta ya no está registrada
+            except Exception as e:
+                logger.warning(f"Falló el precalentamiento de '{tool_name}' con '{arg}': {e}")
+                self.stats["failures"] += 1
+                continue
+            warmed += self._warm(call_key, value)
+
+        self.stats["cycles"] += 1
+        self.last_cycle_ms = (time.perf_counter() - start) * 1000
+        if warmed:
+            logger.info(f"Precalentadas {warmed} entradas en {self.last_cycle_ms:.0f} ms.")
+        return warmed
+
+    def save(self) -> None:
+        try:
+            self.sketch.save(self.sketch_path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar el historial de consultas en {self.sketch_path}: {e}")
+
+    def _loop(self) -> None:
+        self.warm_once()
+        while not self._stop.wait(self.interval):
+            self.sketch.decay()
+            self.warm_once()
+            self.save()
+
+    def start(self) -> None:
+        """Precalienta al arrancar y luego cada 'interval' segundos, en un hilo en segundo plano."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="prefetch", daemon=True)
+        self._thread.start()
+        atexit.register(self.save)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+
+    def report(self) -> dict:
+        calls = self.flight.calls()
+        warm_hits = self.flight.stats["warm_hits"]
+        return {
+            **self.stats,
+            "warm_hits": warm_hits,
+            "tool_calls": calls,
+            "hit_rate": round(warm_hits / calls, 3) if calls else 0.0,
+            "last_cycle_ms": round(self.last_cycle_ms, 1),
+            "tracked": len(self.sketch.top),
+        }
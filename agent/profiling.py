@@ -0,0 +1,306 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import contextvars
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from functools import wraps
+
+from dotenv import load_dotenv
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+# Perfilado por consulta: se activa con "profile": True en la entrada del grafo, por sesión
+# (enable_session_profiling) o para una fracción aleatoria de las consultas (PROFILE_SAMPLE_RATE).
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# "sampling": muestreo de pilas cada PROFILE_SAMPLE_INTERVAL_MS (bajo costo, genera .collapsed para
+# flamegraphs); "cprofile": traza determinista por función (genera .pstats, más costosa).
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling").lower()
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profiles')))
+PROFILE_MAX_DEPTH = int(os.getenv("PROFILE_MAX_DEPTH", "96"))
+
+PROFILE_MODES = ("sampling", "cprofile")
+
+_profiled_sessions: set[str] = set()
+# Perfil de la consulta en curso. Es una variable de contexto y no un global, para que las consultas
+# concurrentes (y el precalentamiento en segundo plano) no se mezclen en un perfil ajeno. Los hilos
+# de trabajo la heredan solo si se les copia el contexto (ver submit_in_context).
+_current: contextvars.ContextVar["RequestProfile | None"] = contextvars.ContextVar("request_profile", default=None)
+
+
+def enable_session_profiling(session_id: str, enabled: bool = True) -> None:
+    """Perfila (o deja de perfilar) todas las consultas de una sesión."""
+    if enabled:
+        _profiled_sessions.add(session_id)
+    else:
+        _profiled_sessions.discard(session_id)
+
+
+def session_profiling_enabled(session_id: str) -> bool:
+    return session_id in _profiled_sessions
+
+
+def should_profile(inputs: dict) -> bool:
+    if inputs.get("profile"):
+        return True
+    if inputs.get("session_id") in _profiled_sessions:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _slug(text: str, limit: int = 40) -> str:
+    return re.sub(r"[^a-zA-Z0-9]+", "-", text or "").strip("-").lower()[:limit] or "consulta"
+
+
+class RequestProfile:
+    """
+    Perfil de una consulta. Los nodos del grafo y las herramientas abren 'spans' en el hilo en que
+    corren; solo se miden los hilos con un span abierto, así que los nodos, las herramientas y los
+    pasos paralelos del planificador quedan cubiertos, pero no los hilos ociosos del proceso.
+    """
+
+    def __init__(self, query: str, session_id: str | None = None, mode: str = PROFILE_MODE,
+                 interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"PROFILE_MODE inválido: '{mode}'. Opciones: {', '.join(PROFILE_MODES)}.")
+        self.query = query
+        self.session_id = session_id
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.tool_name: str | None = None
+        self.started = time.time()
+        self.duration_ms = 0.0
+        self.samples: Counter = Counter()
+        self.span_ms: dict[str, float] = defaultdict(float)
+        self._spans: dict[int, list[str]] = {}
+        self._profiles: dict[int, cProfile.Profile] = {}
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._start_clock = time.perf_counter()
+        if self.mode == "sampling":
+            self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        self.duration_ms = (time.perf_counter() - self._start_clock) * 1000
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, spans in list(self._spans.items()):
+                frame = frames.get(thread_id)
+                if not spans or frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                self.samples[";".join(list(spans) + stack[::-1])] += 1
+
+    def span(self, name: str):
+        return _Span(self, name)
+
+    def _enter(self, name: str) -> None:
+        thread_id = threading.get_ident()
+        spans = self._spans.setdefault(thread_id, [])
+        if not spans and self.mode == "cprofile":
+            profile = self._profiles.setdefault(thread_id, cProfile.Profile())
+            profile.enable()
+        spans.append(name)
+
+    def _exit(self, name: str, elapsed_ms: float) -> None:
+        thread_id = threading.get_ident()
+        spans = self._spans.get(thread_id, [])
+        if spans:
+            spans.pop()
+        if not spans and self.mode == "cprofile" and thread_id in self._profiles:
+            self._profiles[thread_id].disable()
+        self.span_ms[name] += elapsed_ms
+
+    def write(self, directory: str = PROFILE_DIR) -> str | None:
+        """Escribe el perfil (.collapsed o .pstats) y sus metadatos (.json). Devuelve la ruta base."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        base = os.path.join(directory, f"{stamp}-{os.getpid()}-{_slug(self.query)}-{_slug(self.tool_name or 'sin-herramienta')}")
+        if self.mode == "sampling":
+            with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        else:
+            stats = None
+            for profile in self._profiles.values():
+                try:
+                    stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+                except TypeError:
+                    continue
+            if stats is None:
+                logger.warning("El perfil de la consulta no registró ninguna llamada. No se escribe.")
+                return None
+            stats.dump_stats(f"{base}.pstats")
+        meta = {
+            "query": self.query,
+            "tool": self.tool_name,
+            "session_id": self.session_id,
+            "mode": self.mode,
+            "started": self.started,
+            "duration_ms": round(self.duration_ms, 1),
+            "samples": sum(self.samples.values()),
+            "spans_ms": {name: round(ms, 1) for name, ms in sorted(self.span_ms.items())},
+        }
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        return base
+
+
+class _Span:
+    __slots__ = ("profile", "name", "_start")
+
+    def __init__(self, profile: RequestProfile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self.profile._enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profile._exit(self.name, (time.perf_counter() - self._start) * 1000)
+        return False
+
+
+def profile_span(name: str):
+    """Marca un tramo (nodo, herramienta, recarga...) del perfil activo; sin perfil no hace nada."""
+    profile = _current.get()
+    return profile.span(name) if profile is not None else nullcontext()
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit que ejecuta 'fn' con el contexto actual, para que sus tramos vayan al perfil de la consulta."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def profiled_node(name: str, node_fn):
+    """Envuelve un nodo del grafo para que su tiempo quede atribuido a 'node:<name>'."""
+    @wraps(node_fn)
+    def wrapper(state):
+        with profile_span(f"node:{name}"):
+            return node_fn(state)
+    return wrapper
+
+
+class ProfiledApp:
+    """
+    Envoltorio del grafo compilado: decide en cada invoke si la consulta se perfila y, si es así,
+    escribe el perfil etiquetado con la consulta y la herramienta elegida.
+    """
+
+    def __init__(self, app, directory: str | None = None):
+        self._app = app
+        self.directory = directory
+
+    def __getattr__(self, name):
+        return getattr(self._app, name)
+
+    def invoke(self, inputs: dict, *args, **kwargs):
+        if not should_profile(inputs) or _current.get() is not None:
+            return self._app.invoke(inputs, *args, **kwargs)
+        profile = RequestProfile(inputs.get("user_input", ""), inputs.get("session_id"))
+        token = _current.set(profile)
+        profile.start()
+        state = None
+        try:
+            state = self._app.invoke(inputs, *args, **kwargs)
+            return state
+        finally:
+            profile.stop()
+            _current.reset(token)
+            if isinstance(state, dict):
+                profile.tool_name = state.get("tool_name")
+            try:
+                base = profile.write(self.directory or PROFILE_DIR)
+                if base:
+                    logger.warning(f"🔬 Perfil de la consulta escrito en {base}.*")
+            except OSError as e:
+                logger.error(f"No se pudo escribir el perfil de la consulta: {e}")
+
+
+def load_profiles(directory: str = PROFILE_DIR, tool: str | None = None) -> list[tuple[str, dict]]:
+    """(ruta base, metadatos) de los perfiles guardados, opcionalmente solo los de una herramienta."""
+    captured = []
+    if not os.path.isdir(directory):
+        return captured
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Metadatos de perfil ilegibles ({path}): {e}")
+            continue
+        if tool and meta.get("tool") != tool:
+            continue
+        captured.append((path[:-len(".json")], meta))
+    return captured
+
+
+def aggregate_profiles(directory: str = PROFILE_DIR, tool: str | None = None, top: int = 15) -> dict:
+    """
+    Combina los perfiles capturados: tiempo total por span, funciones con más muestras propias e
+    inclusivas (modo sampling), pilas combinadas para un flamegraph y estadísticas pstats sumadas.
+    """
+    captured = load_profiles(directory, tool)
+    span_ms: Counter = Counter()
+    merged: Counter = Counter()
+    self_samples: Counter = Counter()
+    inclusive_samples: Counter = Counter()
+    stats = None
+    for base, meta in captured:
+        span_ms.update(meta.get("spans_ms", {}))
+        if os.path.exists(f"{base}.collapsed"):
+            with open(f"{base}.collapsed", encoding="utf-8") as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    if not stack or not count.isdigit():
+                        continue
+                    frames = stack.split(";")
+                    merged[stack] += int(count)
+                    self_samples[frames[-1]] += int(count)
+                    for frame in set(frames):
+                        inclusive_samples[frame] += int(count)
+        if os.path.exists(f"{base}.pstats"):
+            stats = pstats.Stats(f"{base}.pstats") if stats is None else stats.add(f"{base}.pstats")
+    return {
+        "requests": len(captured),
+        "total_ms": round(sum(meta.get("duration_ms", 0) for _, meta in captured), 1),
+        "spans_ms": span_ms.most_common(),
+        "self": self_samples.most_common(top),
+        "inclusive": [(frame, count) for frame, count in inclusive_samples.most_common()
+                      if " (" in frame][:top],
+        "samples": sum(merged.values()),
+        "collapsed": merged,
+        "stats": stats,
+    }
@@ -0,0 +1,216 @@
+import os
+import re
+import time
+import hashlib
+import logging
+from collections import deque
+from typing import Callable, NamedTuple
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Presupuesto total del prompt de enrutamiento (prefijo estable + consulta) en tokens estimados.
+ROUTING_PROMPT_TOKEN_BUDGET = int(os.getenv("ROUTING_PROMPT_TOKEN_BUDGET", "3500"))
+# Tokens reservados para el sufijo variable (la consulta del usuario).
+ROUTING_QUERY_TOKEN_RESERVE = int(os.getenv("ROUTING_QUERY_TOKEN_RESERVE", "256"))
+# Ejemplos que se conservan antes de empezar a recortar descripciones de herramientas.
+ROUTING_MIN_EXAMPLES = int(os.getenv("ROUTING_MIN_EXAMPLES", "3"))
+ROUTING_MIN_DESCRIPTION_CHARS = int(os.getenv("ROUTING_MIN_DESCRIPTION_CHARS", "80"))
+# Caché de contexto del proveedor (Gemini): el prefijo se sube una vez y las llamadas solo envían la consulta.
+ROUTING_CONTEXT_CACHE = os.getenv("ROUTING_CONTEXT_CACHE", "0") == "1"
+ROUTING_CONTEXT_CACHE_TTL = int(os.getenv("ROUTING_CONTEXT_CACHE_TTL", "3600"))
+
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cuenta tokens localmente: cada palabra vale ~1 token cada 4 caracteres y cada signo, 1 token."""
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PIECES.findall(text))
+
+
+def shorten_description(text: str, max_chars: int | None) -> str:
+    """Recorta una descripción a su primera oración o, si sigue siendo larga, a 'max_chars' caracteres."""
+    text = " ".join(str(text).split())
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    first_sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    if len(first_sentence) <= max_chars:
+        return first_sentence
+    return text[:max_chars - 1].rstrip() + "…"
+
+
+class PromptPrefix(NamedTuple):
+    text: str
+    tokens: int
+    examples: int                     # ejemplos incluidos
+    description_chars: int | None     # None: descripciones completas
+    fingerprint: tuple
+
+
+class RoutingPrompt:
+    """
+    Prompt de enrutamiento dividido en un prefijo estable (instrucciones, catálogo y ejemplos) y
+    un sufijo variable (la consulta). El prefijo se reconstruye solo cuando cambia el catálogo de
+    herramientas y se ajusta al presupuesto de tokens quitando ejemplos y acortando descripciones.
+    Mantener el prefijo idéntico entre llamadas también permite el cacheo implícito del proveedor.
+    """
+
+    # Escalones de recorte de descripciones, del más suave al más agresivo.
+    DESCRIPTION_STEPS = (None, 240, 160, ROUTING_MIN_DESCRIPTION_CHARS)
+
+    def __init__(self, build_prefix: Callable[[int, int | None], str], build_suffix: Callable[[str, str], str],
+                 total_examples: int, budget: int = ROUTING_PROMPT_TOKEN_BUDGET):
+        self.build_prefix = build_prefix
+        self.build_suffix = build_suffix
+        self.total_examples = total_examples
+        self.budget = budget
+        self._prefix: PromptPrefix | None = None
+
+    def _fits(self, tokens: int) -> bool:
+        return tokens + ROUTING_QUERY_TOKEN_RESERVE <= self.budget
+
+    def _candidates(self):
+        min_examples = min(ROUTING_MIN_EXAMPLES, self.total_examples)
+        for examples in range(self.total_examples, min_examples - 1, -1):
+            yield examples, None
+        for description_chars in self.DESCRIPTION_STEPS[1:]:
+            yield min_examples, description_chars
+        for examples in range(min_examples - 1, -1, -1):
+            yield examples, ROUTING_MIN_DESCRIPTION_CHARS
+
+    def prefix(self, fingerprint: tuple) -> PromptPrefix:
+        if self._prefix is not None and self._prefix.fingerprint == fingerprint:
+            return self._prefix
+
+        text = ""
+        tokens = 0
+        examples, description_chars = self.total_examples, None
+        for examples, description_chars in self._candidates():
+            text = self.build_prefix(examples, description_chars)
+            tokens = estimate_tokens(text)
+            if self._fits(tokens):
+                break
+        else:
+            logger.warning(f"El prompt de enrutamiento ({tokens} tokens) excede el presupuesto de {self.budget} aun recortado.")
+
+        if examples < self.total_examples or description_chars is not None:
+            logger.info(f"Prompt de enrutamiento recortado a {tokens} tokens: {examples}/{self.total_examples} ejemplos, "
+                        f"descripciones de hasta {description_chars or 'todos los'} caracteres.")
+        self._prefix = PromptPrefix(text, tokens, examples, description_chars, fingerprint)
+        return self._prefix
+
+    def suffix(self, user_input: str, context: str = "") -> str:
+        return self.build_suffix(user_input, context)
+
+
+class ProviderContextCache:
+    """
+    Sube el prefijo como contenido cacheado del proveedor (client.caches.create de google-genai)
+    y devuelve su nombre para invocar con 'cached_content'. Si el cliente no lo soporta o el
+    proveedor lo rechaza (p. ej. por debajo del mínimo de tokens cacheables), se desactiva.
+    Con las versiones fijadas (langchain-google-genai 1.0.10 / google-generativeai 0.7.2) el cliente
+    no expone 'caches' ni acepta 'cached_content', así que la caché queda inactiva.
+    """
+
+    def __init__(self, enabled: bool = ROUTING_CONTEXT_CACHE, ttl: int = ROUTING_CONTEXT_CACHE_TTL):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._entries: dict[str, tuple[float, str]] = {}
+
+    def lookup(self, model, prefix_text: str) -> str | None:
+        if not self.enabled:
+            return None
+        digest = hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()
+        entry = self._entries.get(digest)
+        # Se renueva un poco antes de que expire en el proveedor.
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        caches = getattr(getattr(model, "client", None), "caches", None)
+        if caches is None or not hasattr(caches, "create"):
+            logger.warning("ROUTING_CONTEXT_CACHE=1, pero el cliente del modelo no soporta caché de contexto "
+                           "(requiere google-genai). Se desactiva y se envía el prompt completo.")
+            self.enabled = False
+            return None
+        try:
+            cache = caches.create(
+                model=getattr(model, "model", ""),
+                config={"system_instruction": prefix_text, "ttl": f"{self.ttl}s", "display_name": f"routing-{digest[:12]}"},
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo crear la caché de contexto del proveedor: {e}. Se envía el prompt completo.")
+            self.enabled = False
+            return None
+        self._entries = {digest: (time.monotonic() + self.ttl * 0.9, cache.name)}
+        return cache.name
+
+
+class LlmUsageLog:
+    """Uso de tokens y latencia por llamada al LLM, con totales acumulados por etiqueta."""
+
+    def __init__(self, max_records: int = 256):
+        self.records: deque = deque(maxlen=max_records)
+        self.totals: dict[str, dict[str, float]] = {}
+
+    def record(self, label: str, response, latency: float, estimated_prompt_tokens: int, **extra) -> dict:
+        usage = getattr(response, "usage_metadata", None) or {}
+        details = usage.get("input_token_details") or {}
+        entry = {
+            "label": label,
+            "latency_ms": round(latency * 1000, 1),
+            "estimated_prompt_tokens": estimated_prompt_tokens,
+            "input_tokens": usage.get("input_tokens"),
+            "output_tokens": usage.get("output_tokens"),
+            "cached_tokens": details.get("cache_read"),
+            **extra,
+        }
+        self.records.append(entry)
+
+        totals = self.totals.setdefault(label, {"calls": 0, "latency_ms": 0.0, "estimated_prompt_tokens": 0,
+                                                "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0})
+        totals["calls"] += 1
+        for key in ("latency_ms", "estimated_prompt_tokens", "input_tokens", "output_tokens", "cached_tokens"):
+            totals[key] += entry[key] or 0
+        logger.info(f"LLM[{label}] {entry['latency_ms']} ms, prompt≈{estimated_prompt_tokens} tokens, "
+                    f"entrada={entry['input_tokens']}, salida={entry['output_tokens']}, cacheados={entry['cached_tokens']}")
+        return entry
+
+
+usage_log = LlmUsageLog()
+
+
+def invoke_with_usage(model, label: str, prompt: str, **kwargs):
+    """model.invoke(prompt) registrando tokens estimados, uso reportado por el proveedor y latencia."""
+    start = time.perf_counter()
+    response = model.invoke(prompt, purpose=label, **kwargs)
+    usage_log.record(label, response, time.perf_counter() - start, estimate_tokens(prompt))
+    return response
+
+
+def invoke_routing(model, routing_prompt: RoutingPrompt, fingerprint: tuple, user_input: str,
+                   context_cache: ProviderContextCache, context: str = "", schema: dict | None = None):
+    """
+    Invoca el enrutamiento enviando solo el sufijo si el prefijo está cacheado en el proveedor.
+    'context' (historial de la conversación) va en el sufijo para no invalidar el prefijo.
+    Con 'schema' se usa la salida estructurada del modelo. Devuelve (mensaje crudo, decisión parseada o None).
+    """
+    prefix = routing_prompt.prefix(fingerprint)
+    suffix = routing_prompt.suffix(user_input, context)
+    cache_name = context_cache.lookup(model, prefix.text)
+    prompt = suffix if cache_name else prefix.text + suffix
+
+    start = time.perf_counter()
+    parsed = None
+    if schema is not None:
+        target = model.model_copy(update={"cached_content": cache_name}) if cache_name else model
+        result = target.with_structured_output(schema, include_raw=True).invoke(prompt, purpose="routing")
+        response, parsed = result["raw"], result.get("parsed")
+    elif cache_name:
+        response = model.invoke(prompt, purpose="routing", cached_content=cache_name)
+    else:
+        response = model.invoke(prompt, purpose="routing")
+    usage_log.record("routing", response, time.perf_counter() - start, prefix.tokens + estimate_tokens(suffix),
+                     prefix_tokens=prefix.tokens, provider_cache=bool(cache_name), structured=schema is not None)
+    return response, parsed
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, NamedTuple
+
+from profiling import submit_in_context
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+PLAN_MAX_STEPS = int(os.getenv("PLAN_MAX_STEPS", "8"))
+PLAN_MAX_FANOUT = int(os.getenv("PLAN_MAX_FANOUT", "50"))
+PLAN_MAX_WORKERS = int(os.getenv("PLAN_MAX_WORKERS", "8"))
+
+# Nombre de "herramienta" con el que el router indica que la consulta necesita un plan de varios pasos.
+MULTI_STEP_TOOL = "multi_step"
+
+
+class PlanError(ValueError):
+    """Plan inválido devuelto por el LLM."""
+
+
+class PlanStep(NamedTuple):
+    id: str
+    tool: str
+    arg: str | None              # argumento literal (None si se toma de otro paso)
+    source: str | None           # id del paso cuyo resultado alimenta a este
+    foreach: bool                # True: ejecutar una vez por cada elemento del resultado de 'source'
+    transform: str               # transformación aplicada a cada valor de entrada
+
+
+def dn_to_uid(value) -> str:
+    """Extrae el valor del primer RDN de un DN ('cn=john.doe,ou=users,...' -> 'john.doe')."""
+    text = str(value).strip()
+    first_rdn = re.split(r"(?<!\\),", text, maxsplit=1)[0]
+    if "=" not in first_rdn:
+        return text
+    return first_rdn.split("=", 1)[1].strip()
+
+
+TRANSFORMS: dict[str, Callable[[Any], Any]] = {
+    "identity": lambda value: value,
+    "dn_to_uid": dn_to_uid,
+}
+
+
+def build_planner_prompt(user_input: str, tools_description: str, context: str = "") -> str:
+    context_block = f"Contexto de la conversación (para resolver referencias como 'sus' o 'ese grupo'):\n    {context}\n" if context else ""
+    return f"""
+    Eres el planificador de un agente LDAP. Descompón la consulta del usuario en una lista corta de pasos,
+    donde cada paso invoca UNA de las herramientas disponibles y puede usar como entrada el resultado de un paso anterior.
+
+    Herramientas disponibles:
+
+    {tools_description}
+
+    Formato de cada paso:
+    * "id": identificador único corto (ej. "s1").
+    * "tool": nombre EXACTO de una herramienta disponible.
+    * "arg": argumento literal (ej. "developers") o "ninguno" si la herramienta no requiere argumentos. Omitir si se usa "from".
+    * "from": id del paso cuyo resultado es la entrada de este paso (opcional).
+    * "foreach": true si el paso debe ejecutarse una vez por cada elemento de la lista que devuelve "from".
+    * "transform": "dn_to_uid" si la entrada es un DN (ej. "cn=john.doe,ou=users,dc=meli,dc=com") y la herramienta espera un uid; si no, "identity".
+
+    Reglas:
+    * Usa como máximo {PLAN_MAX_STEPS} pasos y solo herramientas de la lista.
+    * Los pasos sin dependencias entre sí se ejecutan en paralelo.
+
+    Ejemplo:
+    * Consulta: "dame los emails de todos los miembros de developers"
+      JSON: {{"steps": [
+        {{"id": "s1", "tool": "enumerate_group_members_tool", "arg": "developers"}},
+        {{"id": "s2", "tool": "get_user_email_tool", "from": "s1", "foreach": true, "transform": "dn_to_uid"}}
+      ]}}
+
+    {context_block}
+    Consulta del usuario: "{user_input}"
+
+    Responde estrictamente en JSON con la forma {{"steps": [...]}}.
+    """
+
+
+def _extract_json(text: str) -> dict:
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end <= start:
+        raise PlanError("La respuesta del planificador no contiene JSON.")
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise PlanError(f"JSON de plan inválido: {e}")
+
+
+def parse_plan(response_text: str, available_tools) -> list[PlanStep]:
+    """Valida el plan del LLM: herramientas conocidas, ids únicos, dependencias existentes y sin ciclos."""
+    raw_steps = _extract_json(response_text).get("steps")
+    if not isinstance(raw_steps, list) or not raw_steps:
+        raise PlanError("El plan no contiene pasos.")
+    if len(raw_steps) > PLAN_MAX_STEPS:
+        raise PlanError(f"El plan tiene {len(raw_steps)} pasos; el máximo es {PLAN_MAX_STEPS}.")
+
+    steps: list[PlanStep] = []
+    seen: set[str] = set()
+    for raw in raw_steps:
+        if not isinstance(raw, dict):
+            raise PlanError(f"Paso inválido: {raw!r}")
+        step_id = str(raw.get("id", "")).strip()
+        tool_name = str(raw.get("tool", "")).strip()
+        source = raw.get("from")
+        source = str(source).strip() if source else None
+        transform = str(raw.get("transform") or "identity").strip()
+        arg = raw.get("arg")
+        arg = None if arg is None or str(arg).strip().lower() in ("", "ninguno") else str(arg).strip()
+
+        if not step_id or step_id in seen:
+            raise PlanError(f"Id de paso vacío o repetido: '{step_id}'.")
+        if tool_name not in available_tools:
+            raise PlanError(f"El paso '{step_id}' usa una herramienta inexistente: '{tool_name}'.")
+        # Solo se admite depender de pasos anteriores: así el plan es un DAG por construcción.
+        if source is not None and source not in seen:
+            raise PlanError(f"El paso '{step_id}' depende de '{source}', que no es un paso anterior.")
+        if transform not in TRANSFORMS:
+            raise PlanError(f"Transformación desconocida en '{step_id}': '{transform}'.")
+
+        seen.add(step_id)
+        steps.append(PlanStep(step_id, tool_name, arg, source, bool(raw.get("foreach")) and source is not None, transform))
+    return steps
+
+
+def _levels(steps: list[PlanStep]) -> list[list[PlanStep]]:
+    """Agrupa los pasos por profundidad en el DAG: cada nivel solo depende de niveles anteriores."""
+    depth: dict[str, int] = {}
+    levels: list[list[PlanStep]] = []
+    for step in steps:
+        level = depth[step.source] + 1 if step.source else 0
+        depth[step.id] = level
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append(step)
+    return levels
+
+
+def _flatten_outputs(step_id: str, wrapped: list[dict]) -> list:
+    """
+    Salidas de un paso 'foreach' como entrada de otro: se descartan los envoltorios {"input", "output"},
+    se expanden las salidas que son listas y se omiten las que fallaron.
+    """
+    items = []
+    failed = 0
+    for entry in wrapped:
+        output = entry["output"]
+        if isinstance(output, dict) and "error" in output:
+            failed += 1
+        elif isinstance(output, list):
+            items.extend(output)
+        else:
+            items.append(output)
+    if failed:
+        if failed == len(wrapped):
+            raise PlanError(f"Todas las invocaciones del paso '{step_id}' fallaron.")
+        logger.warning(f"Se omiten {failed} de {len(wrapped)} resultados fallidos del paso '{step_id}'.")
+    return items
+
+
+def _inputs_for(step: PlanStep, results: dict[str, Any], fanned_out: set[str]) -> list:
+    transform = TRANSFORMS[step.transform]
+    if step.source is None:
+        return [step.arg]
+    upstream = results.get(step.source)
+    if isinstance(upstream, dict) and "error" in upstream:
+        raise PlanError(f"El paso '{step.source}' falló: {upstream['error']}")
+    if step.source in fanned_out:
+        upstream = _flatten_outputs(step.source, upstream)
+    if step.foreach:
+        items = upstream if isinstance(upstream, list) else [upstream]
+        if len(items) > PLAN_MAX_FANOUT:
+            logger.warning(f"El paso '{step.id}' se limita a {PLAN_MAX_FANOUT} de {len(items)} elementos.")
+            items = items[:PLAN_MAX_FANOUT]
+        return [transform(item) for item in items]
+    return [transform(upstream)]
+
+
+def execute_plan(steps: list[PlanStep], invoke_tool: Callable[[str, Any], Any]) -> dict[str, Any]:
+    """
+    Ejecuta el plan nivel por nivel. Los pasos de un mismo nivel y las invocaciones de un
+    'foreach' corren en paralelo. Devuelve id de paso -> resultado ('foreach' devuelve una
+    lista de {"input", "output"} para el formateo final; los pasos que dependen de él reciben solo
+    las salidas, aplanadas).
+    """
+    results: dict[str, Any] = {}
+    fanned_out = {step.id for step in steps if step.foreach}
+    with ThreadPoolExecutor(max_workers=PLAN_MAX_WORKERS) as pool:
+        for level in _levels(steps):
+            pending = {}
+            for step in level:
+                try:
+                    inputs = _inputs_for(step, results, fanned_out)
+                except PlanError as e:
+                    results[step.id] = {"error": str(e)}
+                    continue
+                pending[step.id] = (step, inputs, [submit_in_context(pool, invoke_tool, step.tool, value) for value in inputs])
+
+            for step_id, (step, inputs, futures) in pending.items():
+                outputs = []
+                for future in futures:
+                    try:
+                        outputs.append(future.result())
+                    except Exception as e:
+                        logger.error(f"Error ejecutando el paso '{step_id}' ({step.tool}): {e}", exc_info=True)
+                        outputs.append({"error": str(e)})
+                if step.foreach:
+                    results[step_id] = [{"input": value, "output": output} for value, output in zip(inputs, outputs)]
+                else:
+                    results[step_id] = outputs[0]
+    return results
@@ -0,0 +1,168 @@
+import re
+import ast
+import json
+import logging
+from inspect import signature
+from typing import NamedTuple
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+NO_TOOL = "ninguno"
+# Nombre válido para una herramienta nueva: snake_case.
+TOOL_NAME_PATTERN = re.compile(r"^[a-z][a-z0-9_]{2,80}$")
+
+# Contadores de cómo se obtuvo cada decisión de enrutamiento.
+routing_stats = {"structured": 0, "json": 0, "repaired": 0, "failed": 0, "invalid_tool": 0, "arg_dropped": 0}
+
+
+class RoutingParseError(ValueError):
+    """La salida del router no se pudo convertir en una decisión válida."""
+
+
+class RoutingDecision(NamedTuple):
+    tool: str
+    arg: str
+
+
+def tool_parameters(tool_obj) -> list[str]:
+    func = getattr(tool_obj, 'func', tool_obj)
+    try:
+        return list(signature(func).parameters.keys())
+    except (TypeError, ValueError):
+        return []
+
+
+def routing_schema(tools: dict, special_tools=(NO_TOOL,)) -> dict:
+    """Esquema JSON de la respuesta del router, con las herramientas registradas y sus argumentos."""
+    catalog = "; ".join(
+        f"{name}({', '.join(tool_parameters(tool_obj)) or 'sin argumentos'})" for name, tool_obj in tools.items()
+    )
+    return {
+        "title": "RoutingDecision",
+        "description": "Herramienta elegida para la consulta del usuario y su argumento.",
+        "type": "object",
+        "properties": {
+            "tool": {
+                "type": "string",
+                "description": (
+                    f"Nombre EXACTO de una herramienta registrada ({catalog}), "
+                    f"uno de {', '.join(repr(name) for name in special_tools)}, "
+                    "o un nombre nuevo en snake_case si hay que generar una herramienta."
+                ),
+            },
+            "arg": {
+                "type": "string",
+                "description": "Valor puro del argumento (uid, grupo o campo) o 'ninguno' si no requiere.",
+            },
+        },
+        "required": ["tool", "arg"],
+    }
+
+
+def _first_object(text: str) -> str | None:
+    """Devuelve el primer objeto {...} balanceado del texto (o desde '{' hasta el final si no cierra)."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = None
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == in_string:
+                in_string = None
+        elif char in ("'", '"'):
+            in_string = char
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return text[start:]
+
+
+def repair_json(candidate: str) -> str:
+    """Correcciones locales para JSON casi válido: comillas simples, claves sin comillas, comas sobrantes, llaves sin cerrar."""
+    repaired = candidate.strip().strip("`")
+    repaired = re.sub(r"(?<![\\\w])'([^'\n]*)'", r'"\1"', repaired)
+    repaired = re.sub(r'([{,]\s*)([A-Za-z_]\w*)\s*:', r'\1"\2":', repaired)
+    repaired = re.sub(r",\s*([}\]])", r"\1", repaired)
+    repaired = re.sub(r"\bNone\b", '"ninguno"', repaired)
+    if repaired.count("{") > repaired.count("}"):
+        repaired += "}" * (repaired.count("{") - repaired.count("}"))
+    return repaired
+
+
+def _load_object(text: str) -> tuple[dict, bool]:
+    """Devuelve (objeto, reparado). Intenta JSON estricto, luego reparación local y por último extracción por claves."""
+    candidate = _first_object(text)
+    if candidate is not None:
+        try:
+            return json.loads(candidate), False
+        except json.JSONDecodeError:
+            pass
+        try:
+            return json.loads(repair_json(candidate)), True
+        except json.JSONDecodeError:
+            pass
+        try:
+            value = ast.literal_eval(candidate)
+            if isinstance(value, dict):
+                return value, True
+        except (ValueError, SyntaxError):
+            pass
+
+    fields = {}
+    for key in ("tool", "arg"):
+        match = re.search(rf"""["']?{key}["']?\s*[:=]\s*["']([^"'\n]*)["']""", text)
+        if match:
+            fields[key] = match.group(1)
+    if "tool" in fields:
+        return fields, True
+    raise RoutingParseError(f"La respuesta del router no contiene una decisión reconocible: {text[:200]!r}")
+
+
+def validate_decision(raw: dict, tools: dict, special_tools=(NO_TOOL,)) -> RoutingDecision:
+    """Valida la decisión contra las herramientas registradas y normaliza el argumento."""
+    if not isinstance(raw, dict):
+        raise RoutingParseError(f"Decisión con formato inválido: {raw!r}")
+    tool_name = str(raw.get("tool") or "").strip().strip("`")
+    arg = raw.get("arg")
+    arg = NO_TOOL if arg is None or str(arg).strip() == "" else str(arg).strip().strip("`\"'")
+
+    if tool_name not in tools and tool_name not in special_tools and not TOOL_NAME_PATTERN.match(tool_name):
+        routing_stats["invalid_tool"] += 1
+        raise RoutingParseError(f"Nombre de herramienta inválido: {tool_name!r}")
+
+    if tool_name in tools:
+        params = tool_parameters(tools[tool_name])
+        if not params and arg.lower() != NO_TOOL:
+            routing_stats["arg_dropped"] += 1
+            logger.info(f"'{tool_name}' no recibe argumentos; se descarta '{arg}'.")
+            arg = NO_TOOL
+        elif params and "=" in arg and arg.split("=", 1)[0].strip() == params[0]:
+            arg = arg.split("=", 1)[1].strip()
+    return RoutingDecision(tool_name, arg)
+
+
+def parse_routing_output(response_text: str, tools: dict, special_tools=(NO_TOOL,)) -> RoutingDecision:
+    """Convierte la salida en texto del router en una decisión validada, reparando JSON casi válido."""
+    try:
+        raw, repaired = _load_object(response_text)
+        decision = validate_decision(raw, tools, special_tools)
+    except RoutingParseError:
+        routing_stats["failed"] += 1
+        raise
+    routing_stats["repaired" if repaired else "json"] += 1
+    if repaired:
+        logger.info(f"Salida del router reparada localmente: {response_text[:200]!r}")
+    return decision
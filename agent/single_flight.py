@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+def normalize_call_key(tool_name: str, tool_arg) -> tuple:
+    """Clave de coalescencia: nombre de herramienta + argumento normalizado (sin espacios ni mayúsculas)."""
+    if tool_arg is None or str(tool_arg).strip().lower() in ("", "ninguno"):
+        return (tool_name, None)
+    return (tool_name, str(tool_arg).strip().lower())
+
+
+def is_reusable_result(result) -> bool:
+    """Solo se reutilizan resultados exitosos: los {'error': ...} de las herramientas no se cachean."""
+    return not (isinstance(result, dict) and "error" in result)
+
+
+class SingleFlight:
+    """
+    Coalesce llamadas idénticas concurrentes: la primera ejecuta la operación y las demás
+    esperan y reciben el mismo resultado (o la misma excepción). Opcionalmente conserva
+    el resultado durante 'result_ttl' segundos para reutilizarlo en llamadas posteriores.
+    Funciona desde hilos (do) y desde asyncio (do_async).
+    """
+
+    def __init__(self, result_ttl: float = 0.0, max_cached_results: int = 1024):
+        self.result_ttl = result_ttl
+        self.max_cached_results = max_cached_results
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        self._results: dict[Hashable, tuple[float, Any]] = {}
+        self._async_calls: dict[tuple[int, Hashable], asyncio.Future] = {}
+        self._warm_keys: set[Hashable] = set()
+        self.stats = {"executed": 0, "coalesced": 0, "reused": 0, "warm_hits": 0}
+
+    def _cached(self, key: Hashable):
+        entry = self._results.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._results.pop(key, None)
+            self._warm_keys.discard(key)
+            return False, None
+        if key in self._warm_keys:
+            self.stats["warm_hits"] += 1
+        return True, value
+
+    def _store(self, key: Hashable, value, cacheable: Callable[[Any], bool] | None) -> None:
+        if self.result_ttl <= 0 or (cacheable is not None and not cacheable(value)):
+            return
+        if len(self._results) >= self.max_cached_results:
+            now = time.monotonic()
+            for stale_key in [k for k, (expires_at, _) in self._results.items() if expires_at < now]:
+                del self._results[stale_key]
+            if len(self._results) >= self.max_cached_results:
+                self._results.pop(next(iter(self._results)))
+        self._results[key] = (time.monotonic() + self.result_ttl, value)
+        self._warm_keys.discard(key)
+
+    def warm(self, key: Hashable, value, ttl: float) -> None:
+        """
+        Precarga un resultado obtenido fuera de do() (p. ej. por una búsqueda en bloque) durante
+        'ttl' segundos, aunque result_ttl sea 0. Los aciertos sobre estas entradas se cuentan en
+        stats["warm_hits"].
+        """
+        with self._lock:
+            if ttl <= 0 or key in self._calls:
+                return
+            if len(self._results) >= self.max_cached_results and key not in self._results:
+                self._warm_keys.discard(next(iter(self._results)))
+                self._results.pop(next(iter(self._results)))
+            self._results[key] = (time.monotonic() + ttl, value)
+            self._warm_keys.add(key)
+
+    def calls(self) -> int:
+        """Llamadas atendidas: ejecutadas, coalescidas o servidas desde resultados guardados."""
+        return self.stats["executed"] + self.stats["coalesced"] + self.stats["reused"]
+
+    def do(self, key: Hashable, fn: Callable[[], Any], cacheable: Callable[[Any], bool] | None = None):
+        """Ejecuta fn() una sola vez por clave entre todos los hilos que la pidan a la vez."""
+        with self._lock:
+            hit, value = self._cached(key)
+            if hit:
+                self.stats["reused"] += 1
+                return value
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.stats["executed"] += 1
+            else:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                if call.error is None:
+                    self._store(key, call.result, cacheable)
+                self._calls.pop(key, None)
+            call.event.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any], cacheable: Callable[[Any], bool] | None = None):
+        """
+        Variante asyncio. Las corrutinas del mismo loop comparten un Future; el líder ejecuta
+        fn() en un hilo a través de do(), por lo que también se coalesce con llamadas hechas desde hilos.
+        """
+        loop = asyncio.get_running_loop()
+        async_key = (id(loop), key)
+        with self._lock:
+            hit, value = self._cached(key)
+            if hit:
+                self.stats["reused"] += 1
+                return value
+            future = self._async_calls.get(async_key)
+            leader = future is None
+            if leader:
+                future = loop.create_future()
+                self._async_calls[async_key] = future
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            return await asyncio.shield(future)
+
+        try:
+            result = await asyncio.to_thread(self.do, key, fn, cacheable)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            # El líder relanza; se marca como consultada para no loguear "exception never retrieved".
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                self._async_calls.pop(async_key, None)
+        return result
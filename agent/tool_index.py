@@ -0,0 +1,262 @@
+import re
+import inspect
+from typing import Callable, NamedTuple
+
+from langchain_core.tools import StructuredTool
+
+
+# Palabra (en snake_case del nombre de la herramienta) -> atributo LDAP que representa.
+# Las claves de varias palabras se prueban antes que las de una sola.
+ATTRIBUTE_SYNONYMS = {
+    "phone_number": "telephoneNumber",
+    "telephone_number": "telephoneNumber",
+    "home_directory": "homeDirectory",
+    "login_shell": "loginShell",
+    "display_name": "displayName",
+    "given_name": "givenName",
+    "first_name": "givenName",
+    "last_name": "sn",
+    "uid_number": "uidNumber",
+    "gid_number": "gidNumber",
+    "employee_number": "employeeNumber",
+    "phone": "telephoneNumber",
+    "telephone": "telephoneNumber",
+    "telefono": "telephoneNumber",
+    "telephonenumber": "telephoneNumber",
+    "mobile": "mobile",
+    "celular": "mobile",
+    "email": "mail",
+    "mail": "mail",
+    "correo": "mail",
+    "title": "title",
+    "titulo": "title",
+    "cargo": "title",
+    "job": "title",
+    "displayname": "displayName",
+    "givenname": "givenName",
+    "nombre": "givenName",
+    "surname": "sn",
+    "apellido": "sn",
+    "sn": "sn",
+    "homedirectory": "homeDirectory",
+    "home": "homeDirectory",
+    "shell": "loginShell",
+    "loginshell": "loginShell",
+    "uidnumber": "uidNumber",
+    "gidnumber": "gidNumber",
+    "pager": "pager",
+    "password": "userPassword",
+    "userpassword": "userPassword",
+    "description": "description",
+    "descripcion": "description",
+    "department": "departmentNumber",
+    "departamento": "departmentNumber",
+    "manager": "manager",
+    "groups": "groups",
+    "grupos": "groups",
+    "members": "member",
+    "miembros": "member",
+}
+
+# Atributos que la vía rápida genérica puede leer directamente de la entrada del usuario.
+FAST_PATH_ATTRIBUTES = {
+    "telephoneNumber", "mobile", "mail", "title", "displayName", "givenName", "sn", "homeDirectory",
+    "loginShell", "uidNumber", "gidNumber", "pager", "description", "departmentNumber", "manager",
+    "employeeNumber",
+}
+
+_NOISE_WORDS = {
+    "get", "fetch", "retrieve", "obtain", "obtener", "find", "lookup", "show", "return", "read", "query",
+    "tool", "the", "of", "for", "by", "de", "del", "la", "el", "los", "las", "user", "users", "usuario",
+    "usuarios", "info", "value", "attribute", "attr", "address", "number",
+}
+_GROUP_WORDS = {"group", "groups", "grupo", "grupos", "team", "equipo"}
+_CURRENT_USER_WORDS = {"current", "actual", "me", "my", "whoami", "self"}
+_DOMAIN_WORDS = {"all", "todos", "todas", "list", "enumerate", "domain", "dominio"}
+
+# Parámetro de la función -> tipo de argumento que recibe.
+_PARAM_KINDS = {
+    "uid": "uid", "username": "uid", "user": "uid", "user_id": "uid", "query": "uid",
+    "group_name": "group", "group": "group", "cn": "group",
+    "field": "field", "attribute": "field",
+}
+
+
+class IntentSignature(NamedTuple):
+    attributes: frozenset   # atributos LDAP objetivo ('*' = todos)
+    arg_kind: str           # "uid", "group", "field", "none" o "unknown"
+    subject: str            # "user", "group", "current_user" o "domain"
+    normalized_name: str
+    specific: bool = True   # False si el nombre tiene palabras que los atributos no explican
+
+
+# Firmas declaradas de las herramientas estáticas: sus nombres no siempre nombran el atributo.
+STATIC_TOOL_SIGNATURES = {
+    "get_all_usernames_tool": (frozenset({"uid"}), "none", "domain"),
+    "get_user_attributes_tool": (frozenset({"*"}), "uid", "user"),
+    "get_group_names_tool": (frozenset({"cn"}), "none", "domain"),
+    "get_current_user_info_tool": (frozenset({"*"}), "field", "current_user"),
+    "get_user_groups_tool": (frozenset({"groups"}), "uid", "user"),
+    "enumerate_group_members_tool": (frozenset({"member"}), "group", "group"),
+    "get_user_email_tool": (frozenset({"mail"}), "uid", "user"),
+    "export_directory_tool": (frozenset({"*"}), "unknown", "domain"),
+    "audit_directory_tool": (frozenset({"*"}), "unknown", "domain"),
+}
+
+
+def _tokens(name: str) -> list[str]:
+    return [token for token in re.split(r"[^a-z0-9]+", name.lower()) if token]
+
+
+def _attributes_from_tokens(tokens: list[str]) -> tuple[set[str], set[str]]:
+    """Devuelve (atributos reconocidos, tokens consumidos por esos atributos)."""
+    attributes = set()
+    consumed = set()
+    index = 0
+    while index < len(tokens):
+        pair = "_".join(tokens[index:index + 2])
+        if index + 1 < len(tokens) and pair in ATTRIBUTE_SYNONYMS:
+            attributes.add(ATTRIBUTE_SYNONYMS[pair])
+            consumed.update(tokens[index:index + 2])
+            index += 2
+            continue
+        if tokens[index] in ATTRIBUTE_SYNONYMS:
+            attributes.add(ATTRIBUTE_SYNONYMS[tokens[index]])
+            consumed.add(tokens[index])
+        index += 1
+    return attributes, consumed
+
+
+def signature_from_name(name: str, arg_kind: str = "unknown") -> IntentSignature:
+    """Deduce la intención de un nombre de herramienta (inventado por el LLM o existente)."""
+    tokens = _tokens(name)
+    attributes, consumed = _attributes_from_tokens(tokens)
+    token_set = set(tokens)
+
+    if token_set & _CURRENT_USER_WORDS:
+        subject = "current_user"
+    elif "member" in attributes:
+        subject = "group"
+    elif "groups" in attributes:
+        # 'groups' sin 'all'/'list' son los grupos de un usuario; con ellas, el listado del dominio.
+        subject = "domain" if token_set & _DOMAIN_WORDS else "user"
+    elif token_set & _GROUP_WORDS:
+        subject = "group"
+    elif token_set & _DOMAIN_WORDS:
+        subject = "domain"
+    else:
+        subject = "user"
+
+    if arg_kind == "unknown":
+        arg_kind = {"user": "uid", "group": "group", "current_user": "none", "domain": "none"}[subject]
+
+    # Palabras que no son ruido, atributo ni sujeto (ej. 'policy', 'weak', 'expired') indican
+    # una capacidad distinta: en ese caso no se equipara por atributos.
+    leftover = token_set - _NOISE_WORDS - consumed - _GROUP_WORDS - _CURRENT_USER_WORDS - _DOMAIN_WORDS
+    normalized = "_".join(sorted(token for token in token_set if token not in _NOISE_WORDS))
+    return IntentSignature(frozenset(attributes), arg_kind, subject, normalized, not leftover)
+
+
+def arg_kind_of(tool_obj) -> str:
+    func = getattr(tool_obj, 'func', tool_obj)
+    try:
+        params = list(inspect.signature(func).parameters.keys())
+    except (TypeError, ValueError):
+        return "unknown"
+    if not params:
+        return "none"
+    return _PARAM_KINDS.get(params[0].lower(), "uid")
+
+
+def _attributes_from_source(tool_obj) -> set[str]:
+    """Para herramientas generadas: lee los atributos pedidos en 'attributes=[...]' de su código."""
+    func = getattr(tool_obj, 'func', tool_obj)
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        return set()
+    attributes = set()
+    for match in re.finditer(r"attributes\s*=\s*\[([^\]]*)\]", source):
+        attributes.update(re.findall(r"['\"]([A-Za-z][\w-]*)['\"]", match.group(1)))
+    return attributes
+
+
+def signature_for_tool(tool_name: str, tool_obj) -> IntentSignature:
+    if tool_name in STATIC_TOOL_SIGNATURES:
+        attributes, arg_kind, subject = STATIC_TOOL_SIGNATURES[tool_name]
+        return IntentSignature(attributes, arg_kind, subject, signature_from_name(tool_name).normalized_name, True)
+    signature = signature_from_name(tool_name, arg_kind_of(tool_obj))
+    if not signature.attributes:
+        signature = signature._replace(attributes=frozenset(_attributes_from_source(tool_obj)))
+    return signature
+
+
+class ToolIndex:
+    """
+    Índice de firmas de intención sobre las herramientas registradas. Permite mapear nombres
+    casi duplicados que inventa el LLM ("get_user_telephone_number_tool", "get_phone_number_tool")
+    a la herramienta existente equivalente en lugar de generar código nuevo. Si varias herramientas
+    equivalen, se elige la de menor costo según 'cost_of' (las que no tienen costo medido cuentan
+    como 0, así las estáticas mantienen la preferencia).
+    """
+
+    def __init__(self, cost_of: Callable[[str], float | None] | None = None):
+        self.cost_of = cost_of
+        self._fingerprint: tuple = ()
+        self._by_name: dict[str, str] = {}
+        self._by_intent: dict[tuple, list[str]] = {}
+
+    def _refresh(self, tools: dict) -> None:
+        fingerprint = tuple(sorted(tools))
+        if fingerprint == self._fingerprint:
+            return
+        self._by_name.clear()
+        self._by_intent.clear()
+        for tool_name, tool_obj in tools.items():
+            signature = signature_for_tool(tool_name, tool_obj)
+            self._by_name.setdefault(signature.normalized_name, tool_name)
+            if signature.specific and signature.attributes and "*" not in signature.attributes:
+                key = (signature.subject, signature.arg_kind, signature.attributes)
+                self._by_intent.setdefault(key, []).append(tool_name)
+        self._fingerprint = fingerprint
+
+    def resolve(self, requested_name: str, tools: dict) -> str | None:
+        """Devuelve la herramienta existente equivalente a 'requested_name', o None si es una capacidad nueva."""
+        if requested_name in tools:
+            return requested_name
+        self._refresh(tools)
+        signature = signature_from_name(requested_name)
+        if signature.normalized_name and signature.normalized_name in self._by_name:
+            return self._by_name[signature.normalized_name]
+        if not signature.specific or not signature.attributes:
+            return None
+        candidates = self._by_intent.get((signature.subject, signature.arg_kind, signature.attributes))
+        if not candidates:
+            return None
+        if self.cost_of is None:
+            return candidates[0]
+        return min(candidates, key=lambda name: self.cost_of(name) or 0.0)
+
+
+def fast_path_attribute(requested_name: str) -> str | None:
+    """
+    Si el nombre pide un único atributo de un usuario dado su uid (ej. 'get_user_phone_tool'),
+    devuelve ese atributo: la herramienta puede servirse sin generar código.
+    """
+    signature = signature_from_name(requested_name)
+    if not signature.specific or signature.subject != "user" or signature.arg_kind != "uid" or len(signature.attributes) != 1:
+        return None
+    attribute = next(iter(signature.attributes))
+    return attribute if attribute in FAST_PATH_ATTRIBUTES else None
+
+
+def make_attribute_tool(tool_name: str, attribute: str, fetch_attribute) -> StructuredTool:
+    """Crea una herramienta genérica que devuelve solo 'attribute' del usuario indicado por uid."""
+    def fetch(uid: str):
+        return fetch_attribute(uid, attribute)
+
+    return StructuredTool.from_function(
+        func=fetch,
+        name=tool_name,
+        description=f"Dado un uid (nombre de usuario), devuelve el atributo '{attribute}' del usuario.",
+    )
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from inspect import signature
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+from ldap3 import SUBTREE
+
+from ldap_backend import open_connection
+from filter_builder import eq
+from tool_index import arg_kind_of
+from profiling import profile_span, submit_in_context
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_USERS_BASE_DN = os.getenv("LDAP_USERS_BASE_DN")
+LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
+
+# Validación de herramientas generadas: cuántas entradas reales se prueban, en paralelo, y los
+# presupuestos que una herramienta debe cumplir para registrarse.
+VALIDATION_SAMPLE_SIZE = int(os.getenv("VALIDATION_SAMPLE_SIZE", "4"))
+VALIDATION_SAMPLE_POOL = int(os.getenv("VALIDATION_SAMPLE_POOL", "200"))
+VALIDATION_MAX_WORKERS = int(os.getenv("VALIDATION_MAX_WORKERS", "4"))
+VALIDATION_LATENCY_BUDGET_MS = float(os.getenv("VALIDATION_LATENCY_BUDGET_MS", "3000"))
+VALIDATION_MAX_RESULT_BYTES = int(os.getenv("VALIDATION_MAX_RESULT_BYTES", str(256 * 1024)))
+# Proporción máxima de entradas válidas que pueden devolver {"error": ...} (p. ej. un usuario sin
+# el atributo pedido). Las excepciones siempre rechazan la herramienta.
+VALIDATION_MAX_ERROR_RATIO = float(os.getenv("VALIDATION_MAX_ERROR_RATIO", "0.5"))
+VALIDATION_TIMEOUT = float(os.getenv("VALIDATION_TIMEOUT", "10"))
+
+TOOL_PROFILES_FILE = os.getenv(
+    "TOOL_PROFILES_FILE", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools', 'tool_profiles.json'))
+)
+
+# Valores de muestra para herramientas que reciben el nombre de un campo.
+FIELD_SAMPLES = ["mail", "title", "telephoneNumber", "displayName"]
+
+
+class ToolValidationError(Exception):
+    """La herramienta generada no pasó la validación con entradas reales del directorio."""
+
+
+class ValidationRun(NamedTuple):
+    arg: str | None
+    latency_ms: float
+    result_bytes: int
+    result: object
+    error: str | None       # excepción o {"error": ...} devuelto por la herramienta
+    raised: bool
+
+
+class ValidationReport(NamedTuple):
+    profile: dict
+    runs: list
+    requested: ValidationRun | None   # ejecución con el argumento de la consulta, si lo hubo
+
+
+_sample_pools: dict[str, list[str]] = {}
+_sample_lock = threading.Lock()
+
+
+def _load_sample_pool(arg_kind: str) -> list[str]:
+    if arg_kind == "group":
+        base, object_class, attribute = LDAP_GROUPS_BASE_DN, "groupOfNames", "cn"
+    else:
+        base, object_class, attribute = LDAP_USERS_BASE_DN, "inetOrgPerson", "uid"
+    conn = None
+    try:
+        conn = open_connection()
+        conn.search(search_base=base, search_filter=eq('objectClass', object_class), search_scope=SUBTREE,
+                    attributes=[attribute], size_limit=VALIDATION_SAMPLE_POOL)
+        values = []
+        for entry in conn.entries:
+            if attribute in entry and getattr(entry, attribute).value:
+                value = getattr(entry, attribute).value
+                values.append(value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value))
+        return values
+    except Exception as e:
+        logger.warning(f"No se pudieron muestrear entradas '{arg_kind}' del directorio: {e}")
+        return []
+    finally:
+        if conn and conn.bound:
+            conn.unbind()
+
+
+def sample_inputs(arg_kind: str, size: int = VALIDATION_SAMPLE_SIZE, rng: random.Random | None = None) -> list[str]:
+    """Valores reales del directorio (uids, grupos o campos) para probar una herramienta."""
+    if arg_kind == "none" or size <= 0:
+        return []
+    if arg_kind == "field":
+        pool = FIELD_SAMPLES
+    else:
+        kind = "group" if arg_kind == "group" else "uid"
+        with _sample_lock:
+            if kind not in _sample_pools:
+                _sample_pools[kind] = _load_sample_pool(kind)
+            pool = _sample_pools[kind]
+    rng = rng or random.Random()
+    return rng.sample(pool, min(size, len(pool)))
+
+
+def forget_samples() -> None:
+    with _sample_lock:
+        _sample_pools.clear()
+
+
+def _run_once(tool_fn, param: str | None, arg: str | None) -> ValidationRun:
+    start = time.perf_counter()
+    try:
+        with profile_span(f"validate:{getattr(tool_fn, 'name', 'herramienta')}"):
+            result = tool_fn.invoke({param: arg} if param else {})
+    except Exception as e:
+        return ValidationRun(arg, (time.perf_counter() - start) * 1000, 0, None, str(e), True)
+    latency_ms = (time.perf_counter() - start) * 1000
+    size = len(json.dumps(result, ensure_ascii=False, default=str).encode("utf-8"))
+    error = str(result["error"]) if isinstance(result, dict) and "error" in result else None
+    return ValidationRun(arg, latency_ms, size, result, error, False)
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def build_profile(tool_name: str, runs: list[ValidationRun]) -> dict:
+    latencies = [run.latency_ms for run in runs]
+    sizes = [run.result_bytes for run in runs]
+    return {
+        "tool": tool_name,
+        "samples": len(runs),
+        "p50_ms": round(_percentile(latencies, 0.5), 1),
+        "max_ms": round(max(latencies), 1),
+        "mean_result_bytes": round(sum(sizes) / len(sizes)),
+        "max_result_bytes": max(sizes),
+        "error_ratio": round(sum(run.error is not None for run in runs) / len(runs), 3),
+        "validated_at": time.time(),
+    }
+
+
+def validate_tool(tool_fn, requested_arg: str | None = None, sample_size: int = VALIDATION_SAMPLE_SIZE) -> ValidationReport:
+    """
+    Ejecuta la herramienta en paralelo con entradas muestreadas del directorio (y con el argumento
+    de la consulta, si lo hay) y mide latencia y tamaño del resultado de cada una. Lanza
+    ToolValidationError si alguna ejecución lanza una excepción, si demasiadas entradas de muestra
+    devuelven error o si se excede el presupuesto de latencia o tamaño.
+    """
+    params = list(signature(getattr(tool_fn, 'func', tool_fn)).parameters.keys())
+    param = params[0] if params else None
+    samples = sample_inputs(arg_kind_of(tool_fn), sample_size) if param else [None]
+    if param and not samples and not requested_arg:
+        raise ToolValidationError("no hay entradas de prueba: el directorio no devolvió valores de muestra.")
+
+    executor = ThreadPoolExecutor(max_workers=VALIDATION_MAX_WORKERS, thread_name_prefix="tool-validation")
+    try:
+        sample_futures = [submit_in_context(executor, _run_once, tool_fn, param, arg) for arg in samples]
+        requested_future = submit_in_context(executor, _run_once, tool_fn, param, requested_arg) if param and requested_arg else None
+        pending_futures = sample_futures + ([requested_future] if requested_future else [])
+        _, not_done = wait(pending_futures, timeout=VALIDATION_TIMEOUT)
+        if not_done:
+            raise ToolValidationError(f"{len(not_done)} ejecuciones de prueba no terminaron en {VALIDATION_TIMEOUT:.0f} s.")
+    finally:
+        # Las ejecuciones colgadas no se pueden interrumpir: se abandonan sin esperarlas.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    runs = [future.result() for future in sample_futures]
+    requested = requested_future.result() if requested_future else None
+    measured = runs + ([requested] if requested else [])
+
+    raised = [run for run in measured if run.raised]
+    if raised:
+        raise ToolValidationError(f"la herramienta lanzó una excepción con '{raised[0].arg}': {raised[0].error}")
+    profile = build_profile(getattr(tool_fn, 'name', 'herramienta'), measured)
+    # El argumento de la consulta puede no existir en el directorio: solo cuentan las muestras.
+    failed = [run for run in runs if run.error]
+    if runs and len(failed) / len(runs) > VALIDATION_MAX_ERROR_RATIO:
+        raise ToolValidationError(
+            f"devolvió error en {len(failed)}/{len(runs)} entradas válidas (ej. '{failed[0].arg}': {failed[0].error})."
+        )
+    if profile["max_ms"] > VALIDATION_LATENCY_BUDGET_MS:
+        raise ToolValidationError(
+            f"tardó {profile['max_ms']:.0f} ms, por encima del presupuesto de {VALIDATION_LATENCY_BUDGET_MS:.0f} ms."
+        )
+    if profile["max_result_bytes"] > VALIDATION_MAX_RESULT_BYTES:
+        raise ToolValidationError(
+            f"devolvió {profile['max_result_bytes']} bytes, por encima del máximo de {VALIDATION_MAX_RESULT_BYTES}."
+        )
+    return ValidationReport(profile, runs, requested)
+
+
+class ToolProfileStore:
+    """Perfiles de costo medidos de las herramientas generadas, persistidos junto a dynamic_tools.py."""
+
+    def __init__(self, path: str = TOOL_PROFILES_FILE):
+        self.path = path
+        self._profiles: dict[str, dict] | None = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, dict]:
+        if self._profiles is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._profiles = json.load(f)
+            except FileNotFoundError:
+                self._profiles = {}
+            except (OSError, ValueError) as e:
+                logger.warning(f"No se pudieron leer los perfiles de herramientas de {self.path}: {e}")
+                self._profiles = {}
+        return self._profiles
+
+    def reload(self, path: str | None = None) -> None:
+        """Descarta los perfiles en memoria; con 'path' pasa a usar otro archivo."""
+        with self._lock:
+            self.path = path or self.path
+            self._profiles = None
+
+    def get(self, tool_name: str) -> dict | None:
+        with self._lock:
+            return self._load().get(tool_name)
+
+    def save(self, tool_name: str, profile: dict) -> None:
+        with self._lock:
+            profiles = self._load()
+            profiles[tool_name] = profile
+            partial_path = f"{self.path}.partial"
+            with open(partial_path, "w", encoding="utf-8") as f:
+                json.dump(profiles, f, ensure_ascii=False, indent=2, sort_keys=True)
+                f.write("\n")
+            os.replace(partial_path, self.path)
+
+    def cost(self, tool_name: str) -> float | None:
+        """Latencia mediana medida (ms), o None si la herramienta no tiene perfil."""
+        profile = self.get(tool_name)
+        return profile["p50_ms"] if profile else None
+
+    def summary(self, tool_name: str) -> str:
+        profile = self.get(tool_name)
+        if not profile:
+            return ""
+        return f"~{profile['p50_ms']:.0f} ms, ~{profile['mean_result_bytes']} bytes"
+
+
+profile_store = ToolProfileStore()
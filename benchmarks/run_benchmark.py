@@ -0,0 +1,278 @@
+"""
+Replay de consultas doradas: ejecuta el corpus de benchmarks/golden_queries.jsonl a través del
+grafo del agente (app) contra el backend LDIF y reporta, por clase de consulta, la precisión del
+enrutamiento y de la respuesta, las llamadas al LLM, los tokens y la latencia p50/p99.
+
+El resultado es un JSON con claves ordenadas y una fila por consulta, pensado para compararse
+entre commits (--compare o un diff directo).
+
+    python benchmarks/run_benchmark.py --model local
+    python benchmarks/run_benchmark.py --model replay --recording benchmarks/recordings/gemini
+    python benchmarks/run_benchmark.py --model gemini --record benchmarks/recordings/gemini
+
+Las grabaciones son directorios de la caché de llamadas al LLM (agent/llm_cache.py).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(ROOT, 'agent'))
+sys.path.append(os.path.join(ROOT, 'tools'))
+sys.path.append(ROOT)
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), 'golden_queries.jsonl')
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Percentil por rango más cercano."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def routing_matches(expected_tool: str, actual_tool: str) -> bool:
+    """'attribute:X' acepta cualquier herramienta de usuario cuyo nombre pida solo el atributo X."""
+    if expected_tool.startswith("attribute:"):
+        from tool_index import signature_from_name
+        signature = signature_from_name(actual_tool or "")
+        return signature.subject == "user" and signature.attributes == frozenset({expected_tool.split(":", 1)[1]})
+    return expected_tool == actual_tool
+
+
+def final_answer(state: dict) -> str:
+    from langchain_core.messages import AIMessage
+    for message in reversed(state.get("messages", [])):
+        if isinstance(message, AIMessage):
+            return str(message.content)
+    return ""
+
+
+def _usage_totals() -> dict:
+    from prompt_budget import usage_log
+    totals = {"calls": 0, "tokens": 0}
+    for label_totals in usage_log.totals.values():
+        totals["calls"] += label_totals["calls"]
+        # Tokens reportados por el proveedor si los hay; si no, la estimación local del prompt.
+        reported = label_totals["input_tokens"] + label_totals["output_tokens"]
+        totals["tokens"] += reported or label_totals["estimated_prompt_tokens"]
+    return totals
+
+
+def run_query(app, query: dict, session_id: str) -> dict:
+    from langchain_core.messages import HumanMessage
+
+    before = _usage_totals()
+    start = time.perf_counter()
+    error = None
+    state = {}
+    try:
+        state = app.invoke({
+            "session_id": session_id,
+            "user_input": query["query"],
+            "tool_generated": False,
+            "result": "",
+            "messages": [HumanMessage(content=query["query"])],
+        })
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    latency_ms = (time.perf_counter() - start) * 1000
+    after = _usage_totals()
+
+    tool_name = state.get("tool_name", "")
+    tool_arg = str(state.get("tool_arg", "") or "")
+    answer = final_answer(state) + "\n" + json.dumps(state.get("result"), ensure_ascii=False, default=str)
+    expected_answer = query.get("expected_answer", [])
+    routing_ok = routing_matches(query["expected_tool"], tool_name) and tool_arg.lower() == query["expected_arg"].lower()
+    row = {
+        "id": query["id"],
+        "class": query["class"],
+        "tool": tool_name,
+        "arg": tool_arg,
+        "routing_ok": routing_ok,
+        "answer_ok": error is None and all(fragment.lower() in answer.lower() for fragment in expected_answer),
+        "llm_calls": after["calls"] - before["calls"],
+        "tokens": after["tokens"] - before["tokens"],
+        "latency_ms": round(latency_ms, 1),
+    }
+    if error:
+        row["error"] = error
+    return row
+
+
+def summarize(rows: list[dict]) -> dict:
+    def aggregate(group: list[dict]) -> dict:
+        latencies = [row["latency_ms"] for row in group]
+        return {
+            "queries": len(group),
+            "routing_accuracy": round(sum(row["routing_ok"] for row in group) / len(group), 3),
+            "answer_accuracy": round(sum(row["answer_ok"] for row in group) / len(group), 3),
+            "llm_calls_per_query": round(sum(row["llm_calls"] for row in group) / len(group), 2),
+            "tokens_per_query": round(sum(row["tokens"] for row in group) / len(group), 1),
+            "p50_ms": round(percentile(latencies, 0.50), 1),
+            "p99_ms": round(percentile(latencies, 0.99), 1),
+        }
+
+    by_class = defaultdict(list)
+    for row in rows:
+        by_class[row["class"]].append(row)
+    return {"overall": aggregate(rows), "by_class": {name: aggregate(group) for name, group in sorted(by_class.items())}}
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    """Debe ejecutarse antes de importar el agente: backend LDIF y proveedor del modelo."""
+    os.environ["LDAP_BACKEND"] = "ldif"
+    os.environ.setdefault("LDAP_USERS_BASE_DN", "ou=users,dc=meli,dc=com")
+    os.environ.setdefault("LDAP_GROUPS_BASE_DN", "ou=groups,dc=meli,dc=com")
+    os.environ.setdefault("LDAP_BIND_DN", "cn=admin,ou=users,dc=meli,dc=com")
+    # El historial de consultas de producción no debe precalentar las mediciones.
+    os.environ["PREFETCH_ENABLED"] = "0"
+    # El replay usa el mismo identificador de modelo que la grabación; no contacta al proveedor.
+    os.environ["LLM_PROVIDER"] = {"replay": "gemini"}.get(args.model, args.model)
+    if args.model == "replay":
+        os.environ["LLM_CACHE_MODE"] = "replay"
+        os.environ["LLM_CACHE_DIR"] = args.recording
+    elif args.record:
+        os.environ["LLM_CACHE_MODE"] = "record"
+        os.environ["LLM_CACHE_DIR"] = args.record
+    if args.model == "replay" or args.record:
+        # Los nombres de la caché de contexto del proveedor cambian entre corridas y romperían las claves.
+        os.environ["ROUTING_CONTEXT_CACHE"] = "0"
+    if args.model == "fake":
+        os.environ.setdefault("LLM_FAKE_LATENCY", str(args.fake_latency))
+    if args.model != "gemini":
+        # Sin proveedor real el limitador de tasa solo agregaría esperas artificiales.
+        os.environ.setdefault("LLM_RATE_LIMIT", "0")
+
+
+def run(args: argparse.Namespace) -> dict:
+    configure_environment(args)
+    import agent_graph
+    from llm_client import get_llm_client
+
+    client = get_llm_client()
+
+    # Las herramientas que se generen durante el benchmark no tocan tools/dynamic_tools.py ni sus perfiles.
+    scratch_dir = tempfile.mkdtemp(prefix="ldap-bench-")
+    scratch_tools = os.path.join(scratch_dir, "dynamic_tools.py")
+    shutil.copyfile(agent_graph.DYNAMIC_TOOLS_FILE, scratch_tools)
+    agent_graph.DYNAMIC_TOOLS_FILE = scratch_tools
+    scratch_profiles = os.path.join(scratch_dir, "tool_profiles.json")
+    if os.path.exists(agent_graph.profile_store.path):
+        shutil.copyfile(agent_graph.profile_store.path, scratch_profiles)
+    agent_graph.profile_store.reload(scratch_profiles)
+
+    corpus = load_corpus(args.corpus)
+    if args.only_class:
+        corpus = [query for query in corpus if query["class"] in args.only_class]
+    rows = []
+    try:
+        for repetition in range(args.repeat):
+            for query in corpus:
+                session_id = f"bench-{repetition}-{query.get('session', query['id'])}"
+                rows.append(run_query(agent_graph.app, query, session_id))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": current_commit(),
+            "model": args.model,
+            "corpus": os.path.relpath(args.corpus, ROOT),
+            "repeat": args.repeat,
+            "llm_client": dict(client.stats),
+        },
+        "summary": summarize(rows),
+        "queries": rows if args.repeat == 1 else rows[:len(corpus)],
+    }
+    if client.cache is not None:
+        report["meta"]["llm_cache"] = {"mode": client.cache.mode, **client.cache.stats}
+    return report
+
+
+def compare(report: dict, baseline_path: str) -> str:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    lines = [f"Comparación con {baseline['meta'].get('commit')} ({baseline_path}):"]
+    base_classes = baseline["summary"]["by_class"]
+    for name, current in [("overall", report["summary"]["overall"])] + list(report["summary"]["by_class"].items()):
+        base = baseline["summary"]["overall"] if name == "overall" else base_classes.get(name)
+        if base is None:
+            lines.append(f"  {name}: (nueva clase)")
+            continue
+        deltas = ", ".join(
+            f"{metric} {base[metric]} -> {current[metric]}"
+            for metric in ("routing_accuracy", "answer_accuracy", "llm_calls_per_query", "tokens_per_query", "p50_ms", "p99_ms")
+            if base[metric] != current[metric]
+        )
+        lines.append(f"  {name}: {deltas or 'sin cambios'}")
+    return "\n".join(lines)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark de enrutamiento y latencia sobre consultas doradas.")
+    parser.add_argument("--model", choices=["local", "fake", "replay", "gemini"], default="local",
+                        help="local: router/formateador deterministas; fake: local con latencia inyectada; "
+                             "replay: respuestas grabadas; gemini: modelo real.")
+    parser.add_argument("--recording", default=os.path.join(os.path.dirname(__file__), 'recordings', 'gemini'),
+                        help="Directorio de la grabación a reproducir con --model replay.")
+    parser.add_argument("--record", default=None, help="Graba las respuestas del modelo en este directorio.")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--class", dest="only_class", action="append", help="Limita a una clase de consulta (repetible).")
+    parser.add_argument("--repeat", type=int, default=1, help="Repeticiones del corpus para estabilizar latencias.")
+    parser.add_argument("--fake-latency", type=float, default=0.05, help="Latencia por llamada del modelo fake (s).")
+    parser.add_argument("--output", default=None, help="Archivo JSON de resultados (por defecto results/<commit>-<modelo>.json).")
+    parser.add_argument("--compare", default=None, help="Resultados previos con los que comparar.")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.model == "replay" and not os.path.exists(args.recording):
+        print(f"❌ No existe la grabación '{args.recording}'. Generala con --model gemini --record.", file=sys.stderr)
+        return 1
+
+    report = run(args)
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"{report['meta']['commit']}-{args.model}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+
+    overall = report["summary"]["overall"]
+    print(f"✅ {overall['queries']} consultas: enrutamiento {overall['routing_accuracy']:.1%}, "
+          f"respuestas {overall['answer_accuracy']:.1%}, {overall['llm_calls_per_query']} llamadas LLM/consulta, "
+          f"p50 {overall['p50_ms']} ms, p99 {overall['p99_ms']} ms. Resultados en '{output}'.")
+    for name, stats in report["summary"]["by_class"].items():
+        print(f"   {name}: enrutamiento {stats['routing_accuracy']:.0%}, respuestas {stats['answer_accuracy']:.0%}, "
+              f"{stats['llm_calls_per_query']} llamadas, p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms")
+    if args.compare:
+        print(compare(report, args.compare))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'tools')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'agent')))
+
+
+def _print_progress(rows: int) -> None:
+    print(f"⏳ {rows} filas exportadas...", file=sys.stderr)
+
+
+def run_export(args: argparse.Namespace) -> int:
+    from export_tools import export_directory, parse_export_spec
+
+    options = parse_export_spec(args.attributes)
+    if args.groups:
+        options["include_groups"] = True
+    if args.format:
+        options["output_format"] = args.format
+    if args.gzip:
+        options["compress"] = True
+
+    result = export_directory(
+        output_path=args.output,
+        search_filter=args.filter,
+        page_size=args.page_size,
+        progress_callback=_print_progress,
+        **options
+    )
+    print(f"✅ Exportación completada: {result['rows']} filas en '{result['path']}'.")
+    return 0
+
+
+def run_replicas(args: argparse.Namespace) -> int:
+    from ldap_backend import open_connection
+    from filter_builder import eq
+    import ldap_backend
+
+    mock = ldap_backend.LDAP_BACKEND == "ldif"
+    if not (ldap_backend.LDAP_MOCK_REPLICAS if mock else ldap_backend.LDAP_HOSTS):
+        print("❌ No hay réplicas configuradas (LDAP_HOSTS o LDAP_MOCK_REPLICAS con LDAP_BACKEND=ldif).", file=sys.stderr)
+        return 1
+    from ldap_replicas import get_replica_set
+
+    errors = 0
+    for _ in range(args.probes):
+        conn = open_connection()
+        try:
+            conn.search(search_base=os.getenv("LDAP_USERS_BASE_DN"), search_filter=eq('objectClass', 'inetOrgPerson'),
+                        attributes=['uid'], size_limit=1)
+        except Exception as e:
+            errors += 1
+            print(f"⚠️ {e}", file=sys.stderr)
+        finally:
+            conn.unbind()
+
+    replica_set = get_replica_set(mock=mock)
+    print(f"Búsquedas de prueba: {args.probes}, con error: {errors}. "
+          + ", ".join(f"{key}={value}" for key, value in replica_set.stats.items()))
+    for status in replica_set.status():
+        latency = f"{status['latency_ms']} ms" if status['latency_ms'] is not None else "sin medir"
+        print(f"  {status['name']}: {status['state']}, {latency}, {status['searches']} búsquedas, "
+              f"{status['failures']} fallos, {status['hedges_won']} coberturas ganadas")
+    return 0
+
+
+def run_snapshot(args: argparse.Namespace) -> int:
+    from directory_snapshot import SnapshotDirectory, build_snapshot, read_current_pointer, SNAPSHOT_DIR
+
+    directory = args.dir or SNAPSHOT_DIR
+    if args.action == "build":
+        path = build_snapshot(args.source, directory)
+        snapshot = SnapshotDirectory(path)
+        print(f"✅ Snapshot generación {snapshot.generation} publicado: {len(snapshot)} entradas, "
+              f"{os.path.getsize(path)} bytes en '{path}'.")
+        return 0
+
+    path = read_current_pointer(directory)
+    if path is None:
+        print(f"❌ No hay snapshot publicado en '{directory}'.", file=sys.stderr)
+        return 1
+    snapshot = SnapshotDirectory(path)
+    print(f"Generación {snapshot.generation}: {len(snapshot)} entradas, {snapshot.header['strings']} cadenas, "
+          f"{os.path.getsize(path)} bytes, atributos indexados: {', '.join(sorted(snapshot.indexed_attributes))}.")
+    return 0
+
+
+def run_profiles(args: argparse.Namespace) -> int:
+    from profiling import aggregate_profiles, PROFILE_DIR
+
+    directory = args.dir or PROFILE_DIR
+    summary = aggregate_profiles(directory, tool=args.tool, top=args.top)
+    if not summary["requests"]:
+        print(f"❌ No hay perfiles capturados en '{directory}'.", file=sys.stderr)
+        return 1
+
+    total_ms = summary["total_ms"] or 1
+    print(f"Consultas perfiladas: {summary['requests']}, {summary['total_ms']:.0f} ms en total, "
+          f"{summary['samples']} muestras.")
+    print("\nTiempo por tramo (nodos, herramientas, recargas):")
+    for name, ms in summary["spans_ms"][:args.top]:
+        print(f"  {ms:10.1f} ms  {100 * ms / total_ms:5.1f}%  {name}")
+    if summary["samples"]:
+        print("\nFunciones con más muestras propias:")
+        for frame, count in summary["self"]:
+            print(f"  {count:8d}  {100 * count / summary['samples']:5.1f}%  {frame}")
+        print("\nFunciones con más muestras inclusivas:")
+        for frame, count in summary["inclusive"]:
+            print(f"  {count:8d}  {100 * count / summary['samples']:5.1f}%  {frame}")
+    if summary["stats"] is not None:
+        print(f"\nEstadísticas cProfile combinadas (orden: {args.sort}):")
+        summary["stats"].sort_stats(args.sort).print_stats(args.top)
+
+    if args.collapsed:
+        with open(args.collapsed, "w", encoding="utf-8") as f:
+            for stack, count in summary["collapsed"].most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"✅ Pilas combinadas escritas en '{args.collapsed}' (entrada de flamegraph.pl o speedscope).")
+    return 0
+
+
+def run_audit_command(args: argparse.Namespace) -> int:
+    from audit_tools import run_audit, parse_analyzer_names
+
+    try:
+        names = parse_analyzer_names(args.analyzers)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    report = run_audit(names, page_size=args.page_size, max_workers=args.workers)
+    scanned = ", ".join(f"{tree}={count}" for tree, count in report["scanned"].items())
+    print(f"Auditoría completada en {report['duration_ms']:.0f} ms. Entradas recorridas: {scanned}.")
+    for name, info in report["analyzers"].items():
+        print(f"\n[{info['severity'].upper()}] {name}: {info['count']} hallazgos — {info['description']}")
+        for finding in report["findings"][name][:args.show]:
+            print("  - " + ", ".join(f"{key}={value}" for key, value in finding.items() if key != "dn"))
+        hidden = info["count"] - min(args.show, len(report["findings"][name]))
+        if hidden > 0:
+            print(f"  ... y {hidden} más.")
+        if info["errors"]:
+            print(f"  ⚠️ {info['errors']} entradas no se pudieron analizar.")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"\n✅ Informe completo escrito en '{args.output}'.")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Utilidades de línea de comandos para el directorio LDAP.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Exporta los usuarios del directorio a JSONL o CSV.")
+    export_parser.add_argument("--attributes", default=None,
+                               help="Atributos separados por comas (ej. 'mail,title,telephoneNumber').")
+    export_parser.add_argument("--format", choices=["jsonl", "csv"], default=None, help="Formato de salida.")
+    export_parser.add_argument("--output", default=None, help="Ruta del archivo de salida.")
+    export_parser.add_argument("--groups", action="store_true", help="Incluye los grupos de cada usuario.")
+    export_parser.add_argument("--gzip", action="store_true", help="Comprime la salida con gzip.")
+    export_parser.add_argument("--filter", default="(objectClass=inetOrgPerson)", help="Filtro LDAP de usuarios.")
+    export_parser.add_argument("--page-size", type=int, default=500, help="Tamaño de página de la búsqueda.")
+    export_parser.set_defaults(handler=run_export)
+
+    replicas_parser = subparsers.add_parser("replicas", help="Sondea los nodos LDAP y muestra latencia y estado del circuito.")
+    replicas_parser.add_argument("--probes", type=int, default=20, help="Cantidad de búsquedas de prueba.")
+    replicas_parser.set_defaults(handler=run_replicas)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Genera o inspecciona el snapshot mapeado en memoria del directorio.")
+    snapshot_parser.add_argument("action", choices=["build", "info"])
+    snapshot_parser.add_argument("--source", choices=["ldap", "ldif"], default=None,
+                                 help="Backend del que se lee el directorio (por defecto LDAP_BACKEND, o ldap si es snapshot).")
+    snapshot_parser.add_argument("--dir", default=None, help="Directorio de snapshots (por defecto SNAPSHOT_DIR).")
+    snapshot_parser.set_defaults(handler=run_snapshot)
+
+    audit_parser = subparsers.add_parser("audit", help="Audita usuarios y grupos en una sola pasada paginada.")
+    audit_parser.add_argument("--analyzers", default=None,
+                              help="Analizadores separados por comas (por defecto todos los registrados).")
+    audit_parser.add_argument("--output", default=None, help="Escribe el informe completo en JSON en esta ruta.")
+    audit_parser.add_argument("--show", type=int, default=10, help="Hallazgos mostrados por analizador.")
+    audit_parser.add_argument("--page-size", type=int, default=500, help="Tamaño de página de la búsqueda.")
+    audit_parser.add_argument("--workers", type=int, default=4, help="Hilos que ejecutan los analizadores.")
+    audit_parser.set_defaults(handler=run_audit_command)
+
+    profiles_parser = subparsers.add_parser("profiles", help="Agrega los perfiles capturados y muestra los puntos calientes.")
+    profiles_parser.add_argument("--dir", default=None, help="Directorio de perfiles (por defecto PROFILE_DIR).")
+    profiles_parser.add_argument("--tool", default=None, help="Solo las consultas resueltas con esta herramienta.")
+    profiles_parser.add_argument("--top", type=int, default=15, help="Cantidad de filas por sección.")
+    profiles_parser.add_argument("--sort", choices=["cumulative", "tottime", "calls"], default="cumulative",
+                                 help="Orden de las estadísticas cProfile.")
+    profiles_parser.add_argument("--collapsed", default=None, help="Escribe las pilas combinadas en este archivo.")
+    profiles_parser.set_defaults(handler=run_profiles)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -36,6 +36,8 @@ from ldap3 import Server, Connection, ALL_ATTRIBUTES, SUBTREE
 from langchain_core.tools import tool, Tool 
 import ldap3.core.exceptions 
 import re 
+from ldap_backend import open_connection # Conexión contra el backend configurado (LDAP o LDIF)
+from filter_builder import eq, presence, prefix, and_, or_, not_, escape_filter_value # Filtros LDAP escapados
 
 # Cargar variables de entorno
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '.env')))
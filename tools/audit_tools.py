@@ -0,0 +1,320 @@
+import os
+import re
+import time
+import queue
+import base64
+import binascii
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from langchain_core.tools import tool
+import ldap3.core.exceptions
+
+from ldap_backend import open_connection
+from directory_snapshot import iter_directory_entries
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
+LDAP_USERS_BASE_DN = os.getenv("LDAP_USERS_BASE_DN")
+LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
+
+# Auditoría en una sola pasada: una búsqueda paginada por árbol, entradas repartidas entre
+# AUDIT_MAX_WORKERS hilos por una cola acotada (la memoria no crece con el tamaño del directorio).
+AUDIT_PAGE_SIZE = int(os.getenv("AUDIT_PAGE_SIZE", "500"))
+AUDIT_MAX_WORKERS = int(os.getenv("AUDIT_MAX_WORKERS", "4"))
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "256"))
+# Hallazgos guardados por analizador; el resto solo se cuenta.
+AUDIT_MAX_FINDINGS = int(os.getenv("AUDIT_MAX_FINDINGS", "1000"))
+# La herramienta del agente devuelve menos detalle para no inflar el prompt de formateo.
+AUDIT_TOOL_MAX_FINDINGS = int(os.getenv("AUDIT_TOOL_MAX_FINDINGS", "20"))
+AUDIT_PRIVILEGED_GROUPS = {
+    name.strip().lower()
+    for name in os.getenv(
+        "AUDIT_PRIVILEGED_GROUPS", "admins,administrators,domain admins,enterprise admins,schema admins,it,root,wheel,sudo"
+    ).split(",")
+    if name.strip()
+}
+AUDIT_SECRET_MIN_LENGTH = int(os.getenv("AUDIT_SECRET_MIN_LENGTH", "16"))
+
+# Atributos que no se revisan en busca de secretos codificados (estructurales o ya cubiertos).
+SECRET_SCAN_EXCLUDED = {"objectclass", "userpassword", "member", "uniquemember", "memberof", "jpegphoto", "usercertificate"}
+# Esquemas de hash de userPassword (RFC 3112 y extensiones de OpenLDAP).
+PASSWORD_SCHEME_PATTERN = re.compile(r"^\{[A-Za-z0-9.+-]+\}")
+BASE64_PATTERN = re.compile(r"^[A-Za-z0-9+/]+={0,2}$")
+SEVERITY_ORDER = {"critical": 0, "high": 1, "medium": 2, "low": 3}
+
+
+class AuditEntry:
+    """Entrada del directorio durante la auditoría: DN, árbol ('users' o 'groups') y atributos como listas de texto."""
+
+    __slots__ = ("dn", "tree", "attributes", "_lowered")
+
+    def __init__(self, dn: str, tree: str, attributes: dict[str, list]):
+        self.dn = dn
+        self.tree = tree
+        self.attributes = attributes
+        self._lowered = {name.lower(): name for name in attributes}
+
+    def values(self, attribute: str) -> list:
+        name = self._lowered.get(attribute.lower())
+        return self.attributes.get(name, []) if name else []
+
+    def first(self, attribute: str):
+        values = self.values(attribute)
+        return values[0] if values else None
+
+    @property
+    def object_classes(self) -> set[str]:
+        return {str(value).lower() for value in self.values("objectClass")}
+
+    @property
+    def label(self) -> str:
+        return self.first("uid") or self.first("cn") or self.dn
+
+
+def _rdn_value(dn: str) -> str:
+    first = dn.split(",", 1)[0]
+    return first.split("=", 1)[1].strip() if "=" in first else dn
+
+
+class Analyzer:
+    """
+    Analizador de la auditoría. 'trees' indica qué árboles recorre; analyze() recibe una entrada y
+    devuelve sus hallazgos, sin estado compartido, porque corre en varios hilos a la vez.
+    """
+
+    name = ""
+    description = ""
+    severity = "medium"
+    trees = ("users",)
+
+    def analyze(self, entry: AuditEntry) -> list[dict]:
+        raise NotImplementedError
+
+
+ANALYZERS: dict[str, type[Analyzer]] = {}
+
+
+def register_analyzer(cls: type[Analyzer]) -> type[Analyzer]:
+    """Registra un analizador para que la auditoría lo ejecute por defecto."""
+    ANALYZERS[cls.name] = cls
+    return cls
+
+
+@register_analyzer
+class PrivilegedMembersAnalyzer(Analyzer):
+    name = "privileged_members"
+    description = "Miembros de grupos privilegiados (AUDIT_PRIVILEGED_GROUPS)."
+    severity = "high"
+    trees = ("groups",)
+
+    def analyze(self, entry: AuditEntry) -> list[dict]:
+        group = entry.first("cn")
+        if not group or str(group).lower() not in AUDIT_PRIVILEGED_GROUPS:
+            return []
+        return [
+            {"group": group, "member": _rdn_value(str(member_dn)), "member_dn": str(member_dn)}
+            for member in entry.values("member") + entry.values("uniqueMember")
+            for member_dn in [member.split(" #", 1)[0].strip()]
+        ]
+
+
+@register_analyzer
+class PlaintextPasswordAnalyzer(Analyzer):
+    name = "plaintext_passwords"
+    description = "userPassword guardado en claro, sin esquema de hash ({SSHA}, {CRYPT}...)."
+    severity = "critical"
+
+    def analyze(self, entry: AuditEntry) -> list[dict]:
+        findings = []
+        for value in entry.values("userPassword"):
+            if isinstance(value, bytes) or PASSWORD_SCHEME_PATTERN.match(value):
+                continue
+            findings.append({"uid": entry.label, "dn": entry.dn, "attribute": "userPassword",
+                             "preview": f"{value[:1]}{'*' * max(len(value) - 1, 0)}", "length": len(value)})
+        return findings
+
+
+def decode_secret(value: str, min_length: int = AUDIT_SECRET_MIN_LENGTH) -> str | None:
+    """Devuelve el texto decodificado si el valor parece base64 de texto legible; si no, None."""
+    candidate = value.strip()
+    if len(candidate) < min_length or len(candidate) % 4 or not BASE64_PATTERN.match(candidate):
+        return None
+    # Palabras sueltas en minúscula o números largos también son base64 válido: se exige mezcla.
+    if candidate.isalpha() and (candidate.islower() or candidate.isupper()) or candidate.isdigit():
+        return None
+    try:
+        decoded = base64.b64decode(candidate, validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    printable = sum(char.isprintable() or char in "\r\n\t" for char in decoded)
+    return decoded if decoded and printable / len(decoded) >= 0.9 else None
+
+
+@register_analyzer
+class EncodedSecretAnalyzer(Analyzer):
+    name = "encoded_secrets"
+    description = "Valores en base64 que decodifican a texto legible (ej. secretos escondidos en 'pager')."
+    severity = "high"
+    trees = ("users", "groups")
+
+    def analyze(self, entry: AuditEntry) -> list[dict]:
+        findings = []
+        for attribute, values in entry.attributes.items():
+            if attribute.lower() in SECRET_SCAN_EXCLUDED:
+                continue
+            for value in values:
+                if not isinstance(value, str):
+                    continue
+                decoded = decode_secret(value)
+                if decoded is not None:
+                    findings.append({"uid": entry.label, "dn": entry.dn, "attribute": attribute,
+                                     "decoded": decoded if len(decoded) <= 120 else decoded[:117] + "..."})
+        return findings
+
+
+@register_analyzer
+class MissingMailAnalyzer(Analyzer):
+    name = "missing_mail"
+    description = "Cuentas de usuario (inetOrgPerson) sin atributo 'mail'."
+    severity = "low"
+
+    def analyze(self, entry: AuditEntry) -> list[dict]:
+        if "inetorgperson" not in entry.object_classes or entry.values("mail"):
+            return []
+        return [{"uid": entry.label, "dn": entry.dn}]
+
+
+def parse_analyzer_names(spec: str | None) -> list[str]:
+    """'plaintext_passwords,missing_mail' -> nombres válidos; vacío o 'ninguno' -> todos los registrados."""
+    if not spec or spec.strip().lower() in ("ninguno", "all", "todos"):
+        return list(ANALYZERS)
+    names = [name.strip() for name in re.split(r"[,\s;]+", spec) if name.strip()]
+    unknown = [name for name in names if name not in ANALYZERS]
+    if unknown:
+        raise ValueError(f"Analizadores desconocidos: {', '.join(unknown)}. Disponibles: {', '.join(ANALYZERS)}.")
+    return names
+
+
+class _Findings:
+    """Hallazgos por analizador, con tope de detalle: más allá de 'limit' solo se cuentan."""
+
+    def __init__(self, names: list[str], limit: int):
+        self.limit = limit
+        self.items = {name: [] for name in names}
+        self.counts = {name: 0 for name in names}
+        self.errors = {name: 0 for name in names}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, findings: list[dict]) -> None:
+        with self._lock:
+            self.counts[name] += len(findings)
+            room = self.limit - len(self.items[name])
+            if room > 0:
+                self.items[name].extend(findings[:room])
+
+    def failed(self, name: str) -> None:
+        with self._lock:
+            self.errors[name] += 1
+
+
+def run_audit(analyzer_names: list[str] | None = None, page_size: int = AUDIT_PAGE_SIZE,
+              max_workers: int = AUDIT_MAX_WORKERS, max_findings: int = AUDIT_MAX_FINDINGS) -> dict:
+    """
+    Recorre una sola vez los árboles de usuarios y grupos con búsquedas paginadas y ejecuta los
+    analizadores sobre cada entrada en paralelo. Devuelve un informe con los hallazgos por analizador.
+    """
+    names = analyzer_names or list(ANALYZERS)
+    analyzers = [ANALYZERS[name]() for name in names]
+    trees = [(tree, base) for tree, base in (("users", LDAP_USERS_BASE_DN), ("groups", LDAP_GROUPS_BASE_DN))
+             if base and any(tree in analyzer.trees for analyzer in analyzers)]
+    findings = _Findings(names, max_findings)
+    scanned = {tree: 0 for tree, _ in trees}
+    pending: queue.Queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+    done = object()
+
+    def worker() -> None:
+        while True:
+            entry = pending.get()
+            if entry is done:
+                return
+            for analyzer in analyzers:
+                if entry.tree not in analyzer.trees:
+                    continue
+                try:
+                    results = analyzer.analyze(entry)
+                except Exception as e:
+                    logger.warning(f"El analizador '{analyzer.name}' falló con '{entry.dn}': {e}")
+                    findings.failed(analyzer.name)
+                    continue
+                if results:
+                    findings.add(analyzer.name, results)
+
+    start = time.perf_counter()
+    conn = open_connection()
+    workers = max(1, max_workers)
+    try:
+        if not conn.bound:
+            raise ldap3.core.exceptions.LDAPBindError(f"No se pudo realizar el bind para la auditoría. DN: {LDAP_BIND_DN}.")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="audit") as pool:
+            futures = [pool.submit(worker) for _ in range(workers)]
+            try:
+                for tree, base in trees:
+                    for dn, attributes in iter_directory_entries(conn, [base], page_size):
+                        pending.put(AuditEntry(dn, tree, attributes))
+                        scanned[tree] += 1
+            finally:
+                for _ in futures:
+                    pending.put(done)
+            for future in futures:
+                future.result()
+    finally:
+        if conn.bound:
+            conn.unbind()
+
+    report_findings = {
+        name: sorted(findings.items[name], key=lambda item: (item.get("uid") or item.get("group") or "", item.get("dn", "")))
+        for name in names
+    }
+    return {
+        "scanned": scanned,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        "analyzers": {
+            analyzer.name: {"description": analyzer.description, "severity": analyzer.severity,
+                            "count": findings.counts[analyzer.name], "errors": findings.errors[analyzer.name]}
+            for analyzer in sorted(analyzers, key=lambda analyzer: SEVERITY_ORDER.get(analyzer.severity, 99))
+        },
+        "findings": report_findings,
+        "truncated": {name: findings.counts[name] - len(report_findings[name])
+                      for name in names if findings.counts[name] > len(report_findings[name])},
+    }
+
+
+@tool
+def audit_directory_tool(analyzers: str | None = None) -> dict:
+    """
+    Audita todo el directorio en una sola pasada y devuelve un informe de hallazgos de seguridad:
+    miembros de grupos privilegiados, contraseñas en claro en userPassword, secretos codificados en base64
+    en atributos (ej. 'pager') y cuentas sin mail. Usar para reconocimiento o auditorías de seguridad completas
+    (ej. 'haz una auditoría de seguridad del directorio', 'busca contraseñas en claro').
+    El argumento opcional es una lista de analizadores separados por comas
+    (privileged_members, plaintext_passwords, encoded_secrets, missing_mail); 'ninguno' ejecuta todos.
+    """
+    try:
+        return run_audit(parse_analyzer_names(analyzers), max_findings=AUDIT_TOOL_MAX_FINDINGS)
+    except ValueError as e:
+        return {"error": str(e)}
+    except ldap3.core.exceptions.LDAPSocketOpenError as e:
+        return {"error": f"Error de conexión LDAP para audit_directory_tool: {e}"}
+    except ldap3.core.exceptions.LDAPBindError as e:
+        return {"error": f"Error de autenticación LDAP para audit_directory_tool: {e}"}
+    except Exception as e:
+        logger.error(f"Error inesperado en audit_directory_tool: {e}", exc_info=True)
+        return {"error": f"Ocurrió un error inesperado al auditar el directorio: {e}"}
@@ -0,0 +1,514 @@
+import os
+import sys
+import json
+import mmap
+import time
+import glob
+import struct
+import logging
+import threading
+from array import array
+from typing import Iterable, Iterator
+
+from dotenv import load_dotenv
+from ldap3 import SUBTREE
+
+from ldap_filter import compile_filter, matches, normalize_dn, normalize_value
+from filter_index import DirectoryIndex, INDEXED_ATTRIBUTES
+from filter_builder import presence
+from ldif_backend import record_in_scope
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_USERS_BASE_DN = os.getenv("LDAP_USERS_BASE_DN")
+LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
+
+# Directorio de los snapshots: un archivo inmutable por generación y el puntero CURRENT a la vigente.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'snapshots')))
+# Cada cuántos segundos un worker mira si hay una generación nueva.
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "1"))
+# Generaciones que se conservan en disco (los workers pueden seguir leyendo una anterior).
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+
+MAGIC = b"LDSNAP01"
+FORMAT_VERSION = 1
+CURRENT_POINTER = "CURRENT"
+# Bit alto de una referencia a valor: el valor es binario (bytes), no texto UTF-8.
+BINARY_FLAG = 0x80000000
+_ALIGNMENT = 8
+
+# Secciones del archivo y su tipo de elemento (array/memoryview).
+#   str_offsets  Q  inicio de cada cadena en str_blob (n + 1 elementos)
+#   str_blob     B  cadenas UTF-8 (y valores binarios) concatenadas
+#   records      I  por entrada: dn, dn normalizado, primer atributo, cantidad de atributos
+#   attributes   I  por atributo: nombre, nombre en minúsculas, primer valor, cantidad de valores
+#   raw_values   I  cadena de cada valor original (| BINARY_FLAG si es binario)
+#   norm_values  I  cadena del valor normalizado (paralelo a raw_values)
+#   index_attrs  I  por atributo indexado: nombre, primer valor, cantidad, inicio y largo de presencia
+#   index_values I  por valor indexado (ordenados): cadena, inicio y largo de su lista de ids
+#   postings     I  ids de entrada ordenados
+SECTIONS = {
+    "str_offsets": "Q", "str_blob": "B", "records": "I", "attributes": "I", "raw_values": "I",
+    "norm_values": "I", "index_attrs": "I", "index_values": "I", "postings": "I",
+}
+
+
+class SnapshotError(Exception):
+    """El snapshot no existe, está dañado o no es compatible con esta plataforma."""
+
+
+# --- Escritura ---
+
+class _StringTable:
+    def __init__(self):
+        self._ids: dict = {}
+        self.offsets = array('Q', [0])
+        self.blob = bytearray()
+
+    def add(self, value: str | bytes) -> int:
+        sid = self._ids.get(value)
+        if sid is None:
+            sid = len(self.offsets) - 1
+            self.blob += value if isinstance(value, bytes) else value.encode('utf-8')
+            self.offsets.append(len(self.blob))
+            self._ids[value] = sid
+        return sid
+
+
+def _generation_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, f"directory-{generation:08d}.snap")
+
+
+def read_current_pointer(directory: str = SNAPSHOT_DIR) -> str | None:
+    try:
+        with open(os.path.join(directory, CURRENT_POINTER), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(directory, name) if name else None
+
+
+def _next_generation(directory: str) -> int:
+    generations = [0]
+    for path in glob.glob(os.path.join(directory, "directory-*.snap")):
+        try:
+            generations.append(int(os.path.basename(path)[len("directory-"):-len(".snap")]))
+        except ValueError:
+            continue
+    return max(generations) + 1
+
+
+def _replace_atomically(path: str, data: bytes) -> None:
+    partial_path = f"{path}.partial"
+    with open(partial_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial_path, path)
+
+
+def write_snapshot(entries: Iterable[tuple[str, dict]], directory: str = SNAPSHOT_DIR,
+                   indexed_attributes: set[str] | None = None, keep: int = SNAPSHOT_KEEP) -> str:
+    """
+    Escribe una generación nueva con las entradas (dn, atributos) y la publica en CURRENT.
+    El archivo se escribe completo antes de publicarse: los workers nunca ven uno a medias.
+    """
+    indexed = set(indexed_attributes if indexed_attributes is not None else INDEXED_ATTRIBUTES)
+    strings = _StringTable()
+    records, attributes_table, raw_values, norm_values = array('I'), array('I'), array('I'), array('I')
+    equality: dict[str, dict[str, list[int]]] = {}
+    presence_ids: dict[str, list[int]] = {}
+    seen: set[str] = set()
+
+    for dn, attributes in entries:
+        key = normalize_dn(dn)
+        if key in seen:
+            continue
+        seen.add(key)
+        record_id = len(records) // 4
+        records.extend((strings.add(dn), strings.add(key), len(attributes_table) // 4, len(attributes)))
+        for name, values in attributes.items():
+            lowered = name.lower()
+            attributes_table.extend((strings.add(name), strings.add(lowered), len(raw_values), len(values)))
+            postings = equality.setdefault(lowered, {}) if lowered in indexed else None
+            for value in values:
+                value_id = strings.add(value)
+                raw_values.append(value_id | BINARY_FLAG if isinstance(value, bytes) else value_id)
+                normalized = normalize_value(name, value)
+                norm_values.append(strings.add(normalized))
+                if postings is not None:
+                    ids = postings.setdefault(normalized, [])
+                    if not ids or ids[-1] != record_id:
+                        ids.append(record_id)
+            if lowered in indexed:
+                presence_ids.setdefault(lowered, []).append(record_id)
+
+    index_attrs, index_values, postings_table = array('I'), array('I'), array('I')
+    for lowered in sorted(equality.keys() | presence_ids.keys()):
+        values = equality.get(lowered, {})
+        first_value = len(index_values) // 3
+        for value in sorted(values):
+            ids = values[value]
+            index_values.extend((strings.add(value), len(postings_table), len(ids)))
+            postings_table.extend(ids)
+        present = presence_ids.get(lowered, [])
+        index_attrs.extend((strings.add(lowered), first_value, len(values), len(postings_table), len(present)))
+        postings_table.extend(present)
+
+    if len(strings.offsets) - 1 >= BINARY_FLAG:
+        raise SnapshotError("Demasiadas cadenas distintas para el formato del snapshot.")
+
+    payloads = {
+        "str_offsets": strings.offsets.tobytes(), "str_blob": bytes(strings.blob), "records": records.tobytes(),
+        "attributes": attributes_table.tobytes(), "raw_values": raw_values.tobytes(),
+        "norm_values": norm_values.tobytes(), "index_attrs": index_attrs.tobytes(),
+        "index_values": index_values.tobytes(), "postings": postings_table.tobytes(),
+    }
+    os.makedirs(directory, exist_ok=True)
+    generation = _next_generation(directory)
+    sections, offset = {}, 0
+    for name, payload in payloads.items():
+        sections[name] = [offset, len(payload)]
+        offset += len(payload) + (-len(payload)) % _ALIGNMENT
+    header = json.dumps({
+        "format": FORMAT_VERSION, "generation": generation, "byteorder": sys.byteorder,
+        "created": time.time(), "records": len(records) // 4, "strings": len(strings.offsets) - 1,
+        "sections": sections,
+    }).encode("utf-8")
+
+    data = bytearray(MAGIC + struct.pack("<I", len(header)) + header)
+    data += b"\0" * ((-len(data)) % _ALIGNMENT)
+    for payload in payloads.values():
+        data += payload + b"\0" * ((-len(payload)) % _ALIGNMENT)
+
+    path = _generation_path(directory, generation)
+    _replace_atomically(path, bytes(data))
+    _replace_atomically(os.path.join(directory, CURRENT_POINTER), os.path.basename(path).encode("utf-8"))
+    logger.info(f"Snapshot generación {generation} publicado: {len(records) // 4} entradas, {len(data)} bytes.")
+    _prune(directory, generation, keep)
+    return path
+
+
+def _prune(directory: str, current_generation: int, keep: int) -> None:
+    # En POSIX un archivo borrado sigue disponible para los workers que ya lo tienen mapeado.
+    for path in glob.glob(os.path.join(directory, "directory-*.snap")):
+        try:
+            generation = int(os.path.basename(path)[len("directory-"):-len(".snap")])
+        except ValueError:
+            continue
+        if generation <= current_generation - max(keep, 1):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"No se pudo borrar el snapshot viejo {path}: {e}")
+
+
+def iter_directory_entries(conn, bases: Iterable[str], page_size: int = 500) -> Iterator[tuple[str, dict]]:
+    """Recorre las bases con búsqueda paginada y devuelve (dn, atributos) con los valores originales."""
+    for base in bases:
+        for response in conn.extend.standard.paged_search(
+            search_base=base, search_filter=presence('objectClass'), search_scope=SUBTREE,
+            attributes=['*'], paged_size=page_size, generator=True,
+        ):
+            if response.get('type') != 'searchResEntry':
+                continue
+            attributes = {}
+            for name, values in (response.get('raw_attributes') or response.get('attributes') or {}).items():
+                decoded = []
+                for value in values if isinstance(values, list) else [values]:
+                    if isinstance(value, bytes):
+                        try:
+                            value = value.decode('utf-8')
+                        except UnicodeDecodeError:
+                            pass
+                    elif not isinstance(value, str):
+                        value = str(value)
+                    decoded.append(value)
+                attributes[name] = decoded
+            yield response['dn'], attributes
+
+
+def build_snapshot(source_backend: str | None = None, directory: str = SNAPSHOT_DIR) -> str:
+    """
+    Lee los árboles de usuarios y grupos del backend indicado y publica un snapshot. Por defecto usa
+    el backend configurado, salvo que sea 'snapshot': entonces lee del LDAP, para no republicar la
+    generación actual como si fuera nueva.
+    """
+    import ldap_backend
+    from ldap_backend import open_connection
+
+    if source_backend == "snapshot":
+        raise SnapshotError("El snapshot no puede generarse a partir de otro snapshot. Usa --source ldap o ldif.")
+    if source_backend is None:
+        source_backend = "ldap" if ldap_backend.LDAP_BACKEND == "snapshot" else ldap_backend.LDAP_BACKEND
+
+    bases = []
+    for base in (LDAP_USERS_BASE_DN, LDAP_GROUPS_BASE_DN):
+        if base and normalize_dn(base) not in {normalize_dn(existing) for existing in bases}:
+            bases.append(base)
+    if not bases:
+        raise SnapshotError("LDAP_USERS_BASE_DN y LDAP_GROUPS_BASE_DN no están configuradas.")
+    conn = open_connection(source_backend)
+    try:
+        return write_snapshot(iter_directory_entries(conn, bases), directory)
+    finally:
+        if conn.bound:
+            conn.unbind()
+
+
+# --- Lectura ---
+
+class SnapshotRecord:
+    """Entrada del snapshot: se decodifica del archivo mapeado solo lo que se consulta."""
+    __slots__ = ("_snapshot", "record_id", "dn", "key", "_first_attribute", "_attribute_count", "_normalized")
+
+    def __init__(self, snapshot: "SnapshotDirectory", record_id: int):
+        records = snapshot._records
+        base = record_id * 4
+        self._snapshot = snapshot
+        self.record_id = record_id
+        self.dn = snapshot.string(records[base])
+        self.key = snapshot.string(records[base + 1])
+        self._first_attribute = records[base + 2]
+        self._attribute_count = records[base + 3]
+        self._normalized = None
+
+    def _attribute_slots(self) -> Iterator[tuple[int, int, int, int]]:
+        table = self._snapshot._attributes
+        for index in range(self._first_attribute, self._first_attribute + self._attribute_count):
+            base = index * 4
+            yield table[base], table[base + 1], table[base + 2], table[base + 3]
+
+    @property
+    def attributes(self) -> dict[str, list]:
+        return self.project(['*'])
+
+    @property
+    def normalized(self) -> dict[str, list]:
+        if self._normalized is None:
+            snapshot = self._snapshot
+            self._normalized = {
+                snapshot.string(lowered_id): [snapshot.string(snapshot._norm_values[position])
+                                              for position in range(first, first + count)]
+                for _, lowered_id, first, count in self._attribute_slots()
+            }
+        return self._normalized
+
+    def project(self, requested: list[str] | None) -> dict[str, list]:
+        """Proyecta los atributos pedidos con la semántica de ldap3 ('*' = todos, [] = ninguno)."""
+        if not requested:
+            return {}
+        if isinstance(requested, str):
+            requested = [requested]
+        wanted = {attr.lower() for attr in requested}
+        snapshot = self._snapshot
+        projected = {}
+        for name_id, lowered_id, first, count in self._attribute_slots():
+            if '*' not in wanted and snapshot.string(lowered_id) not in wanted:
+                continue
+            projected[snapshot.string(name_id)] = [snapshot.value(snapshot._raw_values[position])
+                                                   for position in range(first, first + count)]
+        return projected
+
+
+class SnapshotIndex(DirectoryIndex):
+    """Índices del snapshot con la misma planificación que DirectoryIndex, leídos del archivo mapeado."""
+
+    def __init__(self, snapshot: "SnapshotDirectory"):
+        self._snapshot = snapshot
+        self._slots: dict[str, tuple[int, int, int, int]] = {}
+        table = snapshot._index_attrs
+        for base in range(0, len(table), 5):
+            self._slots[snapshot.string(table[base])] = (table[base + 1], table[base + 2], table[base + 3], table[base + 4])
+        self.indexed_attributes = set(self._slots)
+        self._all_ids_cache: set[int] | None = None
+
+    @property
+    def _all_ids(self) -> set[int]:
+        if self._all_ids_cache is None:
+            self._all_ids_cache = set(range(len(self._snapshot)))
+        return self._all_ids_cache
+
+    def _value_at(self, position: int) -> str:
+        return self._snapshot.string(self._snapshot._index_values[position * 3])
+
+    def _lower_bound(self, attr: str, value: str) -> int:
+        first, count, _, _ = self._slots[attr]
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self._value_at(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _postings(self, position: int) -> memoryview:
+        values = self._snapshot._index_values
+        start, count = values[position * 3 + 1], values[position * 3 + 2]
+        return self._snapshot._postings[start:start + count]
+
+    def _equal(self, attr: str, value: str) -> memoryview | None:
+        first, count, _, _ = self._slots[attr]
+        position = self._lower_bound(attr, value)
+        if position < first + count and self._value_at(position) == value:
+            return self._postings(position)
+        return None
+
+    def _lookup(self, plan) -> set[int] | None:
+        if plan.attr not in self.indexed_attributes:
+            return None
+        if plan.kind == "eq":
+            ids = self._equal(plan.attr, plan.value)
+            return set(ids) if ids is not None else set()
+        if plan.kind == "presence":
+            if plan.attr == "objectclass":
+                return self._all_ids
+            _, _, start, count = self._slots[plan.attr]
+            return set(self._snapshot._postings[start:start + count])
+        if plan.kind == "prefix":
+            first, count, _, _ = self._slots[plan.attr]
+            result: set[int] = set()
+            position = self._lower_bound(plan.attr, plan.value)
+            while position < first + count and self._value_at(position).startswith(plan.value):
+                result.update(self._postings(position))
+                position += 1
+            return result
+        return None
+
+    def _estimate(self, plan) -> int:
+        if getattr(plan, "attr", None) in self._slots and plan.kind == "eq":
+            ids = self._equal(plan.attr, plan.value)
+            return len(ids) if ids is not None else 0
+        if getattr(plan, "attr", None) in self._slots and plan.kind == "presence":
+            return self._slots[plan.attr][3]
+        return len(self._snapshot)
+
+
+class SnapshotDirectory:
+    """
+    Directorio de solo lectura sobre un snapshot mapeado en memoria (mmap). Las páginas las
+    comparte el sistema operativo entre todos los procesos que mapean el mismo archivo, así que
+    cada worker adicional casi no suma memoria, y arrancar es leer páginas en vez de bajar el LDAP.
+    Tiene la interfaz de búsqueda de LdifDirectory (search con el mismo planificador de filtros).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise SnapshotError(f"{path} no es un snapshot de directorio.")
+        (header_length,) = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        header_end = len(MAGIC) + 4 + header_length
+        self.header = json.loads(self._mmap[len(MAGIC) + 4:header_end].decode("utf-8"))
+        if self.header.get("format") != FORMAT_VERSION or self.header.get("byteorder") != sys.byteorder:
+            raise SnapshotError(f"{path}: formato {self.header.get('format')}/{self.header.get('byteorder')} no soportado.")
+        self.generation = self.header["generation"]
+
+        data_start = header_end + (-header_end) % _ALIGNMENT
+        view = memoryview(self._mmap)
+        sections = {}
+        for name, item_format in SECTIONS.items():
+            offset, length = self.header["sections"][name]
+            sections[name] = view[data_start + offset:data_start + offset + length].cast(item_format)
+        self._str_offsets = sections["str_offsets"]
+        self._blob = sections["str_blob"]
+        self._records = sections["records"]
+        self._attributes = sections["attributes"]
+        self._raw_values = sections["raw_values"]
+        self._norm_values = sections["norm_values"]
+        self._index_attrs = sections["index_attrs"]
+        self._index_values = sections["index_values"]
+        self._postings = sections["postings"]
+        self._index = SnapshotIndex(self)
+
+    def __len__(self) -> int:
+        return len(self._records) // 4
+
+    @property
+    def indexed_attributes(self) -> set[str]:
+        return set(self._index.indexed_attributes)
+
+    def string(self, string_id: int) -> str:
+        return str(self._blob[self._str_offsets[string_id]:self._str_offsets[string_id + 1]], 'utf-8')
+
+    def value(self, reference: int) -> str | bytes:
+        if reference & BINARY_FLAG:
+            string_id = reference & ~BINARY_FLAG
+            return bytes(self._blob[self._str_offsets[string_id]:self._str_offsets[string_id + 1]])
+        return self.string(reference)
+
+    def search(self, search_base: str, search_filter: str, search_scope: str = SUBTREE,
+               size_limit: int = 0) -> list[SnapshotRecord]:
+        compiled = compile_filter(search_filter)
+        base_key = normalize_dn(search_base)
+        candidate_ids, covered = (None, False)
+        if compiled.plan is not None:
+            candidate_ids, covered = self._index.candidates(compiled.plan)
+        if candidate_ids is None:
+            record_ids = range(len(self))
+            verify = True
+        else:
+            record_ids = sorted(candidate_ids)
+            verify = not (compiled.exact and covered)
+
+        results = []
+        for record_id in record_ids:
+            record = SnapshotRecord(self, record_id)
+            if not record_in_scope(record.key, base_key, search_scope):
+                continue
+            if verify and not matches(compiled.ast, record.normalized):
+                continue
+            results.append(record)
+            if size_limit and len(results) >= size_limit:
+                break
+        return results
+
+
+class SnapshotStore:
+    """Abre la generación publicada en CURRENT y cambia a una nueva sin reiniciar el proceso."""
+
+    def __init__(self, directory: str = SNAPSHOT_DIR, check_interval: float = SNAPSHOT_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._snapshot: SnapshotDirectory | None = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> SnapshotDirectory:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._next_check:
+            return snapshot
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            path = read_current_pointer(self.directory)
+            if path is None:
+                if self._snapshot is not None:
+                    return self._snapshot
+                raise SnapshotError(f"No hay snapshot publicado en {self.directory}. "
+                                    "Generalo con 'python directory_cli.py snapshot build'.")
+            if self._snapshot is None or self._snapshot.path != path:
+                # La generación anterior se libera cuando terminan las búsquedas que la usan.
+                self._snapshot = SnapshotDirectory(path)
+                logger.info(f"Snapshot de directorio generación {self._snapshot.generation} en uso ({path}).")
+            return self._snapshot
+
+
+_store: SnapshotStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_directory() -> SnapshotDirectory:
+    """Snapshot vigente del proceso, compartido por todas las herramientas."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SnapshotStore()
+    return _store.current()
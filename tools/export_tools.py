@@ -0,0 +1,242 @@
+import os
+import csv
+import gzip
+import json
+import logging
+from datetime import datetime
+from typing import Callable, Iterator
+
+from dotenv import load_dotenv
+from ldap3 import Connection, SUBTREE
+from langchain_core.tools import tool
+import ldap3.core.exceptions
+
+from ldap_backend import open_connection
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
+LDAP_USERS_BASE_DN = os.getenv("LDAP_USERS_BASE_DN")
+LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
+
+# Directorio donde se escriben los volcados. Los datos nunca pasan por el LLM:
+# la herramienta solo devuelve la ruta del archivo y la cantidad de filas.
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'exports')))
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+EXPORT_PROGRESS_EVERY = int(os.getenv("EXPORT_PROGRESS_EVERY", "1000"))
+
+EXPORT_FORMATS = ("jsonl", "csv")
+DEFAULT_EXPORT_ATTRIBUTES = ["uid", "mail", "title", "telephoneNumber"]
+# Pseudo-atributo que activa el cruce con la base de grupos.
+GROUPS_PSEUDO_ATTRIBUTE = "groups"
+# Separador para atributos multivaluados en CSV.
+CSV_MULTIVALUE_SEPARATOR = "|"
+
+
+def _decode_value(value):
+    """Convierte bytes (o listas de bytes) devueltos por LDAP a texto."""
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return str(value)
+    if isinstance(value, (list, tuple)):
+        return [_decode_value(item) for item in value]
+    return value
+
+
+def _collapse_value(value):
+    """Devuelve un escalar para atributos de un solo valor y None para atributos ausentes."""
+    if isinstance(value, list):
+        if not value:
+            return None
+        if len(value) == 1:
+            return value[0]
+    return value
+
+
+def _open_export_connection() -> Connection:
+    conn = open_connection()
+    if not conn.bound:
+        raise ldap3.core.exceptions.LDAPBindError(f"No se pudo realizar el bind para la exportación. DN: {LDAP_BIND_DN}.")
+    return conn
+
+
+def _paged_entries(conn: Connection, search_base: str, search_filter: str,
+                   attributes: list[str], page_size: int) -> Iterator[tuple[str, dict]]:
+    """Itera (dn, atributos) página a página sin materializar el resultado completo."""
+    for response in conn.extend.standard.paged_search(
+        search_base=search_base,
+        search_filter=search_filter,
+        search_scope=SUBTREE,
+        attributes=attributes,
+        paged_size=page_size,
+        generator=True
+    ):
+        if response.get('type') != 'searchResEntry':
+            continue
+        yield response['dn'], response.get('attributes', {})
+
+
+def _load_group_memberships(conn: Connection, page_size: int) -> dict[str, list[str]]:
+    """
+    Construye el índice DN de miembro -> nombres de grupo recorriendo la base de grupos una vez.
+    Su tamaño depende de la cantidad de membresías, no de la cantidad de usuarios exportados.
+    """
+    memberships: dict[str, list[str]] = {}
+    for _, attrs in _paged_entries(conn, LDAP_GROUPS_BASE_DN, '(objectClass=groupOfNames)', ['cn', 'member'], page_size):
+        cn = _decode_value(attrs.get('cn'))
+        if isinstance(cn, list):
+            cn = cn[0] if cn else None
+        if not cn:
+            continue
+        members = _decode_value(attrs.get('member', []))
+        if not isinstance(members, list):
+            members = [members]
+        for member_dn in members:
+            memberships.setdefault(str(member_dn).lower(), []).append(cn)
+    return memberships
+
+
+def _iter_export_rows(conn: Connection, attributes: list[str], include_groups: bool,
+                      search_filter: str, page_size: int) -> Iterator[dict]:
+    memberships = _load_group_memberships(conn, page_size) if include_groups else {}
+    for dn, attrs in _paged_entries(conn, LDAP_USERS_BASE_DN, search_filter, attributes, page_size):
+        row = {"dn": dn}
+        for attr in attributes:
+            row[attr] = _collapse_value(_decode_value(attrs.get(attr)))
+        if include_groups:
+            row[GROUPS_PSEUDO_ATTRIBUTE] = memberships.get(dn.lower(), [])
+        yield row
+
+
+def _csv_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return CSV_MULTIVALUE_SEPARATOR.join(str(item) for item in value)
+    return str(value)
+
+
+def _default_export_path(output_format: str, compress: bool) -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    suffix = f".{output_format}.gz" if compress else f".{output_format}"
+    return os.path.join(EXPORT_DIR, f"directory_export_{timestamp}{suffix}")
+
+
+def export_directory(
+    attributes: list[str] | None = None,
+    output_format: str = "jsonl",
+    output_path: str | None = None,
+    include_groups: bool = False,
+    compress: bool = False,
+    search_filter: str = '(objectClass=inetOrgPerson)',
+    page_size: int = EXPORT_PAGE_SIZE,
+    progress_every: int = EXPORT_PROGRESS_EVERY,
+    progress_callback: Callable[[int], None] | None = None,
+) -> dict:
+    """
+    Vuelca los usuarios del directorio a un archivo JSONL o CSV (opcionalmente gzip)
+    usando búsquedas paginadas, escribiendo cada fila apenas llega.
+    Devuelve un diccionario con la ruta del archivo, el formato y la cantidad de filas.
+    """
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError(f"Formato de exportación no soportado: '{output_format}'. Usa uno de {EXPORT_FORMATS}.")
+
+    attributes = [attr for attr in (attributes or DEFAULT_EXPORT_ATTRIBUTES) if attr != GROUPS_PSEUDO_ATTRIBUTE]
+    output_path = os.path.abspath(output_path or _default_export_path(output_format, compress))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    # Se escribe a un archivo temporal y se renombra al final para no dejar volcados a medias.
+    tmp_path = f"{output_path}.partial"
+    opener = gzip.open if compress else open
+    rows = 0
+    conn = None
+    try:
+        conn = _open_export_connection()
+        with opener(tmp_path, 'wt', encoding='utf-8', newline='') as fh:
+            columns = ["dn"] + attributes + ([GROUPS_PSEUDO_ATTRIBUTE] if include_groups else [])
+            csv_writer = None
+            if output_format == "csv":
+                csv_writer = csv.writer(fh)
+                csv_writer.writerow(columns)
+
+            for row in _iter_export_rows(conn, attributes, include_groups, search_filter, page_size):
+                if csv_writer:
+                    csv_writer.writerow([_csv_cell(row.get(column)) for column in columns])
+                else:
+                    fh.write(json.dumps(row, ensure_ascii=False, default=str))
+                    fh.write("\n")
+                rows += 1
+                if progress_every and rows % progress_every == 0:
+                    logger.info(f"Exportación en curso: {rows} filas escritas en {output_path}.")
+                    if progress_callback:
+                        progress_callback(rows)
+
+        os.replace(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if conn and conn.bound:
+            conn.unbind()
+
+    if progress_callback:
+        progress_callback(rows)
+    return {"path": output_path, "format": output_format, "compressed": compress, "rows": rows}
+
+
+def parse_export_spec(spec: str | None) -> dict:
+    """
+    Interpreta la especificación textual de la herramienta de exportación, por ejemplo
+    "mail,title,telephoneNumber,groups csv gzip". Las palabras 'jsonl', 'csv' y 'gzip'
+    son opciones; 'groups' activa el cruce de membresías; el resto son atributos.
+    """
+    options = {"attributes": [], "output_format": "jsonl", "include_groups": False, "compress": False}
+    if not spec or spec.strip().lower() == "ninguno":
+        options["attributes"] = list(DEFAULT_EXPORT_ATTRIBUTES)
+        return options
+
+    for token in spec.replace(';', ',').replace(' ', ',').split(','):
+        token = token.strip()
+        if not token:
+            continue
+        lowered = token.lower()
+        if lowered in EXPORT_FORMATS:
+            options["output_format"] = lowered
+        elif lowered in ("gzip", "gz"):
+            options["compress"] = True
+        elif lowered == GROUPS_PSEUDO_ATTRIBUTE:
+            options["include_groups"] = True
+        elif token not in options["attributes"]:
+            options["attributes"].append(token)
+
+    if not options["attributes"]:
+        options["attributes"] = list(DEFAULT_EXPORT_ATTRIBUTES)
+    return options
+
+
+@tool
+def export_directory_tool(spec: str | None = None) -> dict:
+    """
+    Exporta en bloque todos los usuarios del dominio a un archivo (JSONL o CSV) y devuelve solo la ruta y la cantidad de filas.
+    Usar para auditorías o volcados completos (ej. 'exporta todos los usuarios con mail, title y grupos').
+    El argumento es una lista de atributos separados por comas; 'groups' agrega las membresías,
+    'csv' o 'jsonl' eligen el formato y 'gzip' comprime el archivo.
+    """
+    try:
+        options = parse_export_spec(spec)
+        return export_directory(**options)
+    except ldap3.core.exceptions.LDAPSocketOpenError as e:
+        return {"error": f"Error de conexión LDAP para export_directory_tool: {e}"}
+    except ldap3.core.exceptions.LDAPBindError as e:
+        return {"error": f"Error de autenticación LDAP para export_directory_tool: {e}"}
+    except Exception as e:
+        logger.error(f"Error inesperado en export_directory_tool: {e}", exc_info=True)
+        return {"error": f"Ocurrió un error inesperado al exportar el directorio: {e}"}
@@ -0,0 +1,134 @@
+import os
+import re
+
+
+# Longitud mínima del prefijo fijo en búsquedas con comodín: evita que un valor como "*"
+# (por ejemplo extraído por el LLM) dispare un recorrido completo del directorio.
+MIN_WILDCARD_PREFIX = int(os.getenv("FILTER_MIN_WILDCARD_PREFIX", "3"))
+
+_ATTRIBUTE_RE = re.compile(r"^(?:[A-Za-z][A-Za-z0-9-]*|\d+(?:\.\d+)+)(?:;[A-Za-z0-9-]+)*$")
+
+# RFC 4515: estos caracteres deben escaparse como \XX dentro de un valor de filtro.
+_ESCAPES = {
+    "\\": r"\5c",
+    "*": r"\2a",
+    "(": r"\28",
+    ")": r"\29",
+    "\x00": r"\00",
+}
+
+
+class FilterBuilderError(ValueError):
+    """Valor o atributo que no puede usarse para construir un filtro seguro."""
+
+
+def escape_filter_value(value) -> str:
+    """Escapa un valor para incluirlo literalmente en un filtro LDAP (RFC 4515)."""
+    if isinstance(value, bytes):
+        return "".join(f"\\{byte:02x}" for byte in value)
+    return "".join(_ESCAPES.get(char, char) for char in str(value))
+
+
+def _check_attribute(attr: str) -> str:
+    attr = (attr or "").strip()
+    if not _ATTRIBUTE_RE.match(attr):
+        raise FilterBuilderError(f"Nombre de atributo inválido para un filtro LDAP: '{attr}'.")
+    return attr
+
+
+def _check_value(value) -> str:
+    if value is None:
+        raise FilterBuilderError("El valor del filtro no puede ser vacío.")
+    value = value.strip() if isinstance(value, str) else value
+    if value == "" or (isinstance(value, str) and value.lower() == "ninguno"):
+        raise FilterBuilderError("El valor del filtro no puede ser vacío.")
+    return value
+
+
+def eq(attr: str, value) -> str:
+    """Igualdad exacta: '(attr=valor)' con el valor escapado (un '*' se busca literalmente)."""
+    return f"({_check_attribute(attr)}={escape_filter_value(_check_value(value))})"
+
+
+def presence(attr: str) -> str:
+    """Presencia: '(attr=*)'."""
+    return f"({_check_attribute(attr)}=*)"
+
+
+def prefix(attr: str, value, min_prefix: int = MIN_WILDCARD_PREFIX) -> str:
+    """
+    Búsqueda anclada al inicio: '(attr=valor*)'. Rechaza prefijos más cortos que 'min_prefix'
+    porque equivalen en la práctica a un recorrido del directorio completo.
+    """
+    value = _check_value(value)
+    if isinstance(value, str):
+        value = value.rstrip("*")
+    if len(value) < min_prefix:
+        raise FilterBuilderError(
+            f"La búsqueda por prefijo requiere al menos {min_prefix} caracteres fijos (recibido: '{value}')."
+        )
+    return f"({_check_attribute(attr)}={escape_filter_value(value)}*)"
+
+
+def _combine(operator: str, filters) -> str:
+    parts = []
+    for item in filters:
+        if not item:
+            continue
+        item = item.strip()
+        # Aplana (&(&(a)(b))(c)) -> (&(a)(b)(c)) cuando el sub-filtro usa el mismo operador.
+        if item.startswith(f"({operator}") and _is_flat_group(item):
+            parts.extend(_split_group(item))
+        else:
+            parts.append(item)
+    if not parts:
+        raise FilterBuilderError(f"El operador '{operator}' requiere al menos un sub-filtro.")
+    # Orden canónico y sin duplicados: filtros equivalentes producen el mismo texto (y la misma clave de caché).
+    unique = sorted(set(parts), key=str.lower)
+    if len(unique) == 1:
+        return unique[0]
+    return f"({operator}{''.join(unique)})"
+
+
+def _is_flat_group(item: str) -> bool:
+    depth = 0
+    for index, char in enumerate(item):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0 and index != len(item) - 1:
+                return False
+    return depth == 0
+
+
+def _split_group(item: str) -> list[str]:
+    body = item[2:-1]
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(body):
+        if char == "(":
+            if depth == 0:
+                start = index
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                parts.append(body[start:index + 1])
+    return parts
+
+
+def and_(*filters: str) -> str:
+    """Conjunción de filtros ya construidos con este módulo."""
+    return _combine("&", filters)
+
+
+def or_(*filters: str) -> str:
+    """Disyunción de filtros ya construidos con este módulo."""
+    return _combine("|", filters)
+
+
+def not_(filter_text: str) -> str:
+    """Negación de un filtro ya construido con este módulo."""
+    if not filter_text:
+        raise FilterBuilderError("El operador '!' requiere un sub-filtro.")
+    return f"(!{filter_text.strip()})"
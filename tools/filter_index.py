@@ -0,0 +1,131 @@
+import os
+from bisect import bisect_left
+
+from ldap_filter import IndexLookup, IndexAnd, IndexOr
+
+
+# Atributos indexados por defecto: los que usan los filtros de las herramientas estáticas y generadas.
+DEFAULT_INDEXED_ATTRIBUTES = (
+    "objectclass,uid,cn,mail,member,uniquemember,memberuid,sn,givenname,"
+    "title,uidnumber,gidnumber,ou,telephonenumber"
+)
+INDEXED_ATTRIBUTES = {
+    attr.strip().lower()
+    for attr in os.getenv("LDIF_INDEXED_ATTRIBUTES", DEFAULT_INDEXED_ATTRIBUTES).split(",")
+    if attr.strip()
+}
+
+
+class DirectoryIndex:
+    """
+    Índices invertidos sobre entradas identificadas por enteros:
+    igualdad (valor -> ids), presencia (atributo -> ids) y valores ordenados para prefijos.
+    """
+
+    def __init__(self, indexed_attributes: set[str] | None = None):
+        self.indexed_attributes = set(indexed_attributes if indexed_attributes is not None else INDEXED_ATTRIBUTES)
+        self._equality: dict[str, dict[str, set[int]]] = {}
+        self._presence: dict[str, set[int]] = {}
+        # Valores distintos ordenados por atributo; se reconstruyen solo cuando cambian.
+        self._sorted_values: dict[str, list[str]] = {}
+        self._all_ids: set[int] = set()
+
+    def add(self, record_id: int, normalized: dict[str, list]) -> None:
+        self._all_ids.add(record_id)
+        for attr, values in normalized.items():
+            if attr not in self.indexed_attributes:
+                continue
+            self._presence.setdefault(attr, set()).add(record_id)
+            postings = self._equality.setdefault(attr, {})
+            for value in values:
+                if value not in postings:
+                    postings[value] = set()
+                    self._sorted_values.pop(attr, None)
+                postings[value].add(record_id)
+
+    def remove(self, record_id: int, normalized: dict[str, list]) -> None:
+        self._all_ids.discard(record_id)
+        for attr, values in normalized.items():
+            if attr not in self.indexed_attributes:
+                continue
+            self._presence.get(attr, set()).discard(record_id)
+            postings = self._equality.get(attr, {})
+            for value in values:
+                ids = postings.get(value)
+                if ids is None:
+                    continue
+                ids.discard(record_id)
+                if not ids:
+                    del postings[value]
+                    self._sorted_values.pop(attr, None)
+
+    def _sorted(self, attr: str) -> list[str]:
+        values = self._sorted_values.get(attr)
+        if values is None:
+            values = sorted(self._equality.get(attr, {}))
+            self._sorted_values[attr] = values
+        return values
+
+    def _lookup(self, plan: IndexLookup) -> set[int] | None:
+        if plan.attr not in self.indexed_attributes:
+            return None
+        if plan.kind == "eq":
+            return self._equality.get(plan.attr, {}).get(plan.value, set())
+        if plan.kind == "presence":
+            return self._all_ids if plan.attr == "objectclass" else self._presence.get(plan.attr, set())
+        if plan.kind == "prefix":
+            postings = self._equality.get(plan.attr, {})
+            values = self._sorted(plan.attr)
+            result: set[int] = set()
+            position = bisect_left(values, plan.value)
+            while position < len(values) and values[position].startswith(plan.value):
+                result |= postings[values[position]]
+                position += 1
+            return result
+        return None
+
+    def _estimate(self, plan) -> int:
+        """Costo estimado sin materializar: tamaño de la lista de postings (o del universo si no se sabe)."""
+        if isinstance(plan, IndexLookup) and plan.kind == "eq" and plan.attr in self.indexed_attributes:
+            return len(self._equality.get(plan.attr, {}).get(plan.value, ()))
+        if isinstance(plan, IndexLookup) and plan.kind == "presence" and plan.attr in self.indexed_attributes:
+            return len(self._presence.get(plan.attr, ()))
+        return len(self._all_ids)
+
+    def candidates(self, plan) -> tuple[set[int] | None, bool]:
+        """
+        Ejecuta un plan. Devuelve (ids candidatos o None si hace falta recorrer el ámbito,
+        cubierto), donde 'cubierto' indica que todos los atributos del plan estaban indexados.
+        Los conjuntos devueltos pueden ser los del índice: no deben modificarse.
+        """
+        if isinstance(plan, IndexLookup):
+            ids = self._lookup(plan)
+            return ids, ids is not None
+
+        if isinstance(plan, IndexAnd):
+            # Intersección empezando por la lista más chica: el costo queda acotado por el resultado.
+            covered = True
+            result = None
+            for child in sorted(plan.children, key=self._estimate):
+                ids, child_covered = self.candidates(child)
+                if ids is None:
+                    covered = False
+                    continue
+                covered = covered and child_covered
+                result = set(ids) if result is None else result.intersection(ids)
+                if not result:
+                    break
+            return result, covered and result is not None
+
+        if isinstance(plan, IndexOr):
+            result = set()
+            covered = True
+            for child in plan.children:
+                ids, child_covered = self.candidates(child)
+                if ids is None:
+                    return None, False
+                result |= ids
+                covered = covered and child_covered
+            return result, covered
+
+        return None, False
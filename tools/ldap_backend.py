@@ -0,0 +1,63 @@
+import os
+import logging
+
+from dotenv import load_dotenv
+from ldap3 import Server, Connection, ALL_ATTRIBUTES
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_HOST = os.getenv("LDAP_HOST")
+LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
+LDAP_BIND_PASSWORD = os.getenv("LDAP_BIND_PASSWORD")
+# Varios nodos (primario y réplicas de lectura) separados por comas: las lecturas se reparten
+# por latencia con circuit breaker y cobertura (ver ldap_replicas.py). Con el backend LDIF,
+# LDAP_MOCK_REPLICAS simula varios nodos con demoras y fallos inyectados.
+LDAP_HOSTS = os.getenv("LDAP_HOSTS", "").strip()
+LDAP_MOCK_REPLICAS = os.getenv("LDAP_MOCK_REPLICAS", "").strip()
+
+# Backend de directorio: "ldap" (servidor real, por defecto), "ldif" (archivos LDIF en memoria,
+# sin red) o "snapshot" (snapshot inmutable mapeado en memoria, compartido entre procesos; ver
+# directory_snapshot.py). Con "ldif" se leen los archivos de LDAP_LDIF_FILES o, si no está
+# definida, los de users_groups/.
+LDAP_BACKEND = os.getenv("LDAP_BACKEND", "ldap").strip().lower()
+SUPPORTED_BACKENDS = ("ldap", "ldif", "snapshot")
+
+if LDAP_BACKEND not in SUPPORTED_BACKENDS:
+    logger.warning(f"LDAP_BACKEND '{LDAP_BACKEND}' no soportado. Se usará 'ldap'. Opciones: {SUPPORTED_BACKENDS}.")
+    LDAP_BACKEND = "ldap"
+
+
+def uses_network_backend() -> bool:
+    """Indica si las herramientas hablan con un servidor LDAP real (y necesitan LDAP_HOST o LDAP_HOSTS)."""
+    return LDAP_BACKEND == "ldap"
+
+
+def open_connection(backend: str | None = None):
+    """
+    Abre una conexión ya vinculada contra el backend configurado (o contra 'backend').
+    Devuelve un ldap3.Connection o un LdifConnection con la misma interfaz de búsqueda.
+    """
+    backend = backend or LDAP_BACKEND
+    if backend == "snapshot":
+        from ldif_backend import LdifConnection
+        from directory_snapshot import get_snapshot_directory
+        return LdifConnection(get_snapshot_directory(), user=LDAP_BIND_DN)
+
+    if backend == "ldif":
+        if LDAP_MOCK_REPLICAS:
+            from ldap_replicas import ReplicaConnection, get_replica_set
+            return ReplicaConnection(get_replica_set(mock=True))
+        from ldif_backend import LdifConnection, get_ldif_directory
+        return LdifConnection(get_ldif_directory(), user=LDAP_BIND_DN)
+
+    if LDAP_HOSTS:
+        from ldap_replicas import ReplicaConnection, get_replica_set
+        return ReplicaConnection(get_replica_set())
+
+    server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
+    return Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
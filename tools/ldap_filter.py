@@ -0,0 +1,288 @@
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+
+# --- AST de filtros LDAP (RFC 4515) ---
+
+class And(NamedTuple):
+    children: tuple
+
+
+class Or(NamedTuple):
+    children: tuple
+
+
+class Not(NamedTuple):
+    child: object
+
+
+class Equality(NamedTuple):
+    attr: str
+    value: str
+
+
+class Presence(NamedTuple):
+    attr: str
+
+
+class Substring(NamedTuple):
+    attr: str
+    initial: str | None
+    any: tuple
+    final: str | None
+
+
+class GreaterOrEqual(NamedTuple):
+    attr: str
+    value: str
+
+
+class LessOrEqual(NamedTuple):
+    attr: str
+    value: str
+
+
+class LdapFilterError(ValueError):
+    """Filtro LDAP mal formado."""
+
+
+# --- Planes de evaluación sobre índices ---
+
+class IndexLookup(NamedTuple):
+    kind: str          # "eq", "presence" o "prefix"
+    attr: str          # nombre de atributo en minúsculas
+    value: str | None  # valor ya normalizado (None para presencia)
+
+
+class IndexAnd(NamedTuple):
+    children: tuple
+
+
+class IndexOr(NamedTuple):
+    children: tuple
+
+
+class CompiledFilter(NamedTuple):
+    text: str
+    ast: object
+    plan: object   # IndexLookup / IndexAnd / IndexOr, o None si requiere recorrer el ámbito completo
+    exact: bool    # True si los candidatos del plan son exactamente el resultado (sin re-verificar)
+
+
+FILTER_PLAN_CACHE_SIZE = int(os.getenv("FILTER_PLAN_CACHE_SIZE", "1024"))
+
+
+# Atributos cuyos valores son DNs y se comparan normalizados (sin espacios alrededor de ',' y '=').
+DN_ATTRIBUTES = {"member", "uniquemember", "owner", "manager", "seealso", "distinguishedname"}
+
+_ESCAPE_RE = re.compile(r"\\([0-9a-fA-F]{2})")
+_DN_SPACES_RE = re.compile(r"\s*([,=+])\s*")
+
+
+def unescape_value(raw: str) -> str:
+    """Deshace los escapes '\\XX' de un valor de filtro."""
+    if "\\" not in raw:
+        return raw
+    data = bytearray()
+    pos = 0
+    for match in _ESCAPE_RE.finditer(raw):
+        data += raw[pos:match.start()].encode('utf-8')
+        data.append(int(match.group(1), 16))
+        pos = match.end()
+    data += raw[pos:].encode('utf-8')
+    return data.decode('utf-8', errors='replace')
+
+
+def normalize_dn(dn: str) -> str:
+    return _DN_SPACES_RE.sub(r"\1", dn.strip()).lower()
+
+
+def normalize_value(attr: str, value) -> str:
+    """Normaliza un valor para comparaciones sin distinguir mayúsculas (y DNs sin espacios)."""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    value = str(value)
+    if attr.lower() in DN_ATTRIBUTES:
+        return normalize_dn(value)
+    return value.strip().lower()
+
+
+def _split_components(body: str, position: int) -> list[str]:
+    """Separa los sub-filtros '(..)(..)' de un '&' o '|' respetando el anidamiento."""
+    components = []
+    depth = 0
+    start = None
+    for index, char in enumerate(body):
+        if char == '(':
+            if depth == 0:
+                start = index
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                raise LdapFilterError(f"Paréntesis desbalanceados cerca de la posición {position + index}.")
+            if depth == 0:
+                components.append(body[start:index + 1])
+        elif depth == 0 and not char.isspace():
+            raise LdapFilterError(f"Texto inesperado '{char}' en la posición {position + index}.")
+    if depth != 0:
+        raise LdapFilterError("Paréntesis desbalanceados en el filtro.")
+    return components
+
+
+def _parse_item(body: str):
+    index = body.find("=")
+    if index <= 0:
+        raise LdapFilterError(f"Componente de filtro sin operador o sin atributo: '({body})'.")
+    prefix = body[index - 1]
+    value = body[index + 1:]
+    if prefix in "><~":
+        attr = body[:index - 1].strip()
+        node_type = {">": GreaterOrEqual, "<": LessOrEqual, "~": Equality}[prefix]
+        return node_type(attr, unescape_value(value))
+
+    attr = body[:index].strip()
+    if not attr:
+        raise LdapFilterError(f"Componente de filtro sin atributo: '({body})'.")
+
+    if value == "*":
+        return Presence(attr)
+    if "*" in value:
+        parts = value.split("*")
+        initial = unescape_value(parts[0]) or None
+        final = unescape_value(parts[-1]) or None
+        middle = tuple(unescape_value(part) for part in parts[1:-1] if part)
+        return Substring(attr, initial, middle, final)
+    return Equality(attr, unescape_value(value))
+
+
+def _parse(text: str, position: int = 0):
+    text = text.strip()
+    if not (text.startswith('(') and text.endswith(')')):
+        raise LdapFilterError(f"El filtro debe estar entre paréntesis: '{text}'.")
+    body = text[1:-1].strip()
+    if not body:
+        raise LdapFilterError("Filtro vacío.")
+
+    operator = body[0]
+    if operator in "&|":
+        children = tuple(_parse(component, position + 1) for component in _split_components(body[1:], position + 1))
+        if not children:
+            raise LdapFilterError(f"El operador '{operator}' requiere al menos un sub-filtro.")
+        return And(children) if operator == "&" else Or(children)
+    if operator == "!":
+        components = _split_components(body[1:], position + 1)
+        if len(components) != 1:
+            raise LdapFilterError("El operador '!' requiere exactamente un sub-filtro.")
+        return Not(_parse(components[0], position + 1))
+    return _parse_item(body)
+
+
+def parse_filter(text: str):
+    """Convierte un filtro LDAP textual en su AST. Lanza LdapFilterError si es inválido."""
+    if not text or not text.strip():
+        raise LdapFilterError("Filtro vacío.")
+    text = text.strip()
+    if not text.startswith('('):
+        text = f"({text})"
+    return _parse(text)
+
+
+def _plan(node) -> tuple[object, bool]:
+    """Traduce el AST a un plan sobre índices. Devuelve (plan o None, exacto)."""
+    if isinstance(node, Equality):
+        return IndexLookup("eq", node.attr.lower(), normalize_value(node.attr, node.value)), True
+    if isinstance(node, Presence):
+        return IndexLookup("presence", node.attr.lower(), None), True
+    if isinstance(node, Substring) and node.initial:
+        exact = not node.any and node.final is None
+        return IndexLookup("prefix", node.attr.lower(), normalize_value(node.attr, node.initial)), exact
+    if isinstance(node, And):
+        planned = [_plan(child) for child in node.children]
+        usable = tuple(plan for plan, _ in planned if plan is not None)
+        if not usable:
+            return None, False
+        exact = all(plan is not None and exact for plan, exact in planned)
+        return (usable[0] if len(usable) == 1 else IndexAnd(usable)), exact
+    if isinstance(node, Or):
+        planned = [_plan(child) for child in node.children]
+        if any(plan is None for plan, _ in planned):
+            return None, False
+        exact = all(exact for _, exact in planned)
+        return IndexOr(tuple(plan for plan, _ in planned)), exact
+    # NOT y comparaciones de orden se resuelven verificando candidatos o recorriendo el ámbito.
+    return None, False
+
+
+@lru_cache(maxsize=FILTER_PLAN_CACHE_SIZE)
+def _compile(text: str) -> CompiledFilter:
+    ast = parse_filter(text)
+    plan, exact = _plan(ast)
+    return CompiledFilter(text, ast, plan, exact)
+
+
+def compile_filter(text: str) -> CompiledFilter:
+    """Parsea y planifica un filtro. Los planes se memorizan por texto de filtro."""
+    if not text or not text.strip():
+        raise LdapFilterError("Filtro vacío.")
+    return _compile(text.strip())
+
+
+def _values_for(attributes: dict, attr: str) -> list:
+    return attributes.get(attr.lower(), [])
+
+
+def _substring_matches(node: Substring, value: str) -> bool:
+    position = 0
+    if node.initial is not None:
+        initial = normalize_value(node.attr, node.initial)
+        if not value.startswith(initial):
+            return False
+        position = len(initial)
+    for fragment in node.any:
+        fragment = normalize_value(node.attr, fragment)
+        found = value.find(fragment, position)
+        if found < 0:
+            return False
+        position = found + len(fragment)
+    if node.final is not None:
+        final = normalize_value(node.attr, node.final)
+        return len(value) - len(final) >= position and value.endswith(final)
+    return True
+
+
+def _ordering_key(value: str) -> tuple:
+    """Compara numéricamente los valores enteros (ej. uidNumber) y el resto como texto."""
+    try:
+        return (0, int(value), "")
+    except ValueError:
+        return (1, 0, value)
+
+
+def matches(node, attributes: dict) -> bool:
+    """
+    Evalúa el AST sobre una entrada. 'attributes' mapea nombres de atributo en minúsculas
+    a listas de valores ya normalizados con normalize_value.
+    """
+    if isinstance(node, And):
+        return all(matches(child, attributes) for child in node.children)
+    if isinstance(node, Or):
+        return any(matches(child, attributes) for child in node.children)
+    if isinstance(node, Not):
+        return not matches(node.child, attributes)
+    if isinstance(node, Presence):
+        return node.attr.lower() == "objectclass" or bool(_values_for(attributes, node.attr))
+    if isinstance(node, Equality):
+        expected = normalize_value(node.attr, node.value)
+        return expected in _values_for(attributes, node.attr)
+    if isinstance(node, Substring):
+        return any(_substring_matches(node, value) for value in _values_for(attributes, node.attr))
+    if isinstance(node, GreaterOrEqual):
+        expected = _ordering_key(normalize_value(node.attr, node.value))
+        return any(_ordering_key(value) >= expected for value in _values_for(attributes, node.attr))
+    if isinstance(node, LessOrEqual):
+        expected = _ordering_key(normalize_value(node.attr, node.value))
+        return any(_ordering_key(value) <= expected for value in _values_for(attributes, node.attr))
+    raise LdapFilterError(f"Nodo de filtro desconocido: {node!r}")
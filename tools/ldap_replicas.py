@@ -0,0 +1,436 @@
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+
+from dotenv import load_dotenv
+from ldap3 import Server, Connection, ALL_ATTRIBUTES, SUBTREE
+from ldap3.core.exceptions import (
+    LDAPSocketOpenError, LDAPCommunicationError, LDAPResponseTimeoutError, LDAPStartTLSError,
+    LDAPBusyResult, LDAPUnavailableResult,
+)
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
+
+LDAP_HOST = os.getenv("LDAP_HOST")
+LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
+LDAP_BIND_PASSWORD = os.getenv("LDAP_BIND_PASSWORD")
+
+# Nodos LDAP separados por comas: el primario primero y luego las réplicas de lectura.
+# Sin LDAP_HOSTS se usa LDAP_HOST como único nodo.
+LDAP_HOSTS = [host.strip() for host in os.getenv("LDAP_HOSTS", "").split(",") if host.strip()]
+LDAP_CONNECT_TIMEOUT = float(os.getenv("LDAP_CONNECT_TIMEOUT", "5"))
+LDAP_RECEIVE_TIMEOUT = float(os.getenv("LDAP_RECEIVE_TIMEOUT", "10"))
+# Latencia por nodo: media móvil exponencial de las búsquedas exitosas.
+LDAP_LATENCY_EWMA_ALPHA = float(os.getenv("LDAP_LATENCY_EWMA_ALPHA", "0.3"))
+# Circuit breaker: fallos seguidos para abrir el circuito y segundos hasta la prueba (half-open).
+LDAP_FAILURE_THRESHOLD = int(os.getenv("LDAP_FAILURE_THRESHOLD", "3"))
+LDAP_COOLDOWN = float(os.getenv("LDAP_COOLDOWN", "30"))
+# Búsqueda de cobertura en el siguiente nodo si la primera tarda más de
+# max(LDAP_HEDGE_MIN_MS, LDAP_HEDGE_MULTIPLIER × latencia media del nodo). 0 desactiva la cobertura.
+LDAP_HEDGE_MULTIPLIER = float(os.getenv("LDAP_HEDGE_MULTIPLIER", "3"))
+LDAP_HEDGE_MIN_MS = float(os.getenv("LDAP_HEDGE_MIN_MS", "50"))
+LDAP_REPLICA_MAX_WORKERS = int(os.getenv("LDAP_REPLICA_MAX_WORKERS", "16"))
+# Réplicas simuladas sobre el backend LDIF, para pruebas: "nombre:delay=0.01,jitter=0.05,error_rate=0.2;otro:..."
+LDAP_MOCK_REPLICAS = os.getenv("LDAP_MOCK_REPLICAS", "")
+
+
+class ReplicaUnavailableError(LDAPSocketOpenError):
+    """Ningún nodo LDAP disponible respondió la búsqueda."""
+
+
+# Errores que indican un nodo caído o saturado. Los demás (filtro inválido, atributo desconocido...)
+# son de la petición: fallarían igual en cualquier réplica, así que no abren el circuito ni se reintentan.
+NODE_FAILURE_ERRORS = (
+    LDAPCommunicationError, LDAPResponseTimeoutError, LDAPStartTLSError, LDAPBusyResult, LDAPUnavailableResult,
+    TimeoutError, ConnectionError,
+)
+
+
+def is_node_failure(error: BaseException) -> bool:
+    return isinstance(error, NODE_FAILURE_ERRORS)
+
+
+class Endpoint:
+    """Un nodo LDAP con su latencia medida y su circuit breaker (closed → open → half_open)."""
+
+    def __init__(self, name: str, connect: Callable[[], object], failure_threshold: int = LDAP_FAILURE_THRESHOLD,
+                 cooldown: float = LDAP_COOLDOWN, alpha: float = LDAP_LATENCY_EWMA_ALPHA):
+        self.name = name
+        self.connect = connect
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.latency_ms: float | None = None
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._probe_in_flight = False
+        self.stats = {"searches": 0, "failures": 0, "hedges_won": 0}
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Indica si se le puede enviar una búsqueda; en half_open deja pasar una sola prueba."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self.open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def available(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.monotonic() >= self.open_until
+            return not self._probe_in_flight
+
+    def record_success(self, latency_ms: float | None) -> None:
+        with self._lock:
+            self.stats["searches"] += 1
+            if latency_ms is not None:
+                self.latency_ms = latency_ms if self.latency_ms is None else \
+                    self.alpha * latency_ms + (1 - self.alpha) * self.latency_ms
+            if self.state != "closed":
+                logger.info(f"Nodo LDAP '{self.name}' recuperado.")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """Libera la prueba de half_open sin cambiar el estado: la búsqueda falló por la petición, no por el nodo."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self, error: BaseException) -> None:
+        with self._lock:
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self.state = "open"
+                self.open_until = time.monotonic() + self.cooldown
+                logger.warning(f"Nodo LDAP '{self.name}' fuera de servicio por {self.cooldown:.0f} s "
+                               f"tras {self.consecutive_failures} fallos seguidos: {error}")
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            **self.stats,
+        }
+
+
+class ReplicaSet:
+    """Nodos LDAP ordenados por latencia medida; los que están en circuito abierto se saltean."""
+
+    def __init__(self, endpoints: list[Endpoint], hedge_multiplier: float = LDAP_HEDGE_MULTIPLIER,
+                 hedge_min_ms: float = LDAP_HEDGE_MIN_MS, max_workers: int = LDAP_REPLICA_MAX_WORKERS):
+        if not endpoints:
+            raise ValueError("Se necesita al menos un nodo LDAP.")
+        self.endpoints = endpoints
+        self.hedge_multiplier = hedge_multiplier
+        self.hedge_min_ms = hedge_min_ms
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ldap-replica")
+        self.stats = {"searches": 0, "hedges": 0, "failovers": 0, "rejected": 0}
+
+    def ranked(self) -> list[Endpoint]:
+        """Nodos disponibles, del más rápido al más lento. Los que aún no tienen medición van primero
+        (así se miden), respetando el orden de configuración (el primario antes que las réplicas)."""
+        order = {endpoint.name: index for index, endpoint in enumerate(self.endpoints)}
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.available()]
+        return sorted(candidates, key=lambda endpoint: (endpoint.latency_ms or 0.0, order[endpoint.name]))
+
+    def hedge_delay(self, endpoint: Endpoint) -> float | None:
+        """Segundos a esperar antes de cubrir una búsqueda enviada a 'endpoint' (None: sin cobertura)."""
+        if self.hedge_multiplier <= 0:
+            return None
+        return max(self.hedge_min_ms, self.hedge_multiplier * (endpoint.latency_ms or self.hedge_min_ms)) / 1000
+
+    def status(self) -> list[dict]:
+        return [endpoint.status() for endpoint in self.endpoints]
+
+
+class _ReplicaStandardExtend:
+    def __init__(self, connection: "ReplicaConnection"):
+        self._connection = connection
+
+    def paged_search(self, search_base, search_filter, search_scope=SUBTREE, attributes=None,
+                     paged_size=100, generator=True, **kwargs):
+        # La paginación queda atada a un nodo (la cookie es del servidor): sin cobertura ni failover.
+        items = self._connection._paged_search(search_base, search_filter, search_scope, attributes, paged_size, **kwargs)
+        return items if generator else list(items)
+
+
+class _ReplicaExtend:
+    def __init__(self, connection: "ReplicaConnection"):
+        self.standard = _ReplicaStandardExtend(connection)
+
+
+class ReplicaConnection:
+    """
+    Conexión con la interfaz de ldap3.Connection que usan las herramientas (bound, search, entries,
+    response, extend.standard.paged_search, unbind) y reparte cada búsqueda entre los nodos de un
+    ReplicaSet. Envía la búsqueda al nodo más rápido y, si tarda más que su umbral de cobertura,
+    la repite en el siguiente y se queda con la primera respuesta. Si un nodo falla, pasa al
+    siguiente. Las conexiones por nodo se abren al primer uso y se reutilizan hasta unbind().
+    """
+
+    def __init__(self, replica_set: ReplicaSet):
+        self.replica_set = replica_set
+        self.bound = True
+        self.entries: list = []
+        self.response: list = []
+        self.result: dict = {}
+        self.extend = _ReplicaExtend(self)
+        self._idle: dict[str, object] = {}
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def bind(self) -> bool:
+        self.bound = True
+        return True
+
+    def unbind(self) -> bool:
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+        for conn in idle.values():
+            _close_quietly(conn)
+        self.bound = False
+        return True
+
+    def _checkout(self, endpoint: Endpoint):
+        with self._lock:
+            conn = self._idle.pop(endpoint.name, None)
+        return conn if conn is not None else endpoint.connect()
+
+    def _checkin(self, endpoint: Endpoint, conn) -> None:
+        with self._lock:
+            if not self._closed and endpoint.name not in self._idle:
+                self._idle[endpoint.name] = conn
+                return
+        _close_quietly(conn)
+
+    def _search_on(self, endpoint: Endpoint, args: tuple, kwargs: dict):
+        start = time.perf_counter()
+        conn = None
+        try:
+            conn = self._checkout(endpoint)
+            found = conn.search(*args, **kwargs)
+        except Exception as e:
+            if not is_node_failure(e):
+                endpoint.release()
+                if conn is not None:
+                    self._checkin(endpoint, conn)
+                raise
+            endpoint.record_failure(e)
+            if conn is not None:
+                _close_quietly(conn)
+            raise
+        endpoint.record_success((time.perf_counter() - start) * 1000)
+        outcome = (found, conn.entries, conn.response, getattr(conn, "result", {}))
+        self._checkin(endpoint, conn)
+        return outcome
+
+    def _candidates(self) -> list[Endpoint]:
+        candidates = self.replica_set.ranked()
+        if not candidates:
+            self.replica_set.stats["rejected"] += 1
+            raise ReplicaUnavailableError("Todos los nodos LDAP están fuera de servicio (circuito abierto).")
+        return candidates
+
+    def search(self, *args, **kwargs) -> bool:
+        replica_set = self.replica_set
+        replica_set.stats["searches"] += 1
+        queue = self._candidates()
+        pending: dict = {}
+        last_error: BaseException | None = None
+
+        def launch():
+            while queue:
+                endpoint = queue.pop(0)
+                if endpoint.acquire():
+                    future = replica_set.executor.submit(self._search_on, endpoint, args, kwargs)
+                    pending[future] = endpoint
+                    return future
+            return None
+
+        if len(queue) == 1 and queue[0].acquire():
+            # Un solo nodo: sin hilos ni cobertura.
+            endpoint = queue.pop()
+            try:
+                outcome = self._search_on(endpoint, args, kwargs)
+            except Exception as e:
+                if not is_node_failure(e):
+                    raise
+                raise ReplicaUnavailableError(f"El nodo LDAP '{endpoint.name}' falló: {e}") from e
+            return self._apply(outcome)
+
+        first = latest = launch()
+        hedge = None
+        while pending:
+            # Se cubre una sola vez por búsqueda, según la latencia del último nodo consultado.
+            timeout = replica_set.hedge_delay(pending[latest]) if hedge is None and queue and latest in pending else None
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge = launch()
+                if hedge is not None:
+                    replica_set.stats["hedges"] += 1
+                    latest = hedge
+                else:
+                    hedge = False
+                continue
+            for future in done:
+                endpoint = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    if hedge and future is not first:
+                        endpoint.stats["hedges_won"] += 1
+                    return self._apply(future.result())
+                if not is_node_failure(error):
+                    # Error de la petición: se devuelve tal cual, sin probar otro nodo.
+                    raise error
+                last_error = error
+                logger.warning(f"Búsqueda en el nodo LDAP '{endpoint.name}' falló: {error}")
+                # Cada búsqueda fallida se reemplaza por la del siguiente nodo, aunque otra siga en curso.
+                replacement = launch()
+                if replacement is not None:
+                    replica_set.stats["failovers"] += 1
+                    latest = replacement
+        if last_error is None:
+            raise ReplicaUnavailableError("Ningún nodo LDAP aceptó la búsqueda (circuito abierto o en prueba).")
+        raise ReplicaUnavailableError(f"Ningún nodo LDAP respondió la búsqueda: {last_error}") from last_error
+
+    def _apply(self, outcome) -> bool:
+        found, self.entries, self.response, self.result = outcome
+        return found
+
+    def _paged_search(self, search_base, search_filter, search_scope, attributes, paged_size, **kwargs):
+        endpoint = next((candidate for candidate in self._candidates() if candidate.acquire()), None)
+        if endpoint is None:
+            raise ReplicaUnavailableError("Ningún nodo LDAP aceptó la búsqueda paginada.")
+        conn = self._checkout(endpoint)
+        try:
+            for item in conn.extend.standard.paged_search(search_base, search_filter, search_scope, attributes=attributes,
+                                                          paged_size=paged_size, generator=True, **kwargs):
+                yield item
+        except Exception as e:
+            if not is_node_failure(e):
+                endpoint.release()
+                self._checkin(endpoint, conn)
+                raise
+            endpoint.record_failure(e)
+            _close_quietly(conn)
+            raise
+        # La duración total depende del tamaño del resultado: se registra el éxito, no la latencia.
+        endpoint.record_success(None)
+        self._checkin(endpoint, conn)
+
+
+def _close_quietly(conn) -> None:
+    try:
+        if getattr(conn, "bound", False):
+            conn.unbind()
+    except Exception:
+        pass
+
+
+# --- Nodos ---
+
+def ldap_endpoint(host: str) -> Endpoint:
+    def connect():
+        server = Server(host, use_ssl=True, get_info=ALL_ATTRIBUTES, connect_timeout=LDAP_CONNECT_TIMEOUT)
+        return Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True,
+                          receive_timeout=LDAP_RECEIVE_TIMEOUT)
+    return Endpoint(host, connect)
+
+
+class FaultyLdifConnection:
+    """LdifConnection con demora y fallos inyectados: simula un nodo LDAP lento o caído."""
+
+    def __init__(self, inner, delay: float, jitter: float, error_rate: float, rng: random.Random, name: str):
+        self._inner = inner
+        self._delay = delay
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._rng = rng
+        self._name = name
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def _disturb(self) -> None:
+        delay = self._delay + self._rng.uniform(0, self._jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self._rng.random() < self._error_rate:
+            raise LDAPSocketOpenError(f"nodo simulado '{self._name}' no responde")
+
+    def search(self, *args, **kwargs):
+        self._disturb()
+        return self._inner.search(*args, **kwargs)
+
+
+def mock_endpoint(name: str, delay: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                  seed: int | None = None) -> Endpoint:
+    """Nodo simulado sobre el directorio LDIF compartido, con demora y tasa de error propias."""
+    from ldif_backend import LdifConnection, get_ldif_directory
+    rng = random.Random(seed)
+
+    def connect():
+        return FaultyLdifConnection(LdifConnection(get_ldif_directory(), user=LDAP_BIND_DN), delay, jitter, error_rate, rng, name)
+    return Endpoint(name, connect)
+
+
+def parse_mock_replicas(spec: str) -> list[Endpoint]:
+    """'r1:delay=0.01;r2:delay=0.2,error_rate=0.5' → nodos simulados."""
+    endpoints = []
+    for chunk in spec.split(";"):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        name, _, options = chunk.partition(":")
+        settings = {}
+        for option in options.split(","):
+            if "=" in option:
+                key, value = option.split("=", 1)
+                settings[key.strip()] = float(value)
+        endpoints.append(mock_endpoint(
+            name.strip(), delay=settings.get("delay", 0.0), jitter=settings.get("jitter", 0.0),
+            error_rate=settings.get("error_rate", 0.0),
+            seed=int(settings["seed"]) if "seed" in settings else None,
+        ))
+    return endpoints
+
+
+_replica_set: ReplicaSet | None = None
+_replica_lock = threading.Lock()
+
+
+def get_replica_set(mock: bool = False) -> ReplicaSet:
+    """ReplicaSet compartido: réplicas simuladas (LDAP_MOCK_REPLICAS) o LDAP_HOSTS / LDAP_HOST."""
+    global _replica_set
+    if _replica_set is None:
+        with _replica_lock:
+            if _replica_set is None:
+                if mock:
+                    endpoints = parse_mock_replicas(LDAP_MOCK_REPLICAS)
+                else:
+                    endpoints = [ldap_endpoint(host) for host in (LDAP_HOSTS or [LDAP_HOST])]
+                _replica_set = ReplicaSet(endpoints)
+    return _replica_set
@@ -0,0 +1,390 @@
+import os
+import glob
+import base64
+import logging
+import threading
+from collections import deque
+from typing import Iterator
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from ldap3 import BASE, LEVEL, SUBTREE
+
+from ldap_filter import compile_filter, matches, normalize_dn, normalize_value
+from filter_index import DirectoryIndex
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_LDIF_FILES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'users_groups', '*.ldif'))
+
+
+# --- Parser LDIF en streaming ---
+
+def _logical_lines(handle) -> Iterator[str]:
+    """Une las líneas de continuación (las que empiezan con un espacio) sin leer todo el archivo."""
+    pending = None
+    for raw_line in handle:
+        line = raw_line.rstrip('\r\n')
+        if line.startswith(' ') and pending is not None:
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending is not None:
+        yield pending
+
+
+def _decode_attribute_value(line: str) -> tuple[str, str | bytes]:
+    name, _, rest = line.partition(':')
+    name = name.split(';', 1)[0].strip()
+    if rest.startswith(':'):
+        data = base64.b64decode(rest[1:].strip())
+        try:
+            return name, data.decode('utf-8')
+        except UnicodeDecodeError:
+            return name, data
+    if rest.startswith('<'):
+        url = urlparse(rest[1:].strip())
+        with open(url2pathname(url.path), 'rb') as fh:
+            return name, fh.read()
+    return name, rest.lstrip(' ')
+
+
+def iter_ldif_records(path: str) -> Iterator[tuple[str, str, dict]]:
+    """
+    Recorre un archivo LDIF y devuelve (changetype, dn, atributos) por cada registro.
+    Procesa el archivo línea a línea, por lo que sirve para exportaciones de varios GB.
+    """
+    with open(path, 'r', encoding='utf-8') as handle:
+        dn = None
+        changetype = "add"
+        attributes: dict[str, list] = {}
+        for line in _logical_lines(handle):
+            if not line.strip():
+                if dn is not None:
+                    yield changetype, dn, attributes
+                dn, changetype, attributes = None, "add", {}
+                continue
+            if line.startswith('#') or line == '-':
+                continue
+            name, value = _decode_attribute_value(line)
+            lowered = name.lower()
+            if lowered == 'version' and dn is None:
+                continue
+            if lowered == 'dn':
+                dn = value if isinstance(value, str) else value.decode('utf-8', errors='replace')
+            elif lowered == 'changetype':
+                changetype = str(value).strip().lower()
+            elif dn is not None:
+                attributes.setdefault(name, []).append(value)
+        if dn is not None:
+            yield changetype, dn, attributes
+
+
+# --- Almacén indexado en memoria ---
+
+class LdifRecord:
+    __slots__ = ("record_id", "dn", "key", "attributes", "normalized")
+
+    def __init__(self, record_id: int, dn: str, attributes: dict[str, list]):
+        self.record_id = record_id
+        self.dn = dn
+        self.key = normalize_dn(dn)
+        # Nombre de atributo tal como aparece en el LDIF -> valores originales.
+        self.attributes = attributes
+        # Nombre en minúsculas -> valores normalizados para evaluar filtros.
+        self.normalized = {
+            name.lower(): [normalize_value(name, value) for value in values]
+            for name, values in attributes.items()
+        }
+
+    def project(self, requested: list[str] | None) -> dict[str, list]:
+        """Proyecta los atributos pedidos con la semántica de ldap3 ('*' = todos, [] = ninguno)."""
+        if not requested:
+            return {}
+        if isinstance(requested, str):
+            requested = [requested]
+        wanted = {attr.lower() for attr in requested}
+        if '*' in wanted:
+            return {name: list(values) for name, values in self.attributes.items()}
+        return {name: list(values) for name, values in self.attributes.items() if name.lower() in wanted}
+
+
+def _parent_key(key: str) -> str | None:
+    # Las comas escapadas en los RDN no aparecen en los datos del desafío; se separa por la primera coma.
+    _, sep, parent = key.partition(',')
+    return parent if sep else None
+
+
+def record_in_scope(key: str, base_key: str, scope: str) -> bool:
+    """Indica si el DN normalizado 'key' está en el ámbito 'scope' de 'base_key'."""
+    if scope == BASE:
+        return key == base_key
+    if scope == LEVEL:
+        return _parent_key(key) == base_key
+    return key == base_key or key.endswith(f",{base_key}")
+
+
+class LdifDirectory:
+    """Directorio en memoria cargado desde LDIF con la semántica de búsqueda que usan las herramientas."""
+
+    def __init__(self, indexed_attributes: set[str] | None = None):
+        self._records: dict[str, LdifRecord] = {}
+        self._by_id: dict[int, LdifRecord] = {}
+        self._children: dict[str, list[str]] = {}
+        self._index = DirectoryIndex(indexed_attributes)
+        self._next_id = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add_entry(self, dn: str, attributes: dict[str, list]) -> LdifRecord:
+        with self._lock:
+            key = normalize_dn(dn)
+            previous = self._records.get(key)
+            if previous is not None:
+                self._index.remove(previous.record_id, previous.normalized)
+                del self._by_id[previous.record_id]
+            else:
+                parent = _parent_key(key)
+                if parent is not None:
+                    self._children.setdefault(parent, []).append(key)
+            record = LdifRecord(self._next_id, dn, attributes)
+            self._next_id += 1
+            self._records[key] = record
+            self._by_id[record.record_id] = record
+            self._index.add(record.record_id, record.normalized)
+        return record
+
+    def delete_entry(self, dn: str) -> None:
+        key = normalize_dn(dn)
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record is None:
+                return
+            del self._by_id[record.record_id]
+            self._index.remove(record.record_id, record.normalized)
+            parent = _parent_key(key)
+            siblings = self._children.get(parent)
+            if siblings and key in siblings:
+                siblings.remove(key)
+
+    def load(self, path: str) -> int:
+        loaded = 0
+        for changetype, dn, attributes in iter_ldif_records(path):
+            if changetype == "add":
+                self.add_entry(dn, attributes)
+                loaded += 1
+            elif changetype == "delete":
+                self.delete_entry(dn)
+            else:
+                logger.warning(f"changetype '{changetype}' no soportado en {path} para '{dn}'. Registro ignorado.")
+        return loaded
+
+    def get(self, dn: str) -> LdifRecord | None:
+        return self._records.get(normalize_dn(dn))
+
+    def _scope_candidates(self, base_key: str, scope: str) -> Iterator[LdifRecord]:
+        base = self._records.get(base_key)
+        if scope == BASE:
+            if base is not None:
+                yield base
+            return
+        if scope == LEVEL:
+            for key in self._children.get(base_key, []):
+                yield self._records[key]
+            return
+        if base is not None:
+            yield base
+        pending = deque(self._children.get(base_key, []))
+        while pending:
+            key = pending.popleft()
+            yield self._records[key]
+            pending.extend(self._children.get(key, []))
+
+    @staticmethod
+    def _in_scope(record: LdifRecord, base_key: str, scope: str) -> bool:
+        return record_in_scope(record.key, base_key, scope)
+
+    def search(self, search_base: str, search_filter: str, search_scope: str = SUBTREE,
+               size_limit: int = 0) -> list[LdifRecord]:
+        """
+        Busca con el plan compilado del filtro: si los índices cubren el filtro, el costo es
+        proporcional al resultado; si no, se recorre el ámbito verificando cada entrada.
+        """
+        compiled = compile_filter(search_filter)
+        base_key = normalize_dn(search_base)
+        results = []
+        with self._lock:
+            candidate_ids, covered = (None, False)
+            if compiled.plan is not None:
+                candidate_ids, covered = self._index.candidates(compiled.plan)
+
+            if candidate_ids is None:
+                candidates = self._scope_candidates(base_key, search_scope)
+                verify = True
+            else:
+                candidates = (self._by_id[record_id] for record_id in sorted(candidate_ids))
+                candidates = (record for record in candidates if self._in_scope(record, base_key, search_scope))
+                verify = not (compiled.exact and covered)
+
+            for record in candidates:
+                if verify and not matches(compiled.ast, record.normalized):
+                    continue
+                results.append(record)
+                if size_limit and len(results) >= size_limit:
+                    break
+        return results
+
+
+def _resolve_ldif_paths(spec: str | None) -> list[str]:
+    paths = []
+    for pattern in (spec or DEFAULT_LDIF_FILES).split(os.pathsep):
+        pattern = pattern.strip()
+        if pattern:
+            paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+_directory: LdifDirectory | None = None
+_directory_lock = threading.Lock()
+
+
+def load_ldif_directory(spec: str | None = None) -> LdifDirectory:
+    """Carga uno o varios LDIF (patrones glob separados por os.pathsep) en un nuevo directorio."""
+    directory = LdifDirectory()
+    for path in _resolve_ldif_paths(spec):
+        count = directory.load(path)
+        logger.info(f"LDIF '{path}' cargado: {count} entradas.")
+    return directory
+
+
+def get_ldif_directory() -> LdifDirectory:
+    """Devuelve el directorio compartido, cargándolo desde LDAP_LDIF_FILES la primera vez."""
+    global _directory
+    if _directory is None:
+        with _directory_lock:
+            if _directory is None:
+                _directory = load_ldif_directory(os.getenv("LDAP_LDIF_FILES"))
+    return _directory
+
+
+# --- Emulación del subconjunto de ldap3.Connection que usan las herramientas ---
+
+class LdifAttribute:
+    def __init__(self, key: str, values: list):
+        self.key = key
+        self.values = values
+
+    @property
+    def value(self):
+        if not self.values:
+            return None
+        return self.values[0] if len(self.values) == 1 else self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, item) -> bool:
+        return item in self.values
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+    def __repr__(self) -> str:
+        return f"{self.key}: {self.value!r}"
+
+
+class LdifEntry:
+    def __init__(self, dn: str, attributes: dict[str, list]):
+        self.entry_dn = dn
+        self._attributes = {name.lower(): LdifAttribute(name, values) for name, values in attributes.items()}
+
+    @property
+    def entry_attributes(self) -> list[str]:
+        return [attribute.key for attribute in self._attributes.values()]
+
+    @property
+    def entry_attributes_as_dict(self) -> dict[str, list]:
+        return {attribute.key: list(attribute.values) for attribute in self._attributes.values()}
+
+    def __contains__(self, item: str) -> bool:
+        return item.lower() in self._attributes
+
+    def __getitem__(self, item: str) -> LdifAttribute:
+        try:
+            return self._attributes[item.lower()]
+        except KeyError:
+            raise KeyError(f"El atributo '{item}' no está presente en '{self.entry_dn}'.")
+
+    def __getattr__(self, item: str) -> LdifAttribute:
+        if item.startswith('_'):
+            raise AttributeError(item)
+        try:
+            return self._attributes[item.lower()]
+        except KeyError:
+            raise AttributeError(f"El atributo '{item}' no está presente en '{self.entry_dn}'.")
+
+    def __repr__(self) -> str:
+        return f"DN: {self.entry_dn}"
+
+
+def _response_item(dn: str, attributes: dict[str, list]) -> dict:
+    return {"type": "searchResEntry", "dn": dn, "attributes": attributes, "raw_attributes": attributes}
+
+
+class _LdifStandardExtend:
+    def __init__(self, connection: "LdifConnection"):
+        self._connection = connection
+
+    def paged_search(self, search_base, search_filter, search_scope=SUBTREE, attributes=None,
+                     paged_size=100, generator=True, **kwargs):
+        records = self._connection.directory.search(search_base, search_filter, search_scope)
+        items = (_response_item(record.dn, record.project(attributes)) for record in records)
+        return items if generator else list(items)
+
+
+class _LdifExtend:
+    def __init__(self, connection: "LdifConnection"):
+        self.standard = _LdifStandardExtend(connection)
+
+
+class LdifConnection:
+    """
+    Conexión de solo lectura sobre un LdifDirectory con la interfaz de ldap3.Connection
+    que usan las herramientas: bound, search, entries, response, extend.standard.paged_search y unbind.
+    """
+
+    def __init__(self, directory: LdifDirectory, user: str | None = None):
+        self.directory = directory
+        self.user = user
+        self.bound = True
+        self.entries: list[LdifEntry] = []
+        self.response: list[dict] = []
+        self.result: dict = {}
+        self.extend = _LdifExtend(self)
+
+    def bind(self) -> bool:
+        self.bound = True
+        return True
+
+    def unbind(self) -> bool:
+        self.bound = False
+        return True
+
+    def search(self, search_base, search_filter, search_scope=SUBTREE, dereference_aliases=None,
+               attributes=None, size_limit=0, **kwargs) -> bool:
+        records = self.directory.search(search_base, search_filter, search_scope, size_limit=size_limit)
+        projected = [(record.dn, record.project(attributes)) for record in records]
+        self.entries = [LdifEntry(dn, attrs) for dn, attrs in projected]
+        self.response = [_response_item(dn, attrs) for dn, attrs in projected]
+        self.result = {"result": 0, "description": "success"}
+        return bool(self.entries)
@@ -1,11 +1,15 @@
 import os,re
 from dotenv import load_dotenv
-from ldap3 import Server, Connection, ALL, SUBTREE,ALL_ATTRIBUTES
+from ldap3 import SUBTREE
 from langchain_core.tools import tool
 import ldap3.core.exceptions
 import json
 import logging
 
+from ldap_backend import open_connection, uses_network_backend
+from filter_builder import eq, and_, or_, FilterBuilderError
+from ldap_filter import normalize_dn
+
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -13,7 +17,8 @@ logger = logging.getLogger(__name__)
 
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
-LDAP_HOST = os.getenv("LDAP_HOST")
+# Con varios nodos (LDAP_HOSTS) alcanza con definir esa variable.
+LDAP_HOST = os.getenv("LDAP_HOST") or os.getenv("LDAP_HOSTS")
 LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
 LDAP_BIND_PASSWORD = os.getenv("LDAP_BIND_PASSWORD")
 LDAP_USERS_BASE_DN = os.getenv("LDAP_USERS_BASE_DN")
@@ -23,11 +28,9 @@ LDAP_GROUPS_BASE_DN = os.getenv("LDAP_GROUPS_BASE_DN")
 @tool
 def get_all_usernames_tool() -> list[str] | dict:
     """Devuelve los uid (nombres de usuario) de todos los usuarios del dominio."""
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para get_all_usernames_tool. DN: {LDAP_BIND_DN}.")
@@ -72,15 +75,14 @@ def get_all_usernames_tool() -> list[str] | dict:
 @tool
 def get_user_attributes_tool(uid: str) -> dict:
     """Dado un uid, devuelve todos los atributos disponibles de ese usuario."""
-    if not all([LDAP_HOST, LDAP_BIND_DN, LDAP_BIND_PASSWORD, LDAP_USERS_BASE_DN]):
+    if not LDAP_USERS_BASE_DN or (uses_network_backend() and not all([LDAP_HOST, LDAP_BIND_DN, LDAP_BIND_PASSWORD])):
         logger.error("Error: Variables de entorno LDAP no completamente configuradas para get_user_attributes_tool.")
         return {"error": "Variables de entorno LDAP no completamente configuradas."}
 
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES) 
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        user_filter = eq('uid', uid)
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para el usuario '{LDAP_BIND_DN}' con las credenciales proporcionadas.")
@@ -88,7 +90,7 @@ def get_user_attributes_tool(uid: str) -> dict:
 
         conn.search(
             search_base=LDAP_USERS_BASE_DN,
-            search_filter=f'(uid={uid})',
+            search_filter=user_filter,
             search_scope=SUBTREE,
             attributes=['*']
         )
@@ -126,6 +128,8 @@ def get_user_attributes_tool(uid: str) -> dict:
         else:
             return {"error": f"No user found with uid: {uid}"}
             
+    except FilterBuilderError as e:
+        return {"error": f"Valor de búsqueda inválido para get_user_attributes_tool: {e}"}
     except ldap3.core.exceptions.LDAPSocketOpenError as e:
         error_msg = f"Error de conexión LDAP para get_user_attributes_tool: {e}"
         logger.error(error_msg)
@@ -146,11 +150,9 @@ def get_user_attributes_tool(uid: str) -> dict:
 @tool
 def get_group_names_tool() -> list[str] | dict:
     """Devuelve los nombres (cn) de todos los grupos del dominio."""
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para get_group_names_tool. DN: {LDAP_BIND_DN}.")
@@ -188,7 +190,7 @@ def get_current_user_info_tool(field: str | None = None) -> dict | str | list |
     Si se proporciona 'field', devuelve solo el valor de ese atributo específico (ej., 'mail', 'gidNumber').
     De lo contrario, devuelve todos los atributos como un diccionario.
     """
-    if not all([LDAP_HOST, LDAP_BIND_DN]): 
+    if not LDAP_BIND_DN or (uses_network_backend() and not LDAP_HOST): 
         error_msg = "Error: Las variables de entorno LDAP_HOST o LDAP_BIND_DN no están configuradas para get_current_user_info_tool."
         logger.error(error_msg)
         return {"error": error_msg}
@@ -233,11 +235,10 @@ def get_user_groups_tool(uid: str) -> list[str] | dict:
     """
     Dado un uid (nombre de usuario), devuelve los nombres de los grupos a los que pertenece ese usuario.
     """
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        user_filter = eq('uid', uid)
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para get_user_groups_tool. DN: {LDAP_BIND_DN}.")
@@ -246,7 +247,7 @@ def get_user_groups_tool(uid: str) -> list[str] | dict:
         
         conn.search(
             search_base=LDAP_USERS_BASE_DN,
-            search_filter=f'(uid={uid})',
+            search_filter=user_filter,
             search_scope=SUBTREE,
             attributes=[] 
         )
@@ -259,7 +260,7 @@ def get_user_groups_tool(uid: str) -> list[str] | dict:
         
         conn.search(
             search_base=LDAP_GROUPS_BASE_DN,
-            search_filter=f'(member={user_dn})',
+            search_filter=eq('member', user_dn),
             search_scope=SUBTREE,
             attributes=['cn']
         )
@@ -268,6 +269,8 @@ def get_user_groups_tool(uid: str) -> list[str] | dict:
             return [entry.cn.value for entry in conn.entries if 'cn' in entry]
         else:
             return []
+    except FilterBuilderError as e:
+        return {"error": f"Valor de búsqueda inválido para get_user_groups_tool: {e}"}
     except ldap3.core.exceptions.LDAPSocketOpenError as e:
         return {"error": f"Error de conexión LDAP para get_user_groups_tool: {e}"}
     except ldap3.core.exceptions.LDAPBindError as e:
@@ -286,11 +289,10 @@ def enumerate_group_members_tool(group_name: str) -> list[str] | dict:
     Dado el nombre común (cn) de un grupo, devuelve una lista de los DNs de sus miembros.
     Útil para identificar usuarios dentro de grupos específicos, especialmente grupos privilegiados.
     """
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        group_filter = and_(eq('objectClass', 'groupOfNames'), eq('cn', group_name))
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para enumerate_group_members_tool. DN: {LDAP_BIND_DN}.")
@@ -298,7 +300,7 @@ def enumerate_group_members_tool(group_name: str) -> list[str] | dict:
 
         conn.search(
             search_base=LDAP_GROUPS_BASE_DN,
-            search_filter=f'(&(objectClass=groupOfNames)(cn={group_name}))',
+            search_filter=group_filter,
             search_scope=SUBTREE,
             attributes=['member']
         )
@@ -308,6 +310,8 @@ def enumerate_group_members_tool(group_name: str) -> list[str] | dict:
             return [str(member) for member in members]
         else:
             return {"error": f"Group '{group_name}' not found or has no members."}
+    except FilterBuilderError as e:
+        return {"error": f"Valor de búsqueda inválido para enumerate_group_members_tool: {e}"}
     except ldap3.core.exceptions.LDAPSocketOpenError as e:
         return {"error": f"Error de conexión LDAP para enumerate_group_members_tool: {e}"}
     except ldap3.core.exceptions.LDAPBindError as e:
@@ -325,11 +329,10 @@ def get_user_email_tool(uid: str) -> str | dict:
     """
     Dado un uid (nombre de usuario), devuelve la dirección de correo electrónico del usuario.
     """
-    server = None
     conn = None
     try:
-        server = Server(LDAP_HOST, use_ssl=True, get_info=ALL_ATTRIBUTES)
-        conn = Connection(server, user=LDAP_BIND_DN, password=LDAP_BIND_PASSWORD, auto_bind=True)
+        user_filter = eq('uid', uid)
+        conn = open_connection()
 
         if not conn.bound:
             logger.error(f"Error: No se pudo realizar el bind para get_user_email_tool. DN: {LDAP_BIND_DN}.")
@@ -337,7 +340,7 @@ def get_user_email_tool(uid: str) -> str | dict:
 
         conn.search(
             search_base=LDAP_USERS_BASE_DN,
-            search_filter=f'(uid={uid})',
+            search_filter=user_filter,
             search_scope=SUBTREE,
             attributes=['mail']
         )
@@ -346,6 +349,8 @@ def get_user_email_tool(uid: str) -> str | dict:
             return conn.entries[0].mail.value
         else:
             return {"error": f"User '{uid}' not found or has no email address."}
+    except FilterBuilderError as e:
+        return {"error": f"Valor de búsqueda inválido para get_user_email_tool: {e}"}
     except ldap3.core.exceptions.LDAPSocketOpenError as e:
         return {"error": f"Error de conexión LDAP para get_user_email_tool: {e}"}
     except ldap3.core.exceptions.LDAPBindError as e:
@@ -356,3 +361,128 @@ def get_user_email_tool(uid: str) -> str | dict:
     finally:
         if conn and conn.bound:
             conn.unbind()
+
+
+def get_user_attribute_value(uid: str, attribute: str) -> str | list | dict:
+    """
+    Dado un uid y el nombre de un atributo LDAP, devuelve solo el valor de ese atributo.
+    Es la base de las herramientas genéricas de atributo, que no requieren generar código.
+    """
+    conn = None
+    try:
+        user_filter = eq('uid', uid)
+        conn = open_connection()
+
+        if not conn.bound:
+            logger.error(f"Error: No se pudo realizar el bind para get_user_attribute_value. DN: {LDAP_BIND_DN}.")
+            return {"error": f"No se pudo realizar el bind para get_user_attribute_value."}
+
+        conn.search(
+            search_base=LDAP_USERS_BASE_DN,
+            search_filter=user_filter,
+            search_scope=SUBTREE,
+            attributes=[attribute]
+        )
+
+        if conn.entries and attribute in conn.entries[0]:
+            value = conn.entries[0][attribute].value
+            if isinstance(value, bytes):
+                try:
+                    return value.decode('utf-8')
+                except UnicodeDecodeError:
+                    return str(value)
+            return value
+        else:
+            return {"error": f"User '{uid}' not found or has no '{attribute}' attribute."}
+    except FilterBuilderError as e:
+        return {"error": f"Valor de búsqueda inválido para get_user_attribute_value: {e}"}
+    except ldap3.core.exceptions.LDAPSocketOpenError as e:
+        return {"error": f"Error de conexión LDAP para get_user_attribute_value: {e}"}
+    except ldap3.core.exceptions.LDAPBindError as e:
+        return {"error": f"Error de autenticación LDAP para get_user_attribute_value: {e}"}
+    except Exception as e:
+        logger.error(f"Error inesperado en get_user_attribute_value: {e}", exc_info=True)
+        return {"error": f"Ocurrió un error inesperado al obtener el atributo '{attribute}' del usuario {uid}: {e}"}
+    finally:
+        if conn and conn.bound:
+            conn.unbind()
+
+
+# --- Consultas en bloque para el precalentamiento (agent/prefetch.py) ---
+# Cada función resuelve muchos argumentos con una búsqueda por lote (filtro OR) y devuelve
+# argumento en minúsculas -> el mismo resultado que daría la herramienta correspondiente.
+# Los argumentos que la herramienta respondería con {"error": ...} se omiten.
+
+BULK_CHUNK_SIZE = int(os.getenv("PREFETCH_BULK_CHUNK", "50"))
+
+
+def _chunks(values: list[str], size: int = BULK_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _first_text(attribute) -> str:
+    value = attribute.value
+    if isinstance(value, list):
+        value = value[0] if value else ""
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+
+def _bulk_search(conn, base: str, attribute: str, values: list[str], attributes: list[str], object_class: str | None = None):
+    for chunk in _chunks(values):
+        search_filter = or_(*(eq(attribute, value) for value in chunk))
+        if object_class:
+            search_filter = and_(eq('objectClass', object_class), search_filter)
+        conn.search(search_base=base, search_filter=search_filter, search_scope=SUBTREE, attributes=attributes)
+        yield from conn.entries
+
+
+def bulk_user_emails(uids: list[str]) -> dict[str, object]:
+    """Resultados de get_user_email_tool para varios uids."""
+    conn = open_connection()
+    try:
+        results = {}
+        for entry in _bulk_search(conn, LDAP_USERS_BASE_DN, 'uid', uids, ['uid', 'mail']):
+            if 'uid' in entry and 'mail' in entry:
+                results.setdefault(_first_text(entry.uid).lower(), entry.mail.value)
+        return results
+    finally:
+        if conn.bound:
+            conn.unbind()
+
+
+def bulk_user_groups(uids: list[str]) -> dict[str, list[str]]:
+    """Resultados de get_user_groups_tool para varios uids: un lote de usuarios y otro de grupos."""
+    conn = open_connection()
+    try:
+        user_dns = {}
+        for entry in _bulk_search(conn, LDAP_USERS_BASE_DN, 'uid', uids, ['uid']):
+            if 'uid' in entry:
+                user_dns.setdefault(_first_text(entry.uid).lower(), entry.entry_dn)
+        results = {uid: [] for uid in user_dns}
+        members_of = {normalize_dn(dn): uid for uid, dn in user_dns.items()}
+        for entry in _bulk_search(conn, LDAP_GROUPS_BASE_DN, 'member', list(user_dns.values()), ['cn', 'member']):
+            if 'cn' not in entry or 'member' not in entry:
+                continue
+            for member in entry.member.values:
+                uid = members_of.get(normalize_dn(str(member)))
+                if uid is not None and entry.cn.value not in results[uid]:
+                    results[uid].append(entry.cn.value)
+        return results
+    finally:
+        if conn.bound:
+            conn.unbind()
+
+
+def bulk_group_members(group_names: list[str]) -> dict[str, list[str]]:
+    """Resultados de enumerate_group_members_tool para varios grupos."""
+    conn = open_connection()
+    try:
+        results = {}
+        for entry in _bulk_search(conn, LDAP_GROUPS_BASE_DN, 'cn', group_names, ['cn', 'member'], 'groupOfNames'):
+            if 'cn' in entry and 'member' in entry:
+                results.setdefault(_first_text(entry.cn).lower(), [str(member) for member in entry.member.values])
+        return results
+    finally:
+        if conn.bound:
+            conn.unbind()